@@ -0,0 +1,219 @@
+import argparse
+import json
+import re
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from storage import get_storage
+
+# ------------------ 段落选择一致性分析 ------------------
+# PASSAGE_SELECTION 事件记录了参与者在某篇文档里选中的字符区间 [start_idx, end_idx)，
+# 下标相对于前端 unifyWhitespace() 之后的全文（连续空白合并为一个空格并去掉首尾空白）。
+# 同一 (用户, 查询, 文档) 以最后一次事件为准：后来的 PASSAGE_SELECTION 覆盖之前的区间
+# （UPDATE_SELECTION 只是重新打开文档，之后取消则保留原区间），UNSELECT 清除选择。
+#
+# 每篇文档的计算都是线性的：k 个区间先写进差分数组，前缀和得到每个字符（或词）被多少人选中
+# 的覆盖计数 c，再由 c 直接得到所有两两组合的交集之和 Σ c(c-1)/2，不需要枚举参与者对。
+#     python agreement.py [--qid N] [--heatmap heatmap.json] [--pairwise pairwise.json]
+
+SELECTION_EVENT = "PASSAGE_SELECTION"
+UNSELECT_EVENT = "UNSELECT"
+
+DocumentAgreement = namedtuple("DocumentAgreement", [
+    "qid", "docno", "raters", "selectors",
+    "char_jaccard", "token_jaccard", "token_kappa",
+    "char_coverage", "token_coverage",
+])
+
+_WHITESPACE = re.compile(r"\s+")
+_TOKEN = re.compile(r"\S+")
+
+
+def normalize_text(text):
+    """与前端 unifyWhitespace() 一致，选择区间的下标基于这个字符串。"""
+    return _WHITESPACE.sub(" ", (text or "").replace("\r", "")).strip()
+
+
+def final_spans(events):
+    """
+    events: 按事件时间排序的 (user_id, qid, docno, event_type, start_idx, end_idx)。
+    返回 {(qid, docno): {user_id: (start, end)}}，只包含最终仍处于选中状态的区间。
+    """
+    latest = {}
+    for user_id, qid, docno, event_type, start, end in events:
+        key = (qid, str(docno), user_id)
+        if event_type == SELECTION_EVENT and start is not None and end is not None and 0 <= start < end:
+            latest[key] = (int(start), int(end))
+        elif event_type == UNSELECT_EVENT:
+            latest.pop(key, None)
+
+    spans = {}
+    for (qid, docno, user_id), span in latest.items():
+        spans.setdefault((qid, docno), {})[user_id] = span
+    return spans
+
+
+def token_bounds(text):
+    """规范化文本中每个词（非空白串）的 [start, end) 字符下标。"""
+    bounds = np.array([m.span() for m in _TOKEN.finditer(text)], dtype=np.int64).reshape(-1, 2)
+    return bounds[:, 0], bounds[:, 1]
+
+
+def coverage(starts, ends, length):
+    """每个位置被多少个区间覆盖（差分数组 + 前缀和，O(k + length)）。"""
+    diff = np.zeros(length + 1, dtype=np.int64)
+    np.add.at(diff, starts, 1)
+    np.add.at(diff, ends, -1)
+    return np.cumsum(diff[:-1])
+
+
+def spans_to_tokens(starts, ends, tok_starts, tok_ends):
+    """
+    字符区间 -> 词区间 [first, last)：与区间有任何重叠的词都算选中。
+    tok_starts / tok_ends 有序，用 searchsorted 一次处理全部区间。
+    """
+    first = np.searchsorted(tok_ends, starts, side="right")
+    last = np.searchsorted(tok_starts, ends, side="left")
+    return first, np.maximum(first, last)
+
+
+def pairwise_stats(cov, k):
+    """
+    由覆盖计数得到所有参与者对的汇总：
+      交集之和 I = Σ c(c-1)/2，并集之和 U = (k-1)·Σc - I，
+    返回 (micro 平均 Jaccard = I / U, Fleiss kappa)。k < 2 或没有任何选择时为 nan。
+    """
+    if k < 2 or cov.size == 0:
+        return float("nan"), float("nan")
+    cov = cov.astype(np.float64)
+    total = cov.sum()
+    intersections = (cov * (cov - 1) / 2).sum()
+    unions = (k - 1) * total - intersections
+    jaccard = intersections / unions if unions > 0 else float("nan")
+
+    # Fleiss kappa：每个位置是一个条目，k 个评分者给出“选中/未选中”两类
+    agree = (cov * (cov - 1) + (k - cov) * (k - cov - 1)) / (k * (k - 1))
+    p = total / (cov.size * k)
+    expected = p * p + (1 - p) * (1 - p)
+    kappa = (agree.mean() - expected) / (1 - expected) if expected < 1 else float("nan")
+    return float(jaccard), float(kappa)
+
+
+def document_agreement(qid, docno, text, spans, raters):
+    """
+    一篇文档的一致性。spans: {user_id: (start, end)}；raters: 看过该查询的全部参与者，
+    没有选择这篇文档的参与者按“全部未选中”参与计算。
+    """
+    text = normalize_text(text)
+    length = len(text)
+    k = max(len(raters), len(spans))
+    if spans:
+        bounds = np.array(list(spans.values()), dtype=np.int64)
+        starts = np.clip(bounds[:, 0], 0, length)
+        ends = np.clip(bounds[:, 1], 0, length)
+    else:
+        starts = ends = np.zeros(0, dtype=np.int64)
+
+    char_cov = coverage(starts, ends, length)
+    tok_starts, tok_ends = token_bounds(text)
+    first, last = spans_to_tokens(starts, ends, tok_starts, tok_ends)
+    token_cov = coverage(first, last, len(tok_starts))
+
+    char_jaccard, _ = pairwise_stats(char_cov, k)
+    token_jaccard, token_kappa = pairwise_stats(token_cov, k)
+    return DocumentAgreement(qid, docno, k, len(spans), char_jaccard, token_jaccard, token_kappa,
+                             char_cov, token_cov)
+
+
+def pairwise_overlap(starts, ends):
+    """k 个区间两两之间的 (交集长度矩阵, 并集长度矩阵)，用于参与者对之间的比较。"""
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    inter = np.clip(np.minimum(ends[:, None], ends[None, :]) - np.maximum(starts[:, None], starts[None, :]),
+                    0, None)
+    sizes = ends - starts
+    union = sizes[:, None] + sizes[None, :] - inter
+    return inter, union
+
+
+def pairwise_matrix(spans_by_doc, users):
+    """
+    所有文档汇总后的参与者两两字符级 Jaccard（ΣI / ΣU），返回 users 顺序的矩阵；
+    两人在共同文档上都没有选择时为 nan。
+    """
+    index = {user: i for i, user in enumerate(users)}
+    n = len(users)
+    inter_total = np.zeros((n, n))
+    union_total = np.zeros((n, n))
+    for spans in spans_by_doc.values():
+        members = [u for u in spans if u in index]
+        if not members:
+            continue
+        idx = np.array([index[u] for u in members])
+        bounds = np.array([spans[u] for u in members], dtype=np.int64)
+        inter, union = pairwise_overlap(bounds[:, 0], bounds[:, 1])
+        inter_total[np.ix_(idx, idx)] += inter
+        union_total[np.ix_(idx, idx)] += union
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(union_total > 0, inter_total / union_total, np.nan)
+
+
+def analyse(qid=None, storage=None):
+    """
+    从存储中读取事件和语料，返回 (final_spans 的结果, 每篇有人选择过的文档的 DocumentAgreement 列表)。
+    """
+    storage = storage or get_storage()
+    spans_by_doc = final_spans(storage.selection_events((SELECTION_EVENT, UNSELECT_EVENT), qid))
+    raters_by_qid = {}
+    for user_id, participant_qid in storage.query_participants(qid):
+        raters_by_qid.setdefault(participant_qid, set()).add(user_id)
+
+    _, _, documents = storage.load_corpus()
+    texts = {(row["qid"], str(row["docno"])): row["content"] for row in documents}
+
+    results = []
+    for (doc_qid, docno), spans in sorted(spans_by_doc.items()):
+        text = texts.get((doc_qid, docno))
+        if text is None:
+            continue
+        results.append(document_agreement(doc_qid, docno, text, spans, raters_by_qid.get(doc_qid, set())))
+    return spans_by_doc, results
+
+
+def _fmt(value):
+    return "   -" if value != value else f"{value:.3f}"  # nan
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="段落选择的参与者间一致性")
+    parser.add_argument("--qid", type=int, help="只分析一个查询")
+    parser.add_argument("--heatmap", help="把每篇文档的词级覆盖计数写入 JSON 文件")
+    parser.add_argument("--pairwise", help="把参与者两两字符级 Jaccard 矩阵写入 JSON 文件")
+    args = parser.parse_args(argv)
+
+    spans_by_doc, results = analyse(args.qid)
+    print(f"{'qid':>10} {'docno':>12} {'raters':>6} {'sel':>4} {'charJ':>6} {'tokJ':>6} {'kappa':>6}")
+    for r in results:
+        print(f"{r.qid:>10} {r.docno:>12} {r.raters:>6} {r.selectors:>4} "
+              f"{_fmt(r.char_jaccard):>6} {_fmt(r.token_jaccard):>6} {_fmt(r.token_kappa):>6}")
+
+    if args.heatmap:
+        heatmap = {}
+        for r in results:
+            heatmap.setdefault(str(r.qid), {})[r.docno] = {"raters": r.raters,
+                                                           "token_coverage": r.token_coverage.tolist()}
+        with open(args.heatmap, "w", encoding="utf-8") as f:
+            json.dump(heatmap, f)
+    if args.pairwise:
+        users = sorted({u for spans in spans_by_doc.values() for u in spans})
+        matrix = pairwise_matrix(spans_by_doc, users)
+        with open(args.pairwise, "w", encoding="utf-8") as f:
+            json.dump({"users": users,
+                       "jaccard": [[None if v != v else round(float(v), 4) for v in row] for row in matrix]}, f)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
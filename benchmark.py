@@ -0,0 +1,377 @@
+import argparse
+import glob
+import gzip
+import http.cookiejar
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# ------------------ 并发参与者压测 ------------------
+# 模拟参与者完整走一遍实验：/ → /query/1..N → /thanks，期间按 query.html
+# 的方式产生 OPEN_DOC / PASSAGE_SELECTION / UNSELECT / PAGE_NAV 等事件并批量上报。
+#     python benchmark.py --url http://localhost:5000 --participants 200 --concurrency 50
+#     python benchmark.py --in-process ...          直接调用 Flask 应用（不经过网络）
+#     python benchmark.py --durations-from-db ...   思考时间按 logs 表中的 duration 分布抽样
+# 结果写入 bench_results/<时间>.json，并与上一次（或 --compare 指定的）结果对比。
+# 比较 gunicorn worker 模式（见 gunicorn.conf.py）时，用 SQLite 后端加上模拟的数据库往返：
+#     STORAGE_BACKEND=sqlite SQLITE_SIMULATED_LATENCY_MS=50 GUNICORN_WORKER_CLASS=sync \
+#         gunicorn "app:create_app()" --bind 127.0.0.1:8790
+#     python benchmark.py --url http://127.0.0.1:8790 --participants 240 --concurrency 120 --max-queries 3
+# 上面不带思考时间，测的是吞吐量；能同时支撑多少参与者要按思考时间节奏跑（--time-scale），
+# 逐步加大 --participants/--concurrency，看 POST / 和 /query/<n> 的 p95 何时开始上升。
+
+RESULTS_DIR = "bench_results"
+
+# 事件之间的思考时间（毫秒）默认分布：对数正态 (mu, sigma)
+DEFAULT_DURATIONS = {
+    "OPEN_DOC": (8.5, 0.9),
+    "PASSAGE_SELECTION": (9.2, 0.8),
+    "CANCEL_DOC": (8.0, 0.9),
+    "UNSELECT": (7.5, 0.8),
+    "UPDATE_SELECTION": (7.5, 0.8),
+    "PAGE_NAV": (8.0, 1.0),
+    "BOT_DETECTION": (8.3, 0.5),
+}
+
+LOG_FLUSH_SIZE = 20  # 与 query.html 中的 LOG_FLUSH_SIZE 一致
+
+_DOCNO_RE = re.compile(r'data-docno="([^"]*)"')
+_QID_RE = re.compile(r"let currentQid = (\d+);")
+_TOTAL_RE = re.compile(r"let totalQueries = (\d+);")
+
+
+# ------------------ 思考时间分布 ------------------
+class DurationModel:
+    def __init__(self, samples=None, rng=None):
+        # samples: {event_type: [duration_ms, ...]}，为空时使用 DEFAULT_DURATIONS
+        self.samples = samples or {}
+        self.rng = rng or random.Random()
+
+    def sample(self, event_type):
+        values = self.samples.get(event_type)
+        if values:
+            return self.rng.choice(values)
+        mu, sigma = DEFAULT_DURATIONS.get(event_type, (8.0, 1.0))
+        return int(self.rng.lognormvariate(mu, sigma))
+
+    @classmethod
+    def from_db(cls, limit=20000):
+        """从 logs 表抽取各事件类型的 duration 经验分布。"""
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from storage import get_storage
+        samples = {}
+        for event_type, duration in get_storage().log_durations(limit):
+            samples.setdefault(event_type, []).append(int(duration))
+        return cls(samples)
+
+
+# ------------------ 传输层 ------------------
+class HttpTransport:
+    """真实 HTTP，每个参与者一个 cookie jar（保持 session）"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        jar = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar),
+                                                  _NoRedirect())
+
+    def request(self, method, path, data=None, json_body=None):
+        headers = {"Accept-Encoding": "gzip"}
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers["Content-Type"] = "application/json"
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        req = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with self.opener.open(req, timeout=30) as resp:
+                payload = resp.read()
+                if resp.headers.get("Content-Encoding") == "gzip":
+                    payload = gzip.decompress(payload)
+                return resp.status, payload.decode("utf-8", "replace")
+        except urllib.error.HTTPError as e:
+            return e.code, ""
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # 重定向按独立请求计时，所以不自动跟随
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class InProcessTransport:
+    """直接调用 Flask 测试客户端，不经过网络和 gunicorn"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None, json_body=None):
+        resp = self.client.open(path, method=method, data=data, json=json_body)
+        return resp.status_code, resp.get_data(as_text=True)
+
+
+# ------------------ 结果统计 ------------------
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, route, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100.0
+    lo, hi = math.floor(k), math.ceil(k)
+    if lo == hi:
+        return sorted_values[lo]
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(recorder, wall_seconds):
+    routes = {}
+    total = 0
+    for route, values in sorted(recorder.latencies.items()):
+        values = sorted(values)
+        total += len(values)
+        routes[route] = {
+            "count": len(values),
+            "errors": recorder.errors.get(route, 0),
+            "throughput_rps": len(values) / wall_seconds if wall_seconds else 0.0,
+            "mean_ms": 1000 * sum(values) / len(values),
+            "p50_ms": 1000 * percentile(values, 50),
+            "p95_ms": 1000 * percentile(values, 95),
+            "p99_ms": 1000 * percentile(values, 99),
+        }
+    return {
+        "wall_seconds": wall_seconds,
+        "requests": total,
+        "throughput_rps": total / wall_seconds if wall_seconds else 0.0,
+        "routes": routes,
+    }
+
+
+# ------------------ 参与者模型 ------------------
+class Participant:
+    """
+    按 query.html 的交互流程生成请求。time_scale 用来压缩思考时间
+    （例如 0.01 表示真实间隔的 1%），事件里的 duration 仍然是未压缩的原值。
+    """
+
+    def __init__(self, index, transport, recorder, durations, args, rng):
+        self.user_id = f"bench-{args.run_id}-{index}"
+        self.transport = transport
+        self.recorder = recorder
+        self.durations = durations
+        self.args = args
+        self.rng = rng
+        self.queue = []
+        self.qid = 0
+
+    def call(self, route, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            status, body = self.transport.request(method, path, **kwargs)
+        except Exception:
+            status, body = 599, ""
+        self.recorder.record(route, time.perf_counter() - started, status < 400)
+        return status, body
+
+    def think(self, duration_ms):
+        if self.args.time_scale > 0:
+            time.sleep(duration_ms * self.args.time_scale / 1000.0)
+
+    def event(self, event_type, docno=0, start=-1, end=-1, pass_flag=0):
+        duration = self.durations.sample(event_type)
+        self.think(duration)
+        self.queue.append({
+            "userId": self.user_id, "qid": self.qid, "docno": docno, "eventType": event_type,
+            "startIndex": start, "endIndex": end, "duration": duration, "passFlag": pass_flag,
+            "clientTs": int(time.time() * 1000),
+        })
+        if len(self.queue) >= LOG_FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.queue:
+            return
+        body = {"sentAt": int(time.time() * 1000), "events": self.queue}
+        self.queue = []
+        self.call("POST /api/log/batch", "POST", "/api/log/batch", json_body=body)
+
+    def run(self):
+        self.call("GET /", "GET", "/")
+        self.call("POST /", "POST", "/", data={"user_id": self.user_id, "terms": "accepted"})
+        position, total = 1, None
+        while total is None or position <= total:
+            status, html = self.call("GET /query/<n>", "GET", f"/query/{position}")
+            if status != 200:
+                break
+            qid_match, total_match = _QID_RE.search(html), _TOTAL_RE.search(html)
+            self.qid = int(qid_match.group(1)) if qid_match else 0
+            total = int(total_match.group(1)) if total_match else 0
+            if self.args.max_queries:
+                total = min(total, self.args.max_queries)
+            self.browse(position, _DOCNO_RE.findall(html))
+            self.event("PAGE_NAV")
+            self.flush()  # 页面跳转时 query.html 通过 sendBeacon 发送剩余事件
+            position += 1
+        self.call("GET /thanks", "GET", "/thanks")
+
+    def browse(self, position, docnos):
+        rng = self.rng
+        if position == 1:
+            self.event("BOT_DETECTION", pass_flag=1)
+        selected = set()
+        for docno in docnos:
+            if rng.random() > self.args.open_rate:
+                continue
+            self.event("OPEN_DOC", docno=docno)
+            if rng.random() < self.args.select_rate:
+                start = rng.randint(0, 200)
+                self.event("PASSAGE_SELECTION", docno=docno, start=start, end=start + rng.randint(20, 200))
+                selected.add(docno)
+            else:
+                self.event("CANCEL_DOC", docno=docno)
+        # 少数已选文档被取消或重新选择
+        for docno in list(selected):
+            roll = rng.random()
+            if roll < 0.05:
+                self.event("UNSELECT", docno=docno)
+            elif roll < 0.10:
+                self.event("UPDATE_SELECTION", docno=docno)
+                start = rng.randint(0, 200)
+                self.event("PASSAGE_SELECTION", docno=docno, start=start, end=start + rng.randint(20, 200))
+
+
+# ------------------ 结果保存与对比 ------------------
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def save_result(result):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{result['run_id']}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    return path
+
+
+def latest_result(exclude=None):
+    paths = sorted(p for p in glob.glob(os.path.join(RESULTS_DIR, "*.json")) if p != exclude)
+    return paths[-1] if paths else None
+
+
+def print_report(summary, baseline=None):
+    base_routes = (baseline or {}).get("summary", {}).get("routes", {})
+    header = f"{'route':<24}{'count':>8}{'err':>6}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    if baseline:
+        header += f"{'Δp95':>10}"
+    print(header)
+    for route, s in summary["routes"].items():
+        line = (f"{route:<24}{s['count']:>8}{s['errors']:>6}{s['throughput_rps']:>9.1f}"
+                f"{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}{s['p99_ms']:>10.1f}")
+        if baseline and route in base_routes and base_routes[route]["p95_ms"]:
+            change = 100.0 * (s["p95_ms"] / base_routes[route]["p95_ms"] - 1)
+            line += f"{change:>+9.1f}%"
+        print(line)
+    print(f"total: {summary['requests']} requests in {summary['wall_seconds']:.1f}s "
+          f"({summary['throughput_rps']:.1f} req/s)")
+
+
+# ------------------ 入口 ------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="模拟并发参与者压测")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="被测服务地址，例如 http://localhost:5000")
+    target.add_argument("--in-process", action="store_true", help="直接调用本地 Flask 应用")
+    parser.add_argument("--participants", type=int, default=50, help="参与者总数")
+    parser.add_argument("--concurrency", type=int, default=10, help="同时进行实验的参与者数")
+    parser.add_argument("--max-queries", type=int, default=0, help="每个参与者最多完成的查询数（0 表示全部）")
+    parser.add_argument("--time-scale", type=float, default=0.0,
+                        help="思考时间缩放比例，0 表示不等待（默认），1 表示真实速度")
+    parser.add_argument("--open-rate", type=float, default=0.8, help="每篇文档被打开的概率")
+    parser.add_argument("--select-rate", type=float, default=0.5, help="打开后提交选段的概率")
+    parser.add_argument("--durations-from-db", action="store_true", help="从 logs 表抽样思考时间")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--label", default="", help="记录在结果文件中的说明")
+    parser.add_argument("--compare", help="对比的历史结果文件（默认为最近一次）")
+    parser.add_argument("--no-save", action="store_true", help="不保存结果文件")
+    args = parser.parse_args(argv)
+    args.run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    seed_rng = random.Random(args.seed)
+    durations = DurationModel.from_db() if args.durations_from_db else DurationModel()
+
+    if args.in_process:
+        from app import create_app
+        app = create_app()
+
+        def make_transport():
+            return InProcessTransport(app)
+    else:
+        def make_transport():
+            return HttpTransport(args.url)
+
+    recorder = Recorder()
+    seeds = [seed_rng.random() for _ in range(args.participants)]
+
+    def run_participant(index):
+        rng = random.Random(seeds[index])
+        participant_durations = DurationModel(durations.samples, rng)
+        Participant(index, make_transport(), recorder, participant_durations, args, rng).run()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for future in [pool.submit(run_participant, i) for i in range(args.participants)]:
+            future.result()
+    wall = time.perf_counter() - started
+
+    summary = summarize(recorder, wall)
+    result = {
+        "run_id": args.run_id,
+        "label": args.label,
+        "git_commit": _git_commit(),
+        "target": "in-process" if args.in_process else args.url,
+        "config": {k: v for k, v in vars(args).items() if k not in ("run_id", "compare", "no_save")},
+        "summary": summary,
+    }
+
+    baseline_path = args.compare or latest_result()
+    baseline = None
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        print(f"对比基准: {baseline_path} ({baseline.get('label') or baseline.get('git_commit')})")
+    print_report(summary, baseline)
+
+    if not args.no_save:
+        print(f"结果已保存: {save_result(result)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+import functools
+import os
+from array import array
+import threading
+import time
+from collections import namedtuple
+
+import corpus_store
+from metrics import log
+from storage import get_storage
+
+# ------------------ 查询/文档语料缓存 ------------------
+# 语料在整个实验期间是静态的，每个 worker 启动时整体读入内存，
+# 之后页面渲染不再访问数据库。导入数据时 (loader.import_csv_to_database)
+# 会通过 Storage.bump_corpus_version() 把 app_meta 表里的 corpus_version 加一；
+# 各 worker 每隔 CORPUS_VERSION_CHECK_INTERVAL 秒（默认 60）读一次版本号，变化后重新加载。
+# 装了 pyarrow 时优先映射 corpus_store 的列式语料文件（所有 worker 共享同一份页面）；
+# 文件不存在时从数据库加载并写出文件，数据库加载的语料压成少数几个大对象（_PackedEntries）。
+# 两种情况下都只在进程内保留最近用过的 CORPUS_ENTRY_CACHE 个查询的 CorpusEntry。
+# gunicorn preload_app 时语料在 master 中加载一次（见 gunicorn.conf.py），fork 出的 worker 共享。
+
+CORPUS_VERSION_CHECK_INTERVAL = float(os.environ.get("CORPUS_VERSION_CHECK_INTERVAL", "60"))
+CORPUS_ENTRY_CACHE = int(os.environ.get("CORPUS_ENTRY_CACHE", "64"))
+
+CorpusEntry = namedtuple("CorpusEntry", ["query_id", "query_content", "docs"])
+CorpusSnapshot = namedtuple("CorpusSnapshot", ["version", "query_ids", "entries"])
+
+
+def _normalize_doc(row):
+    # 模板依赖 docno 为字符串、content 非空，这里一次性处理好
+    return {
+        "id": row["id"],
+        "docno": str(row["docno"]) if row["docno"] is not None else str(row["id"]),
+        "content": row["content"] if row["content"] is not None else "文档内容不可用",
+    }
+
+
+class _LazyEntries:
+    """按需组装的 entries：get(qid) 时才构造 CorpusEntry，最近用过的留在 LRU 里。"""
+
+    def __init__(self, queries):
+        self._queries = queries
+        self.get = functools.lru_cache(maxsize=CORPUS_ENTRY_CACHE)(self._get)
+
+    def _get(self, qid):
+        if qid not in self._queries:
+            return None
+        content = self._queries[qid] or f"Query {qid} (No data available)"
+        return CorpusEntry(qid, content, tuple(self._documents(qid)))
+
+    def _documents(self, qid):
+        raise NotImplementedError
+
+
+class _FileEntries(_LazyEntries):
+    """映射的语料文件，文档在 get 时才从映射中取出。"""
+
+    def __init__(self, corpus_file):
+        super().__init__(dict(corpus_file.queries))
+        self._file = corpus_file
+
+    def _documents(self, qid):
+        return [_normalize_doc(row) for row in self._file.documents(qid)]
+
+
+class _PackedEntries(_LazyEntries):
+    """
+    数据库加载的语料：所有 docno / 正文按 UTF-8 拼成一个 bytes，偏移和文档 ID 放在 array 里。
+    几千个小 str/dict 变成几个大对象，fork 之后引用计数和 GC 只会写到很少的几页，
+    其余页面一直与 master 共享。
+    """
+
+    def __init__(self, queries, documents):
+        super().__init__({row["id"]: row["content"] for row in queries})
+        blob = bytearray()
+        offsets = array("q", [0])
+        ids = array("q")
+        ranges = {}
+        for i, row in enumerate(documents):
+            doc = _normalize_doc(row)
+            for field in (doc["docno"], doc["content"]):
+                blob += field.encode("utf-8")
+                offsets.append(len(blob))
+            ids.append(doc["id"])
+            start, _ = ranges.get(row["qid"], (i, i))
+            ranges[row["qid"]] = (start, i + 1)
+        self._blob = bytes(blob)
+        self._offsets = offsets
+        self._ids = ids
+        self._ranges = ranges
+        self.num_documents = len(ids)
+
+    def _field(self, k):
+        return self._blob[self._offsets[k]:self._offsets[k + 1]].decode("utf-8")
+
+    def _documents(self, qid):
+        start, stop = self._ranges.get(qid, (0, 0))
+        return [{"id": self._ids[i], "docno": self._field(2 * i), "content": self._field(2 * i + 1)}
+                for i in range(start, stop)]
+
+
+class CorpusCache:
+    def __init__(self, check_interval=CORPUS_VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.last_load_seconds = 0.0
+
+    def _load(self):
+        started = time.perf_counter()
+        storage = get_storage()
+        if corpus_store.pa is None and corpus_store.CORPUS_FILE_DIR:
+            log.warning("pyarrow is not installed; loading the corpus from the database instead of a mapped file")
+        dataset_hash = storage.get_meta("dataset_hash") if corpus_store.available() else None
+        if dataset_hash:
+            version = storage.corpus_version()
+            try:
+                corpus_file = corpus_store.open_corpus_file(corpus_store.corpus_key(dataset_hash, version))
+            except Exception as e:
+                log.warning("Ignoring corpus file: %s", e)
+                corpus_file = None
+            if corpus_file is not None:
+                entries = _FileEntries(corpus_file)
+                self.loads += 1
+                self.last_load_seconds = time.perf_counter() - started
+                log.info("Corpus cache mapped %s: %d queries, %d documents", corpus_file.path,
+                         len(corpus_file.queries), corpus_file.num_documents)
+                return CorpusSnapshot(version, tuple(qid for qid, _ in corpus_file.queries), entries)
+
+        version, queries, documents = storage.load_corpus()
+        if dataset_hash:
+            # 下一个启动的 worker 直接映射这个文件
+            try:
+                corpus_store.write_corpus_file(corpus_store.corpus_key(dataset_hash, version), queries, documents)
+            except Exception as e:
+                log.warning("Failed to write corpus file: %s", e)
+
+        entries = _PackedEntries(queries, documents)
+        self.loads += 1
+        self.last_load_seconds = time.perf_counter() - started
+        log.info("Corpus cache loaded version %s: %d queries, %d documents", version, len(queries),
+                 entries.num_documents)
+        return CorpusSnapshot(version, tuple(row["id"] for row in queries), entries)
+
+    def _current_version(self):
+        return get_storage().corpus_version()
+
+    def _ensure_fresh(self):
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - self._checked_at < self.check_interval:
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and now - self._checked_at < self.check_interval:
+                return snapshot
+            try:
+                if snapshot is None or self._current_version() != snapshot.version:
+                    snapshot = self._load()
+                    self._snapshot = snapshot
+            except Exception as e:
+                log.error("Failed to refresh corpus cache: %s", e)
+                if snapshot is None:
+                    return CorpusSnapshot(-1, (), {})
+            self._checked_at = now
+            return snapshot
+
+    def warm(self, reload=True):
+        """
+        预加载整个语料。reload=False 时沿用已有的快照（preload_app 下 worker 直接使用
+        从 master 继承的语料，之后照常按 check_interval 检查版本号）。
+        """
+        if reload:
+            self.invalidate()
+        return self._ensure_fresh()
+
+    def invalidate(self):
+        """丢弃本进程的缓存，下次访问时重新加载。"""
+        with self._lock:
+            self._snapshot = None
+            self._checked_at = 0.0
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            "loads": self.loads,
+            "last_load_seconds": self.last_load_seconds,
+            "version": snapshot.version if snapshot is not None else -1,
+            "queries": len(snapshot.query_ids) if snapshot is not None else 0,
+        }
+
+    def version(self):
+        """当前缓存的语料版本号（render_cache 用作缓存键的一部分）"""
+        return self._ensure_fresh().version
+
+    def query_ids(self):
+        """按 ID 排序的所有查询 ID（替代原来的 AVAILABLE_QUERY_IDS）"""
+        return self._ensure_fresh().query_ids
+
+    def get(self, query_id):
+        """返回 CorpusEntry(query_id, query_content, docs)，不存在时返回 None。docs 按 id 排序，调用方不要修改。"""
+        return self._ensure_fresh().entries.get(query_id)
+
+
+corpus_cache = CorpusCache()
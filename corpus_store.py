@@ -0,0 +1,140 @@
+import glob
+import json
+import os
+from array import array
+
+try:
+    import pyarrow as pa
+    from pyarrow import ipc
+except ImportError:  # 部署依赖 pyarrow（requirements.txt）；本地未安装时语料缓存直接从数据库加载
+    pa = None
+    ipc = None
+
+# ------------------ 列式语料文件（Arrow IPC） ------------------
+# 语料导入数据库后编译成一个不压缩的 Arrow IPC（Feather v2）文件：
+#     CORPUS_FILE_DIR/corpus-<dataset_hash 前 16 位>-v<corpus_version>.arrow
+# 文件名里的键由数据集内容哈希（loader 写入 app_meta 的 dataset_hash）和 corpus_version 组成，
+# 打开时还会核对 schema 元数据里的同一个键，数据集或语料变化后旧文件自然不再匹配。
+# worker 用 memory_map 打开：文档正文留在映射的页面里，由操作系统在各 worker 之间共享，
+# 重启或切换实验时只需要读元数据和 qid 列，不再解析 CSV 或从数据库读取全部正文。
+#   CORPUS_FILE_DIR  文件目录（默认 corpus_files），设为空字符串则不使用
+# pyarrow 在 requirements.txt 中，生产环境总会编译并映射语料文件；没有安装 pyarrow 的本地环境
+# 退回每个 worker 从数据库加载（启动时会记录一条 warning）。
+
+CORPUS_FILE_DIR = os.environ.get("CORPUS_FILE_DIR", "corpus_files")
+
+
+def available():
+    return pa is not None and bool(CORPUS_FILE_DIR)
+
+
+def corpus_key(dataset_hash, version):
+    """文件键；没有 dataset_hash（语料不是经 loader 导入的）时返回 None。"""
+    return f"{dataset_hash[:16]}-v{version}" if dataset_hash else None
+
+
+def corpus_path(key, directory=CORPUS_FILE_DIR):
+    return os.path.join(directory, f"corpus-{key}.arrow")
+
+
+# 列直接由缓冲区构造：pa.array() 会为了识别 pandas 对象而导入 pandas，web worker 不应加载它
+def _int64_array(values):
+    return pa.Array.from_buffers(pa.int64(), len(values), [None, pa.py_buffer(array("q", values))])
+
+
+def _string_array(values):
+    offsets = array("q", [0])
+    data = bytearray()
+    validity = bytearray((len(values) + 7) // 8)
+    nulls = 0
+    for i, value in enumerate(values):
+        if value is None:
+            nulls += 1
+        else:
+            data += value.encode("utf-8")
+            validity[i >> 3] |= 1 << (i & 7)
+        offsets.append(len(data))
+    buffers = [pa.py_buffer(bytes(validity)) if nulls else None, pa.py_buffer(offsets), pa.py_buffer(bytes(data))]
+    return pa.Array.from_buffers(pa.large_string(), len(values), buffers, null_count=nulls)
+
+
+def write_corpus_file(key, queries, documents, directory=CORPUS_FILE_DIR):
+    """
+    把 load_corpus 的结果写成语料文件（先写临时文件再改名），返回路径。
+    同目录下其他键的旧文件会被删除；已经映射它们的进程不受影响。
+    """
+    os.makedirs(directory, exist_ok=True)
+    table = pa.Table.from_arrays([
+        _int64_array([row["qid"] for row in documents]),
+        _int64_array([row["id"] for row in documents]),
+        _string_array([str(row["docno"]) if row["docno"] is not None else None for row in documents]),
+        _string_array([row["content"] for row in documents]),
+    ], names=["qid", "id", "docno", "content"])
+    table = table.replace_schema_metadata({
+        b"corpus_key": key.encode(),
+        b"queries": json.dumps([[row["id"], row["content"]] for row in queries], ensure_ascii=False).encode(),
+    })
+    path = corpus_path(key, directory)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink, ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp_path, path)
+    for old in glob.glob(os.path.join(directory, "corpus-*.arrow")):
+        if old != path:
+            os.unlink(old)
+    return path
+
+
+class CorpusFile:
+    """
+    映射打开的语料文件。documents 按 (qid, id) 排序，打开时只建立 qid -> 行区间的索引，
+    某个查询的文档在 documents(qid) 时才从映射中取出。
+    """
+
+    def __init__(self, path, key):
+        table = ipc.open_file(pa.memory_map(path, "r")).read_all()
+        metadata = table.schema.metadata or {}
+        if metadata.get(b"corpus_key") != key.encode():
+            raise ValueError(f"{path} 的 corpus_key 与当前语料不一致")
+        self.path = path
+        self.key = key
+        self.queries = [(qid, content) for qid, content in json.loads(metadata[b"queries"])]
+        self.num_documents = table.num_rows
+        self._table = table
+        self._ranges = {}
+        start = 0
+        qids = table.column("qid").to_pylist()
+        for i in range(1, len(qids) + 1):
+            if i == len(qids) or qids[i] != qids[start]:
+                self._ranges[qids[start]] = (start, i)
+                start = i
+
+    def documents(self, qid):
+        """该查询的文档行（dict: id, qid, docno, content），按 id 排序。"""
+        start, stop = self._ranges.get(qid, (0, 0))
+        part = self._table.slice(start, stop - start)
+        return [{"id": doc_id, "qid": qid, "docno": docno, "content": content}
+                for doc_id, docno, content in zip(part.column("id").to_pylist(), part.column("docno").to_pylist(),
+                                                  part.column("content").to_pylist())]
+
+
+def open_corpus_file(key, directory=CORPUS_FILE_DIR):
+    """打开与 key 对应的语料文件；文件不存在时返回 None，内容与 key 不符时抛出 ValueError。"""
+    path = corpus_path(key, directory)
+    if not os.path.exists(path):
+        return None
+    return CorpusFile(path, key)
+
+
+def compile_corpus(storage, directory=CORPUS_FILE_DIR):
+    """从数据库读取当前语料并写成文件（已存在则跳过），返回路径；无法编译时返回 None。"""
+    if not available():
+        return None
+    dataset_hash = storage.get_meta("dataset_hash")
+    key = corpus_key(dataset_hash, storage.corpus_version())
+    if key is None:
+        return None
+    if os.path.exists(corpus_path(key, directory)):
+        return corpus_path(key, directory)
+    version, queries, documents = storage.load_corpus()
+    return write_corpus_file(corpus_key(dataset_hash, version), queries, documents, directory)
@@ -0,0 +1,309 @@
+import argparse
+import csv
+import itertools
+import json
+import sys
+import time
+import warnings
+from collections import namedtuple
+
+import numpy as np
+
+from agreement import SELECTION_EVENT, UNSELECT_EVENT, final_spans
+from storage import get_storage
+from studies import get_study
+
+# ------------------ 偏好评估 ------------------
+# 把参与者最终选中的文档（agreement.final_spans：最后一次 PASSAGE_SELECTION 有效，UNSELECT 清除）
+# 与数据集 CSV 中每篇文档的系统标签（origin_label，或 strategic 数据集的 source）和系统排名连接，
+# 再用 orders 里 Latin square 决定的展示位置做位置偏差校正：
+#   label_rates     每个标签的选中率（选中篇数 / 展示篇数）
+#   display_curve   按展示位置的选中率；system_curve 按系统原始排名的选中率
+#   ipw_rates       位置校正后的选中率：由展示位置曲线估计检查概率 θ_p = rate_p / rate_0
+#                   （Latin square 使文档与位置相互独立），每次选中按 1/θ_p 加权
+#   win_rates       同一查询中两个系统的对比：(用户, 查询) 上谁的文档被选中得多，平局记半场
+# 所有指标都写成 Σ num / Σ den 的形式，数据整理成 (用户, 查询, …) 的稠密数组。
+# 置信区间对用户和查询同时做有放回重抽样：每个重抽样是一组多项分布权重，
+# 一批 B 个重抽样用一次 einsum("bu,uq…,bq->b…") 算完，没有逐个重抽样的 Python 循环。
+#     python evaluation.py [--study NAME] [--n-boot 10000] [--json evaluation.json]
+
+LABEL_COLUMNS = ("origin_label", "source")
+RANK_COLUMNS = ("rank", "debiased_rank", "biased_rank")
+SHARED_LABELS = ("Both",)
+IGNORED_LABELS = ("Easy-Negative", "easy negative")
+MIN_PROPENSITY = 0.05
+
+StudyTensors = namedtuple("StudyTensors", [
+    "users", "qids", "labels",
+    "shown", "selected", "position",   # (U, Q, D)：是否展示、是否最终选中、展示位置（0 起始，-1 未知）
+    "label_index", "system_rank",      # (Q, D)：标签下标、系统原始排名（-1 未知）
+])
+
+
+# ------------------ 1) 数据整理 ------------------
+def read_labels(csv_path, label_column=None, rank_column=None):
+    """数据集 CSV -> ({(qid, docno): (label, rank)}, 标签列名, 排名列名)。"""
+    csv.field_size_limit(1 << 24)
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        columns = reader.fieldnames or []
+        label_column = label_column or next((c for c in LABEL_COLUMNS if c in columns), None)
+        if label_column is None:
+            raise ValueError(f"{csv_path} 中没有标签列（{', '.join(LABEL_COLUMNS)}）")
+        rank_column = rank_column or next((c for c in RANK_COLUMNS if c in columns), None)
+        labels = {}
+        for row in reader:
+            rank = row.get(rank_column) if rank_column else None
+            labels[(int(row["qid"]), str(row["docno"]))] = (row[label_column] or None,
+                                                           int(float(rank)) if rank else None)
+    return labels, label_column, rank_column
+
+
+def build_tensors(labels, storage=None):
+    """从存储读取语料、orders 和选择事件，整理成 StudyTensors。"""
+    storage = storage or get_storage()
+    _, _, documents = storage.load_corpus()
+    docs_by_qid = {}
+    for row in documents:
+        docs_by_qid.setdefault(row["qid"], []).append((row["id"], str(row["docno"])))
+
+    exposures = sorted({(u, q) for u, q in storage.query_participants() if q in docs_by_qid})
+    users = sorted({u for u, _ in exposures})
+    qids = sorted({q for _, q in exposures})
+    user_index = {u: i for i, u in enumerate(users)}
+    qid_index = {q: i for i, q in enumerate(qids)}
+    n_docs = max((len(docs_by_qid[q]) for q in qids), default=0)
+    label_names = sorted({label for label, _ in labels.values() if label})
+    label_ids = {label: i for i, label in enumerate(label_names)}
+
+    label_index = np.full((len(qids), n_docs), -1, dtype=np.int64)
+    system_rank = np.full((len(qids), n_docs), -1, dtype=np.int64)
+    slot_by_id = {}
+    slot_by_docno = {}
+    for qi, qid in enumerate(qids):
+        for d, (doc_id, docno) in enumerate(docs_by_qid[qid]):
+            slot_by_id[doc_id] = (qi, d)
+            slot_by_docno[(qid, docno)] = (qi, d)
+            label, rank = labels.get((qid, docno), (None, None))
+            label_index[qi, d] = label_ids.get(label, -1)
+            system_rank[qi, d] = rank if rank is not None else -1
+
+    shape = (len(users), len(qids), n_docs)
+    shown = np.zeros(shape, dtype=bool)
+    selected = np.zeros(shape, dtype=bool)
+    position = np.full(shape, -1, dtype=np.int64)
+    for user, qid in exposures:
+        shown[user_index[user], qid_index[qid], :len(docs_by_qid[qid])] = True
+    for user, qid, doc_order in storage.load_orders():
+        if user not in user_index or qid not in qid_index or not doc_order:
+            continue
+        ui, qi = user_index[user], qid_index[qid]
+        for p, doc_id in enumerate(int(d) for d in doc_order.split(",") if d):
+            slot = slot_by_id.get(doc_id)
+            if slot is not None and slot[0] == qi:
+                position[ui, qi, slot[1]] = p
+
+    events = storage.selection_events((SELECTION_EVENT, UNSELECT_EVENT))
+    for (qid, docno), spans in final_spans(events).items():
+        slot = slot_by_docno.get((qid, docno))
+        if slot is None:
+            continue
+        for user in spans:
+            if user in user_index:
+                selected[user_index[user], slot[0], slot[1]] = True
+    selected &= shown
+    return StudyTensors(users, qids, label_names, shown, selected, position, label_index, system_rank)
+
+
+# ------------------ 2) 指标：stat(wu, wq) -> (B, …) ------------------
+# wu: (B, U) 用户权重，wq: (B, Q) 查询权重；全为 1 时就是点估计。
+def _wsum(wu, x, wq):
+    """Σ_u Σ_q wu[b,u] · x[u,q,…] · wq[b,q]，一次算出 B 个重抽样。"""
+    flat = x.reshape(x.shape[0], x.shape[1], -1).astype(np.float64)
+    out = np.einsum("bu,uqs,bq->bs", wu, flat, wq, optimize=True)
+    return out.reshape((wu.shape[0],) + x.shape[2:])
+
+
+def _ratio_stat(num, den):
+    def stat(wu, wq):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return _wsum(wu, num, wq) / _wsum(wu, den, wq)
+    return stat
+
+
+def _one_hot(index, n):
+    return index[..., None] == np.arange(n)
+
+
+def _count(subscripts, *operands):
+    """布尔数组的 einsum 按计数求和（直接对 bool 做 einsum 得到的是逻辑或）。"""
+    return np.einsum(subscripts, *operands, dtype=np.int64)
+
+
+def label_rates(t):
+    onehot = _one_hot(t.label_index, len(t.labels))
+    num = _count("uqd,qdl->uql", t.selected, onehot)
+    den = _count("uqd,qdl->uql", t.shown, onehot)
+    return _ratio_stat(num, den)
+
+
+def rank_curve(t, positions, n_positions):
+    """positions: (U, Q, D) 或可广播到它的位置数组；返回按位置的选中率。"""
+    onehot = _one_hot(np.broadcast_to(positions, t.shown.shape), n_positions)
+    num = _count("uqd,uqdp->uqp", t.selected, onehot)
+    den = _count("uqd,uqdp->uqp", t.shown, onehot)
+    return _ratio_stat(num, den)
+
+
+def observed_ranks(system_rank):
+    """
+    系统排名 -> (下标数组, 出现过的排名值)。排名从 1 起且可能稀疏（biased_rank 最大到 98），
+    按出现过的值重新编号，one-hot 的宽度只等于不同排名的个数；未知排名（-1）的下标仍为 -1。
+    """
+    known = system_rank >= 0
+    values, inverse = np.unique(system_rank[known], return_inverse=True)
+    index = np.full(system_rank.shape, -1, dtype=np.int64)
+    index[known] = inverse
+    return index, values
+
+
+def ipw_rates(t, n_positions, min_propensity=MIN_PROPENSITY):
+    """
+    位置校正后的各标签选中率。检查概率 θ_p 在每个重抽样里由同一组权重重新估计，
+    区间因此也包含了 θ 的估计误差。
+    """
+    pos = _one_hot(t.position, n_positions)
+    lab = _one_hot(t.label_index, len(t.labels))
+    shown_at = _count("uqd,uqdp->uqp", t.shown, pos)
+    selected_at = _count("uqd,uqdp->uqp", t.selected, pos)
+    selected_at_label = _count("uqd,uqdp,qdl->uqpl", t.selected, pos, lab)
+    shown_label = _count("uqd,qdl->uql", t.shown, lab)
+
+    def stat(wu, wq):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rate = _wsum(wu, selected_at, wq) / _wsum(wu, shown_at, wq)
+            # 首位没有任何选中时无法归一化，该重抽样记为 nan
+            theta = np.clip(np.where(rate[:, :1] > 0, rate / rate[:, :1], np.nan), min_propensity, None)
+            selections = _wsum(wu, selected_at_label, wq)
+            weighted = np.where(selections > 0, selections / theta[:, :, None], 0.0).sum(axis=1)
+            return weighted / _wsum(wu, shown_label, wq)
+    return stat
+
+
+def system_pairs(t, shared=SHARED_LABELS, ignored=IGNORED_LABELS):
+    """在同一查询中同时出现过的系统标签对（共享/忽略的标签除外）。"""
+    systems = [i for i, label in enumerate(t.labels) if label not in shared and label not in ignored]
+    present = _one_hot(t.label_index, len(t.labels)).any(axis=1)  # (Q, L)
+    return [(a, b) for a, b in itertools.combinations(systems, 2) if (present[:, a] & present[:, b]).any()]
+
+
+def win_rates(t, pairs):
+    """每对系统 (a, b)：a 在两者都出现的 (用户, 查询) 上胜出的比例，平局记 0.5。"""
+    lab = _one_hot(t.label_index, len(t.labels))
+    credit = _count("uqd,qdl->uql", t.selected, lab)
+    present = lab.any(axis=1)
+    exposed = t.shown.any(axis=2)
+    num = np.zeros(t.shown.shape[:2] + (len(pairs),))
+    den = np.zeros_like(num)
+    for k, (a, b) in enumerate(pairs):
+        valid = exposed & (present[:, a] & present[:, b])[None, :]
+        ca, cb = credit[:, :, a], credit[:, :, b]
+        num[:, :, k] = valid * ((ca > cb) + 0.5 * (ca == cb))
+        den[:, :, k] = valid
+    return _ratio_stat(num, den)
+
+
+# ------------------ 3) 两向 bootstrap ------------------
+def bootstrap(stat, n_users, n_queries, n_boot=10000, alpha=0.05, seed=0, batch=1000):
+    """
+    对用户和查询同时有放回重抽样，返回 (点估计, 下界, 上界)。
+    每个重抽样是两组多项分布权重，每批 batch 个一起交给 stat。
+    """
+    point = stat(np.ones((1, n_users)), np.ones((1, n_queries)))[0]
+    rng = np.random.default_rng(seed)
+    replicates = []
+    for start in range(0, n_boot, batch):
+        size = min(batch, n_boot - start)
+        wu = rng.multinomial(n_users, np.full(n_users, 1.0 / n_users), size=size).astype(np.float64)
+        wq = rng.multinomial(n_queries, np.full(n_queries, 1.0 / n_queries), size=size).astype(np.float64)
+        replicates.append(stat(wu, wq))
+    replicates = np.concatenate(replicates)
+    # 某些重抽样里分母为 0（例如抽不到某个位置）时为 nan，分位数忽略它们；全为 nan 的指标区间也是 nan
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        lower, upper = np.nanpercentile(replicates, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    return point, lower, upper
+
+
+def evaluate(t, n_boot=10000, alpha=0.05, seed=0):
+    """全部指标及置信区间，返回可 JSON 序列化的 dict。"""
+    n_users, n_queries = len(t.users), len(t.qids)
+    n_positions = t.shown.shape[2]
+    rank_index, rank_values = observed_ranks(t.system_rank)
+    pairs = system_pairs(t)
+
+    def run(stat, names):
+        point, lower, upper = bootstrap(stat, n_users, n_queries, n_boot, alpha, seed)
+        return [{"name": name, "estimate": _num(p), "lower": _num(lo), "upper": _num(hi)}
+                for name, p, lo, hi in zip(names, point, lower, upper)]
+
+    results = {"users": n_users, "queries": n_queries, "n_boot": n_boot, "alpha": alpha}
+    results["label_rates"] = run(label_rates(t), t.labels)
+    results["ipw_rates"] = run(ipw_rates(t, n_positions), t.labels)
+    results["display_curve"] = run(rank_curve(t, t.position, n_positions), [p + 1 for p in range(n_positions)])
+    if rank_values.size:
+        results["system_curve"] = run(rank_curve(t, rank_index[None], len(rank_values)),
+                                      [int(rank) for rank in rank_values])
+    if pairs:
+        results["win_rates"] = run(win_rates(t, pairs), [f"{t.labels[a]} vs {t.labels[b]}" for a, b in pairs])
+    return results
+
+
+def _num(value):
+    return None if value != value else round(float(value), 4)  # nan
+
+
+def _print_table(title, rows):
+    print(f"\n{title}")
+    for row in rows:
+        if row["estimate"] is None:
+            print(f"  {str(row['name']):<28}      -")
+            continue
+        interval = f"[{row['lower']:.3f}, {row['upper']:.3f}]" if row["lower"] is not None else ""
+        print(f"  {str(row['name']):<28} {row['estimate']:.3f}  {interval}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="按系统标签评估参与者的选择，带用户×查询 bootstrap 置信区间")
+    parser.add_argument("--study", help="studies.json 中的实验名（决定读取哪个数据集 CSV 的标签）")
+    parser.add_argument("--csv", help="直接指定数据集 CSV（覆盖 --study）")
+    parser.add_argument("--label-column", help="标签列（默认 origin_label，其次 source）")
+    parser.add_argument("--rank-column", help="系统排名列（默认 rank，其次 debiased_rank）")
+    parser.add_argument("--n-boot", type=int, default=10000)
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    args = parser.parse_args(argv)
+
+    csv_path = args.csv or get_study(args.study).csv
+    labels, label_column, rank_column = read_labels(csv_path, args.label_column, args.rank_column)
+    t = build_tensors(labels)
+    started = time.perf_counter()
+    results = evaluate(t, args.n_boot, args.alpha, args.seed)
+    print(f"{len(t.users)} 位参与者, {len(t.qids)} 个查询, 标签列 {label_column}, 排名列 {rank_column}, "
+          f"{args.n_boot} 次 bootstrap 用时 {time.perf_counter() - started:.2f} 秒")
+    _print_table("各标签选中率", results["label_rates"])
+    _print_table("位置校正后的选中率 (IPW)", results["ipw_rates"])
+    _print_table("按展示位置的选中率", results["display_curve"])
+    if "system_curve" in results:
+        _print_table(f"按系统排名（{rank_column}）的选中率", results["system_curve"])
+    if "win_rates" in results:
+        _print_table("系统胜率（平局记 0.5）", results["win_rates"])
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
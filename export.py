@@ -0,0 +1,259 @@
+import argparse
+import csv
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+from storage import EXPORT_COLUMNS, get_storage
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # 部署依赖 pyarrow（requirements.txt）；本地未安装时导出 gzip 压缩的 CSV
+    pa = None
+    pq = None
+
+# ------------------ 日志流式导出 ------------------
+# 把 logs 与 orders、documents 连接后按块写成列式文件，供离线分析使用：
+#     python export.py [--out exports] [--chunk-rows 50000] [--with-content] [--full]
+# 服务器端游标逐块读取、逐块写出（Parquet 每块一个 row group），内存占用与日志总量无关。
+# 增量导出：manifest.json 记录已导出的最大 logs.id（watermark），
+# 再次运行只读取 id 更大的新行，写成一个新的分片文件。
+# MySQL 的自增 id 在插入时分配、提交顺序却不固定：持有 100–199 的事务可能晚于持有 200–299 的
+# 事务提交。所以每次先读出当前最大 id 作为本次的上界，等 EXPORT_SETTLE_SECONDS（默认 5，
+# 远长于一次 insert_logs 事务）让已经分配到更小 id 的事务提交，再导出 (watermark, 上界]。
+# 等待不能保证所有事务都已提交（participant_progress 上的锁等待、分区 REORGANIZE 都可能更久），
+# 所以导出范围里缺失的 id 记为 manifest 的 gaps，之后每次运行重新读取这些 id，
+# 补上晚提交的行；缺失超过 EXPORT_GAP_SECONDS（默认 3600）的 id 视为回滚或被忽略的插入，不再检查。
+# watermark 同时写入 app_meta 的 log_export_watermark，partitions.py 只归档已导出的分区，
+# 所以 partitions.py restore 恢复的旧 id 行早已在分片里，不会因为小于 watermark 而漏掉。
+#   --full  忽略 watermark，删除旧分片后从头导出（包括恢复回来的行）
+# 每个分片的列：EXPORT_COLUMNS 去掉 doc_order，加上 display_rank（文档在该用户页面上的位置，1 起始）。
+
+DEFAULT_OUT_DIR = "exports"
+DEFAULT_CHUNK_ROWS = 50000
+MANIFEST_NAME = "manifest.json"
+EXPORT_SETTLE_SECONDS = float(os.environ.get("EXPORT_SETTLE_SECONDS", "5"))
+EXPORT_GAP_SECONDS = float(os.environ.get("EXPORT_GAP_SECONDS", "3600"))
+WATERMARK_META_KEY = "log_export_watermark"
+
+OUTPUT_COLUMNS = tuple(c for c in EXPORT_COLUMNS if c != "doc_order") + ("display_rank",)
+_DOC_ID = EXPORT_COLUMNS.index("doc_id")
+_DOC_ORDER = EXPORT_COLUMNS.index("doc_order")
+_TIMESTAMP = EXPORT_COLUMNS.index("timestamp")
+_DOCNO = EXPORT_COLUMNS.index("docno")
+
+
+def _display_rank(doc_id, doc_order, cache):
+    # 同一 (用户, 查询) 的事件共用一个 doc_order 字符串，解析结果按字符串缓存
+    if doc_id is None or not doc_order:
+        return None
+    ranks = cache.get(doc_order)
+    if ranks is None:
+        ranks = cache[doc_order] = {int(d): i + 1 for i, d in enumerate(doc_order.split(",")) if d}
+    return ranks.get(doc_id)
+
+
+def _to_columns(rows, rank_cache):
+    """一块行元组 -> {列名: 列表}，计算 display_rank 并统一时间戳类型。"""
+    columns = {name: [] for name in OUTPUT_COLUMNS}
+    names = [name for name in EXPORT_COLUMNS if name != "doc_order"]
+    for row in rows:
+        row = list(row)
+        if isinstance(row[_TIMESTAMP], str):  # SQLite 后端存的是 ISO 字符串
+            row[_TIMESTAMP] = datetime.fromisoformat(row[_TIMESTAMP])
+        if row[_DOCNO] is not None:
+            row[_DOCNO] = str(row[_DOCNO])
+        rank = _display_rank(row[_DOC_ID], row[_DOC_ORDER], rank_cache)
+        del row[_DOC_ORDER]
+        for name, value in zip(names, row):
+            columns[name].append(value)
+        columns["display_rank"].append(rank)
+    return columns
+
+
+def _parquet_schema():
+    # 显式给出类型：某一块里整列为 NULL 时也不会推断出不兼容的类型
+    string_columns = {"user_id", "docno", "event_type", "event_key", "doc_content"}
+    fields = []
+    for name in OUTPUT_COLUMNS:
+        if name in string_columns:
+            fields.append((name, pa.string()))
+        elif name == "timestamp":
+            fields.append((name, pa.timestamp("us")))
+        else:
+            fields.append((name, pa.int64()))
+    return pa.schema(fields)
+
+
+class _ParquetPart:
+    def __init__(self, path):
+        self.path = path
+        self.schema = _parquet_schema()
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, columns):
+        self.writer.write_table(pa.table(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class _CsvPart:
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, "wt", encoding="utf-8", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(OUTPUT_COLUMNS)
+
+    def write(self, columns):
+        self.writer.writerows(zip(*(columns[name] for name in OUTPUT_COLUMNS)))
+
+    def close(self):
+        self.file.close()
+
+
+def load_manifest(out_dir):
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"watermark": 0, "parts": [], "gaps": []}
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    manifest.setdefault("gaps", [])
+    return manifest
+
+
+def save_manifest(out_dir, manifest):
+    # 先写临时文件再改名，中途失败不会留下损坏的 manifest
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def _collect_gaps(gaps, expected, ids, seen_at):
+    """把从 expected 起、升序 ids 之间缺失的区间追加到 gaps，返回下一个期望的 id。"""
+    for i in ids:
+        if i > expected:
+            gaps.append((expected, i - 1, seen_at))
+        expected = i + 1
+    return expected
+
+
+def export_logs(out_dir=DEFAULT_OUT_DIR, chunk_rows=DEFAULT_CHUNK_ROWS, with_content=False, full=False,
+                settle_seconds=EXPORT_SETTLE_SECONDS, gap_seconds=EXPORT_GAP_SECONDS):
+    """
+    导出 watermark 之后、本次上界之前的新日志，以及之前缺失、现在已经提交的 id，返回本次导出的行数。
+    只有分片完整写完后才推进 watermark 和更新 gaps，中途失败时下次会重新导出这部分。
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = load_manifest(out_dir)
+    if full:
+        for part in manifest["parts"]:
+            try:
+                os.unlink(os.path.join(out_dir, part["file"]))
+            except FileNotFoundError:
+                pass
+        manifest = {"watermark": 0, "parts": [], "gaps": []}
+
+    watermark = manifest["watermark"]
+    now = time.time()
+    gaps = []
+    for first, last, seen_at in manifest["gaps"]:
+        if now - seen_at < gap_seconds:
+            gaps.append((first, last, seen_at))
+        else:
+            print(f"id {first}-{last} 缺失超过 {gap_seconds:.0f} 秒，不再检查")
+    storage = get_storage()
+    # 上界之后分配的 id 留给下一次；上界之前还没提交的事务在等待期间提交
+    until_id = max(storage.max_log_id(), watermark)
+    if until_id == watermark and not gaps:
+        if manifest["gaps"]:
+            manifest["gaps"] = []
+            save_manifest(out_dir, manifest)
+        print(f"没有新的日志 (watermark={watermark})")
+        return 0
+    time.sleep(settle_seconds)
+    suffix = ".parquet" if pa is not None else ".csv.gz"
+    if pa is None:
+        print("未安装 pyarrow，导出为 gzip 压缩的 CSV")
+    tmp_path = os.path.join(out_dir, f"logs-after-{watermark}{suffix}.tmp")
+    part = _ParquetPart(tmp_path) if pa is not None else _CsvPart(tmp_path)
+
+    # 先重新读取之前缺失的 id，再读取 (watermark, 上界]；每个范围记下仍然缺失的 id
+    ranges = [(first, last, seen_at) for first, last, seen_at in gaps]
+    if until_id > watermark:
+        ranges.append((watermark + 1, until_id, now))
+    started = time.time()
+    rows_written = 0
+    first_id = last_id = None
+    new_gaps = []
+    rank_cache = {}
+    try:
+        for first, last, seen_at in ranges:
+            # 边读边记下缺失的区间，只保留 gaps，内存不随导出的行数增长
+            expected = first
+            for rows in storage.iter_log_export(first - 1, last, chunk_rows, with_content):
+                part.write(_to_columns(rows, rank_cache))
+                if expected == first:
+                    first_id = rows[0][0] if first_id is None else min(first_id, rows[0][0])
+                expected = _collect_gaps(new_gaps, expected, (row[0] for row in rows), seen_at)
+                rows_written += len(rows)
+                print(f"已导出 {rows_written} 行 (id <= {rows[-1][0]})")
+                if len(rank_cache) > 100000:
+                    rank_cache.clear()
+            if expected > first:
+                last_id = expected - 1 if last_id is None else max(last_id, expected - 1)
+            if expected <= last:
+                new_gaps.append((expected, last, seen_at))
+    except BaseException:
+        part.close()
+        os.unlink(tmp_path)
+        raise
+    part.close()
+    manifest["gaps"] = [list(gap) for gap in new_gaps]
+
+    if rows_written == 0:
+        # 上界之前的 id 都不存在（例如插入时被 IGNORE 或回滚），直接推进 watermark
+        os.unlink(tmp_path)
+        manifest["watermark"] = until_id
+        save_manifest(out_dir, manifest)
+        storage.set_meta(WATERMARK_META_KEY, str(until_id))
+        print(f"没有新的日志 (watermark={until_id})")
+        return 0
+
+    name = f"logs-{first_id:010d}-{last_id:010d}{suffix}"
+    os.replace(tmp_path, os.path.join(out_dir, name))
+    manifest["parts"].append({
+        "file": name,
+        "first_id": first_id,
+        "last_id": last_id,
+        "rows": rows_written,
+        "with_content": with_content,
+        "exported_at": datetime.now().isoformat(timespec="seconds"),
+    })
+    manifest["watermark"] = until_id
+    save_manifest(out_dir, manifest)
+    storage.set_meta(WATERMARK_META_KEY, str(until_id))
+    print(f"导出 {rows_written} 行到 {name}，用时 {time.time() - started:.1f} 秒")
+    return rows_written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="把交互日志增量导出为 Parquet（或 CSV）分片")
+    parser.add_argument("--out", default=DEFAULT_OUT_DIR, help="输出目录")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS, help="每块读取/写出的行数")
+    parser.add_argument("--with-content", action="store_true", help="同时导出文档全文")
+    parser.add_argument("--full", action="store_true", help="忽略 watermark，从头重新导出")
+    parser.add_argument("--settle-seconds", type=float, default=EXPORT_SETTLE_SECONDS,
+                        help="读出上界后等待未提交事务的秒数")
+    args = parser.parse_args(argv)
+    export_logs(args.out, args.chunk_rows, args.with_content, args.full, args.settle_seconds)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
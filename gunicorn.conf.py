@@ -0,0 +1,73 @@
+# gunicorn 配置：procfile 中的 web 进程会自动读取当前目录下的 gunicorn.conf.py
+import gc
+import os
+
+# ------------------ worker 模式与并发规模 ------------------
+# 参与者的请求几乎都是很小的 /api/log 上报和页面请求，时间花在数据库往返上，
+# 所以默认使用线程 worker（gthread），一个 worker 同时处理 GUNICORN_THREADS 个请求：
+#   GUNICORN_WORKER_CLASS        gthread（默认）| gevent | sync
+#   WEB_CONCURRENCY              worker 进程数（默认 sync 为 2×CPU+1，其余为 CPU 数，至少 2）
+#   GUNICORN_THREADS             gthread 每个 worker 的线程数（默认 16）
+#   GUNICORN_WORKER_CONNECTIONS  gevent 每个 worker 的最大并发连接数（默认 1000）
+# 每个 worker 的 MySQL 连接池（db.DB_POOL_SIZE，未设置时在这里给出）按同时可能访问数据库的
+# 请求数加上日志投递线程来定：sync 为 2，gthread 为线程数 + 1，gevent 为 32（协程在池满时排队等待）。
+# 整个实例的 MySQL 连接数上限为 workers × DB_POOL_SIZE，注意不要超过服务器的 max_connections。
+# gevent 模式需要另外安装 gevent（不在 requirements.txt 中）；PyMySQL 是纯 Python 驱动，
+# 打补丁后的 socket 上会让出协程，spool 的 write/fsync 交给 hub 的线程池（见 spool._run_blocking）。
+# SQLite 后端的调用仍会阻塞 hub，gevent 只用于 MySQL。
+# 比较各模式的并发上限见 benchmark.py 开头（SQLITE_SIMULATED_LATENCY_MS 模拟数据库往返）。
+# 补丁必须在导入应用之前打（preload_app 时应用在 master 中导入），否则 master 中创建的锁仍是
+# 线程锁，一个协程持锁等待数据库时会阻塞整个 worker。
+GUNICORN_WORKER_CLASS = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+if GUNICORN_WORKER_CLASS == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+CPU_COUNT = os.cpu_count() or 1
+
+worker_class = GUNICORN_WORKER_CLASS
+if worker_class == "sync":
+    workers = int(os.environ.get("WEB_CONCURRENCY", str(2 * CPU_COUNT + 1)))
+    db_pool_size = 2
+else:
+    workers = int(os.environ.get("WEB_CONCURRENCY", str(max(2, CPU_COUNT))))
+    threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+    worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "1000"))
+    db_pool_size = threads + 1 if worker_class == "gthread" else 32
+os.environ.setdefault("DB_POOL_SIZE", str(db_pool_size))
+
+# preload_app：应用和语料在 master 中只加载一次，fork 出的 worker 共享这些页面（写时复制），
+# worker 启动不再各自导入应用、读取语料。GUNICORN_PRELOAD=0 恢复每个 worker 各自加载。
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+
+def when_ready(server):
+    """
+    preload 时在 master 中预热语料缓存，然后 gc.freeze() 把此前的对象移出垃圾回收的扫描范围，
+    fork 之后 worker 的 GC 不会去写这些对象所在的页面。
+    """
+    if not server.cfg.preload_app:
+        return
+    from corpus_cache import corpus_cache
+    corpus_cache.warm()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from metrics import mark_worker_forked
+    mark_worker_forked()
+
+
+def post_worker_init(worker):
+    """
+    worker 加载完应用后检查结构版本并预热语料缓存（preload 时沿用 master 中加载的语料），
+    使第一个请求也不需要访问数据库；同时启动日志投递线程，重放上次退出时没投递完的 spool 段。
+    """
+    from corpus_cache import corpus_cache
+    from log_writer import log_writer
+    from metrics import mark_worker_ready
+    from migrations import check_schema
+    check_schema()
+    corpus_cache.warm(reload=not worker.cfg.preload_app)
+    log_writer.start()
+    mark_worker_ready()
@@ -0,0 +1,142 @@
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+from storage import get_storage
+
+# ------------------ 流式批量导入 ------------------
+# 按块读取 result_*.csv，内存占用只和 chunk_size / batch_size 有关，与文件大小无关：
+#   IMPORT_CHUNK_SIZE   每次从 CSV 读取的行数（默认 20000）
+#   IMPORT_BATCH_SIZE   每个事务写入的行数（默认 2000）
+#   IMPORT_LOAD_DATA=1  documents 改用 LOAD DATA LOCAL INFILE 写入
+#                       （仅 MySQL 后端，需要服务器开启 local_infile）
+# 正文按内容哈希写入 texts 表（见 textstore.py），documents 只存 content_hash：
+# 多个数据集共用的正文只在第一次出现时压缩并上传。
+
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", "20000"))
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", "2000"))
+IMPORT_LOAD_DATA = os.environ.get("IMPORT_LOAD_DATA", "0") == "1"
+
+
+def select_qids(csv_path, skip_queries, chunk_size=IMPORT_CHUNK_SIZE, max_queries=None):
+    """
+    第一遍只读 qid 列，按首次出现顺序跳过前 skip_queries 个查询（再最多保留 max_queries 个），
+    返回保留的 qid 集合。
+    """
+    ordered = {}
+    for chunk in pd.read_csv(csv_path, usecols=['qid'], chunksize=chunk_size):
+        for qid in chunk['qid'].unique().tolist():
+            ordered.setdefault(qid, None)
+    stop = skip_queries + max_queries if max_queries is not None else None
+    return set(list(ordered)[skip_queries:stop])
+
+
+def _tsv_field(value):
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+class ImportProgress:
+    def __init__(self, label):
+        self.label = label
+        self.rows = 0
+        self.started = time.monotonic()
+
+    def add(self, n):
+        self.rows += n
+
+    @property
+    def rows_per_sec(self):
+        elapsed = time.monotonic() - self.started
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def report(self, final=False):
+        prefix = "完成" if final else "进度"
+        print(f"{prefix} {self.label}: {self.rows} 行, {self.rows_per_sec:,.0f} 行/秒")
+
+
+class StreamingImporter:
+    """
+    把 CSV（qid, query, docno, text 列）流式导入 queries 和 documents 表。
+
+    documents.id 沿用原来的编号方式：导入前的 MAX(id) + CSV 行号 + 1，
+    因此同一份文件重复导入得到相同的文档 ID。
+    """
+
+    def __init__(self, chunk_size=IMPORT_CHUNK_SIZE, batch_size=IMPORT_BATCH_SIZE,
+                 use_load_data=IMPORT_LOAD_DATA, storage=None):
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.storage = storage or get_storage()
+        # LOAD DATA 是 MySQL 专有的，其他后端退回批量 INSERT
+        self.use_load_data = use_load_data and hasattr(self.storage, "load_documents_file")
+
+    def _write_batches(self, insert, rows):
+        # 每批一个事务
+        for i in range(0, len(rows), self.batch_size):
+            insert(rows[i:i + self.batch_size])
+
+    def _load_data(self, rows):
+        # 每批写一个临时 TSV，再由服务器一次性解析
+        for i in range(0, len(rows), self.batch_size):
+            with tempfile.NamedTemporaryFile("w", suffix=".tsv", encoding="utf-8", delete=False) as f:
+                for row in rows[i:i + self.batch_size]:
+                    f.write("\t".join(_tsv_field(v) for v in row))
+                    f.write("\n")
+                path = f.name
+            try:
+                self.storage.load_documents_file(path)
+            finally:
+                os.unlink(path)
+
+    def import_csv(self, csv_path, skip_queries=0, max_queries=None):
+        """
+        导入一个 CSV 文件，返回 (新增查询数, 新增文档数)。
+        """
+        keep_qids = select_qids(csv_path, skip_queries, self.chunk_size, max_queries)
+        seen_qids = self.storage.existing_query_ids()
+        start_id = self.storage.max_document_id()
+
+        queries_progress = ImportProgress("queries")
+        docs_progress = ImportProgress("documents")
+        texts_progress = ImportProgress("new texts")
+        reader = pd.read_csv(csv_path, usecols=['qid', 'query', 'docno', 'text'],
+                             dtype={'docno': str}, chunksize=self.chunk_size)
+        for chunk in reader:
+            chunk = chunk[chunk['qid'].isin(keep_qids)]
+            if chunk.empty:
+                continue
+
+            # 查询：块内去重后与已存在的 qid 集合做反连接
+            queries = chunk.drop_duplicates('qid')
+            queries = queries[~queries['qid'].isin(seen_qids)]
+            query_rows = list(zip(queries['qid'].tolist(), queries['query'].tolist()))
+            if query_rows:
+                self._write_batches(self.storage.insert_queries, query_rows)
+                seen_qids.update(queries['qid'].tolist())
+                queries_progress.add(len(query_rows))
+
+            # 文档：整列计算 ID，NaN 文本转换为 NULL；正文先写入 texts，文档只引用 hash
+            doc_ids = (chunk.index.to_numpy() + start_id + 1).tolist()
+            texts = chunk['text'].astype(object).where(chunk['text'].notna(), None).tolist()
+            hashes = []
+            for i in range(0, len(texts), self.batch_size):
+                batch_hashes, new_texts = self.storage.store_texts(texts[i:i + self.batch_size])
+                hashes.extend(batch_hashes)
+                texts_progress.add(new_texts)
+            doc_rows = list(zip(doc_ids, chunk['qid'].tolist(), chunk['docno'].tolist(), hashes))
+            if self.use_load_data:
+                self._load_data(doc_rows)
+            else:
+                self._write_batches(self.storage.insert_documents, doc_rows)
+            docs_progress.add(len(doc_rows))
+            docs_progress.report()
+
+        queries_progress.report(final=True)
+        docs_progress.report(final=True)
+        texts_progress.report(final=True)
+        return queries_progress.rows, docs_progress.rows
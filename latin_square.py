@@ -0,0 +1,45 @@
+from functools import lru_cache
+
+# ------------------ 平衡拉丁方 (Williams design) ------------------
+# 直接按公式构造，O(N²)，不再枚举全排列。
+# 偶数 N：N 行，每个文档在每个位置出现一次，且每个有序相邻对 (a, b)
+#         恰好出现一次（一阶残留效应平衡）。
+# 奇数 N：单个 N×N 方阵无法做到相邻对平衡，因此再加上各行的逆序，共 2N 行。
+# 所有下标均为 0 起始。
+
+
+@lru_cache(maxsize=64)
+def balanced_latin_square(n):
+    """
+    返回 n 个元素的 Williams 平衡拉丁方（tuple of tuples）。
+    """
+    if n < 1:
+        return ()
+
+    # 首行: 0, 1, n-1, 2, n-2, 3, ...，其余各行依次对 n 循环加一
+    first = [0]
+    for j in range(1, n):
+        first.append((j + 1) // 2 if j % 2 == 1 else n - j // 2)
+
+    rows = [tuple((x + r) % n for x in first) for r in range(n)]
+    if n % 2 == 1:
+        rows += [row[::-1] for row in rows]
+    return tuple(rows)
+
+
+def num_rows(n):
+    """n 个文档时平衡拉丁方的行数（偶数 n 为 n，奇数 n 为 2n）。"""
+    if n < 1:
+        return 0
+    return n if n % 2 == 0 else 2 * n
+
+
+def permutation_for(row_index, n_docs):
+    """
+    返回第 row_index 行（对行数取模）的排列：
+    第 k 个展示位置放原始顺序中的第 perm[k] 篇文档。
+    """
+    square = balanced_latin_square(n_docs)
+    if not square:
+        return ()
+    return square[row_index % len(square)]
@@ -0,0 +1,166 @@
+import argparse
+import hashlib
+import sys
+import time
+
+import pandas as pd
+
+import corpus_store
+from importer import StreamingImporter
+from storage import get_storage
+from studies import get_study
+
+# ------------------ 建表与数据导入 ------------------
+# 每次部署只运行一次（procfile 中的 release 阶段）：
+#     python loader.py [--study preference_gold] [--csv ...] [--skip-queries 22] [--force]
+# 数据集和查询切片来自 studies.json 中的实验配置（--study，默认 STUDY 环境变量），
+# --csv / --skip-queries 可以临时覆盖。导入后把语料编译成列式文件（见 corpus_store.py）。
+# web worker 导入 app.py 时不再做任何数据库操作。
+# 先建表/执行结构迁移（Storage.ensure_schema，MySQL 见 migrations.py），再导入数据。
+# 多个进程同时运行时通过 Storage.lock 串行化（MySQL GET_LOCK / SQLite 文件锁）；
+# 数据集（CSV 内容 + 查询切片）的 sha256 与 app_meta 中保存的 dataset_hash 相同时直接跳过导入。
+
+LOADER_LOCK_NAME = "ir_study_loader"
+LOADER_LOCK_TIMEOUT = 600
+
+REQUIRED_COLUMNS = ['qid', 'query', 'docno', 'text']
+
+
+# ------------------ 1) 导入查询与文档 ------------------
+def import_csv_to_database(csv_path, skip_queries=0, max_queries=None):
+    """
+    从CSV文件流式导入数据到数据库的queries和documents表。
+    CSV应包含qid, query, docno, text列。
+    表结构由 Storage.ensure_schema() 保证。
+    """
+    # 同一遍扫描中先插入查询，再插入文档
+    started = time.time()
+    query_rows, doc_rows = StreamingImporter().import_csv(csv_path, skip_queries, max_queries)
+    elapsed = time.time() - started
+
+    # 导入统计，web worker 的 /metrics 会读取这些 import_* 键
+    set_meta("import_query_rows", query_rows)
+    set_meta("import_document_rows", doc_rows)
+    set_meta("import_seconds", round(elapsed, 3))
+    set_meta("import_rows_per_second", round(doc_rows / elapsed, 1) if elapsed > 0 else 0)
+    set_meta("import_finished_at", int(time.time()))
+
+    # 上一轮数据集独有、现在没有文档引用的正文
+    pruned = get_storage().prune_texts()
+    if pruned:
+        print(f"删除了 {pruned} 条不再被引用的正文")
+
+    # 语料已变化，使各 worker 的语料缓存失效
+    get_storage().bump_corpus_version()
+
+def clear_tables_before_import():
+    """简单清空所有相关表"""
+    try:
+        # 删除文档表和查询表数据，并使语料缓存失效
+        get_storage().clear_corpus()
+        print("已清空所有相关表，准备导入新数据")
+        return True
+    except Exception as e:
+        print(f"清空表时出错: {e}")
+        return False
+
+def check_query_document_counts():
+    """检查每个查询ID下的文档数量，并输出统计信息"""
+    # 一次 GROUP BY 取出所有查询的文档数
+    query_counts = dict(get_storage().query_document_counts())
+    print(f"总共有 {len(query_counts)} 个查询")
+    for qid, count in query_counts.items():
+        print(f"查询ID {qid} 有 {count} 个文档")
+
+    # 统计分析
+    exact_nine = sum(1 for count in query_counts.values() if count == 9)
+    less_than_nine = sum(1 for count in query_counts.values() if count < 9)
+    more_than_nine = sum(1 for count in query_counts.values() if count > 9)
+    zero_docs = sum(1 for count in query_counts.values() if count == 0)
+
+    print("\n统计信息:")
+    print(f"正好有9个文档的查询: {exact_nine}")
+    print(f"少于9个文档的查询: {less_than_nine}")
+    print(f"多于9个文档的查询: {more_than_nine}")
+    print(f"没有文档的查询: {zero_docs}")
+
+    # 找出文档数少于9的查询ID
+    if less_than_nine > 0:
+        print("\n文档数少于9的查询ID:")
+        for qid, count in query_counts.items():
+            if count < 9:
+                print(f"查询ID {qid}: {count} 个文档")
+
+# ------------------ 2) 数据集指纹与加载 ------------------
+def dataset_hash(csv_path, skip_queries, max_queries=None):
+    """CSV 文件内容 + 查询切片参数的 sha256。"""
+    h = hashlib.sha256()
+    with open(csv_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    h.update(f"|skip_queries={skip_queries}".encode())
+    if max_queries is not None:
+        h.update(f"|max_queries={max_queries}".encode())
+    return h.hexdigest()
+
+
+def get_meta(key):
+    return get_storage().get_meta(key)
+
+
+def set_meta(key, value):
+    get_storage().set_meta(key, value)
+
+
+def load_dataset(csv_path, skip_queries=0, force=False, max_queries=None):
+    """
+    导入数据集。数据集指纹未变化时跳过，返回是否执行了导入。
+    """
+    digest = dataset_hash(csv_path, skip_queries, max_queries)
+    if not force and get_meta("dataset_hash") == digest:
+        print(f"跳过导入: {csv_path} 未变化 (sha256={digest[:12]})")
+        return False
+
+    # 只读表头，检查必要的列是否存在
+    columns = pd.read_csv(csv_path, nrows=0).columns
+    missing_columns = [col for col in REQUIRED_COLUMNS if col not in columns]
+    if missing_columns:
+        raise ValueError(f"CSV文件缺少以下列: {', '.join(missing_columns)}")
+
+    if not clear_tables_before_import():
+        raise RuntimeError("清空表失败，已中止导入")
+    import_csv_to_database(csv_path, skip_queries, max_queries)
+    set_meta("dataset_hash", digest)
+    print(f"成功从 {csv_path} 导入数据（跳过前 {skip_queries} 个查询）")
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="建表并导入实验数据（每次部署运行一次）")
+    parser.add_argument("--study", help="studies.json 中的实验名（默认 STUDY 环境变量或 default）")
+    parser.add_argument("--csv", help="数据集 CSV 文件（覆盖实验配置）")
+    parser.add_argument("--skip-queries", type=int, help="跳过 CSV 中前 N 个查询（按出现顺序，覆盖实验配置）")
+    parser.add_argument("--force", action="store_true", help="忽略数据集指纹，强制重新导入")
+    args = parser.parse_args(argv)
+
+    study = get_study(args.study)
+    csv_path = args.csv or study.csv
+    skip_queries = args.skip_queries if args.skip_queries is not None else study.skip_queries
+    max_queries = study.max_queries if args.csv is None else None
+
+    storage = get_storage()
+    with storage.lock(LOADER_LOCK_NAME, LOADER_LOCK_TIMEOUT):
+        storage.ensure_schema()
+        print(f"实验: {study.name} {study.description}")
+        loaded = load_dataset(csv_path, skip_queries, force=args.force, max_queries=max_queries)
+        set_meta("study", study.name)
+        if loaded:
+            check_query_document_counts()
+        path = corpus_store.compile_corpus(storage)
+        if path:
+            print(f"语料文件: {path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+import atexit
+import hashlib
+import math
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from metrics import log
+from spool import LOG_SPOOL_DIR, LogSpool
+from storage import get_storage
+
+# ------------------ 交互日志批量写入 ------------------
+# 请求线程只把事件放进进程内队列，后台线程把多个请求的事件合并成
+# 一次 Storage.insert_logs（一个事务，同时更新 participant_progress 汇总）：
+#   LOG_BATCH_SIZE      每次写库最多合并的事件数（默认 200）
+#   LOG_FLUSH_INTERVAL  队列里最早的事件最多等待的秒数（默认 0.5）
+
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "200"))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "0.5"))
+
+# 事件在确认之后才异步写库，写不进去的行那时已经没法退回给客户端，还会让写入线程反复重试同一批，
+# 所以 event_to_row 在确认之前按 logs 的列类型检查并转换（见 migrations.py）：
+#   (字段名, 默认值, 最小值, 最大值)
+_INT_FIELDS = (
+    ("qid", 0, -2 ** 31, 2 ** 31 - 1),
+    ("startIndex", -1, -2 ** 31, 2 ** 31 - 1),
+    ("endIndex", -1, -2 ** 31, 2 ** 31 - 1),
+    ("duration", 0, -2 ** 31, 2 ** 31 - 1),
+    ("passFlag", 0, -128, 127),
+)
+MAX_USER_ID_LENGTH = 100
+MAX_DOCNO_LENGTH = 255
+MAX_EVENT_TYPE_LENGTH = 100
+
+
+class InvalidEvent(ValueError):
+    """上报的事件无法写入 logs：/api/log 返回 400，批量接口丢弃这条事件。"""
+
+
+def _int_field(data, name, default, low, high):
+    value = data.get(name)
+    if value is None or value == "":
+        return default
+    if isinstance(value, float) and math.isfinite(value):
+        value = round(value)
+    elif isinstance(value, str):
+        try:
+            value = int(value.strip())
+        except ValueError:
+            raise InvalidEvent(f"{name} must be an integer") from None
+    elif not isinstance(value, int):
+        raise InvalidEvent(f"{name} must be an integer")
+    value = int(value)  # bool -> 0/1
+    if not low <= value <= high:
+        raise InvalidEvent(f"{name} out of range")
+    return value
+
+
+def _str_field(data, name, default, max_length):
+    value = data.get(name)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        raise InvalidEvent(f"{name} must be a string")
+    value = str(value)
+    if len(value) > max_length:
+        raise InvalidEvent(f"{name} longer than {max_length} characters")
+    return value
+
+
+def event_key(data):
+    """
+    事件的去重键。前端为每个事件生成 eventId，网络失败重发时 eventId 不变，
+    与 userId 一起哈希后作为 logs.event_key；旧页面没有 eventId 时随机生成。
+    """
+    event_id = data.get('eventId')
+    if not event_id:
+        return uuid.uuid4().hex
+    return hashlib.sha1(f"{data.get('userId')}\0{event_id}".encode()).hexdigest()
+
+
+def event_to_row(data, received_at, sent_at=None):
+    """
+    把前端上报的一条事件转换成 logs 表的一行（列顺序见 storage.LOG_COLUMNS）。
+
+    duration 由前端在事件发生时计算，这里原样保存。批量上报时事件会在
+    客户端排队一段时间，如果带了 clientTs（事件发生时刻）和整批的 sentAt，
+    就用 服务器接收时间 - (sentAt - clientTs) 还原事件时间，
+    只依赖客户端时钟的差值，不依赖其绝对时间。
+
+    缺少 userId、数值字段不是整数或超出列的范围、字符串超长时抛出 InvalidEvent。
+    """
+    user_id = _str_field(data, 'userId', None, MAX_USER_ID_LENGTH)
+    if not user_id:
+        raise InvalidEvent("userId is required")
+    qid, start_idx, end_idx, duration, pass_flag = (
+        _int_field(data, name, default, low, high) for name, default, low, high in _INT_FIELDS)
+    docno = _str_field(data, 'docno', "0", MAX_DOCNO_LENGTH)
+    event_type = _str_field(data, 'eventType', "", MAX_EVENT_TYPE_LENGTH)
+
+    timestamp = received_at
+    client_ts = data.get('clientTs')
+    if sent_at is not None and client_ts is not None:
+        try:
+            lag_ms = max(0, int(sent_at) - int(client_ts))
+            timestamp = received_at - timedelta(milliseconds=lag_ms)
+        except (TypeError, ValueError, OverflowError):
+            pass
+
+    return (user_id, qid, docno, event_type, start_idx, end_idx, duration, pass_flag, timestamp, event_key(data))
+
+
+class BufferedLogWriter:
+    def __init__(self, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.batches = 0
+        self.rows_written = 0
+        self.rows_rejected = 0
+
+    def _ensure_started(self):
+        # 线程不会跨 fork 存活，按 pid 懒启动
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._thread is None or self._pid != pid:
+                self._queue = queue.Queue()
+                self._pid = pid
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+
+    def start(self):
+        """启动后台写入线程（worker 启动时调用）。"""
+        self._ensure_started()
+
+    def submit(self, rows):
+        """把若干行放入写入队列，立即返回。"""
+        self._ensure_started()
+        for row in rows:
+            self._queue.put(row)
+
+    def _collect(self):
+        rows = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(rows) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return rows
+
+    def _write(self, rows):
+        # 批里写不进去的行（LOG_ROW_ERRORS）被挑出来丢弃，其余照常写入；
+        # 只有数据库本身出错时才抛出异常，由 _run 退避后重试整批
+        storage = get_storage()
+        _, rejected = storage.insert_logs_or_reject(rows)
+        self.batches += 1
+        self.rows_written += len(rows) - len(rejected)
+        if rejected:
+            self.rows_rejected += len(rejected)
+            log.error("Dropped %d log rows the database rejected: %r", len(rejected), rejected)
+        try:
+            storage.ensure_log_partitions()
+        except Exception as e:
+            log.error("Failed to create future log partitions: %s", e)
+
+    def _run(self):
+        backoff = 0.5
+        pending = []
+        while True:
+            if not pending:
+                pending = self._collect()
+            try:
+                self._write(pending)
+                pending = []
+                backoff = 0.5
+            except Exception as e:
+                log.error("Failed to write %d log rows: %s", len(pending), e)
+                if self._stopping:
+                    return
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "rows_written": self.rows_written,
+            "rows_rejected": self.rows_rejected,
+            "queue_depth": self._queue.qsize(),
+        }
+
+    def flush(self):
+        """进程退出前把队列中剩余的事件同步写入数据库。"""
+        if self._pid != os.getpid():
+            return
+        self._stopping = True
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for i in range(0, len(rows), self.batch_size):
+            try:
+                self._write(rows[i:i + self.batch_size])
+            except Exception as e:
+                log.error("Dropped %d log rows at shutdown: %s", len(rows[i:i + self.batch_size]), e)
+
+
+def make_log_writer():
+    """默认使用本地预写 spool（见 spool.py）；LOG_SPOOL_DIR 为空时退回纯内存队列。"""
+    if LOG_SPOOL_DIR:
+        return LogSpool(LOG_SPOOL_DIR, batch_size=LOG_BATCH_SIZE)
+    return BufferedLogWriter()
+
+
+log_writer = make_log_writer()
+atexit.register(log_writer.flush)
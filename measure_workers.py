@@ -0,0 +1,132 @@
+import argparse
+import http.cookiejar
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+# ------------------ worker 内存与启动时间测量 ------------------
+# 用当前环境（STORAGE_BACKEND / MYSQL_URL 等）分别以 preload 关闭和开启启动 gunicorn，
+# 模拟几个参与者走一遍查询页，使每个 worker 都访问过语料，然后从 /proc 读取每个 worker 的
+#   RSS  常驻内存（共享页面在每个进程里都算一次）
+#   PSS  按共享进程数分摊后的内存，各 worker 相加就是实际占用
+#   USS  只属于该进程的页面（Private_Clean + Private_Dirty）
+# 以及从启动到第一次响应的时间、worker 是否映射了 pandas。需要 Linux 的 /proc/<pid>/smaps_rollup。
+#     python measure_workers.py [--workers 4] [--participants 8] [--modes off,on] [--json out.json]
+
+DEFAULT_PORT = 8765
+
+
+def _children(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(p) for p in f.read().split()]
+
+
+def _memory_kb(pid):
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                fields[parts[0][:-1]] = int(parts[1])
+    return {"rss": fields.get("Rss", 0), "pss": fields.get("Pss", 0),
+            "uss": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)}
+
+
+def _maps_pandas(pid):
+    with open(f"/proc/{pid}/maps") as f:
+        return any("/pandas/" in line for line in f)
+
+
+def _wait_ready(base_url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(base_url + "/metrics", timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def _simulate(base_url, participants, max_queries):
+    # 每个参与者一个 cookie 会话：登录，然后依次打开查询页
+    for i in range(participants):
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        data = urllib.parse.urlencode({"user_id": f"measure-{os.getpid()}-{i}", "terms": "on"}).encode()
+        with opener.open(base_url + "/", data=data, timeout=10) as response:
+            response.read()
+            # 登录成功会重定向到第一个查询页；留在首页说明登录被拒绝，后面的测量就没有意义
+            if urllib.parse.urlparse(response.geturl()).path != "/query/1":
+                raise RuntimeError(f"模拟参与者登录失败（停在 {response.geturl()}）")
+        for position in range(1, max_queries + 1):
+            url = f"{base_url}/query/{position}"
+            with opener.open(url, timeout=10) as response:
+                response.read()
+                if response.status != 200 or response.geturl() != url:
+                    raise RuntimeError(f"查询页 {url} 没有正常返回（{response.status} {response.geturl()}）")
+
+
+def measure(preload, workers, participants, max_queries, port, timeout=60):
+    env = dict(os.environ, GUNICORN_PRELOAD="1" if preload else "0")
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.monotonic()
+    master = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:create_app()", "--config", "gunicorn.conf.py",
+         "--workers", str(workers), "--bind", f"127.0.0.1:{port}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not _wait_ready(base_url, timeout):
+            raise RuntimeError("gunicorn 未能在超时前响应")
+        first_response = time.monotonic() - started
+        while len(_children(master.pid)) < workers and time.monotonic() - started < timeout:
+            time.sleep(0.05)
+        _simulate(base_url, participants, max_queries)
+
+        per_worker = [_memory_kb(pid) for pid in _children(master.pid)]
+        return {
+            "preload": preload,
+            "workers": len(per_worker),
+            "first_response_seconds": round(first_response, 3),
+            "master": _memory_kb(master.pid),
+            "worker_rss_kb": sum(m["rss"] for m in per_worker),
+            "worker_pss_kb": sum(m["pss"] for m in per_worker),
+            "worker_uss_kb": sum(m["uss"] for m in per_worker),
+            "pandas_in_workers": any(_maps_pandas(pid) for pid in _children(master.pid)),
+        }
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait(timeout=30)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="测量 gunicorn worker 的内存占用和启动时间")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--participants", type=int, default=8, help="模拟的参与者数")
+    parser.add_argument("--max-queries", type=int, default=5, help="每个参与者打开的查询页数")
+    parser.add_argument("--modes", default="off,on", help="preload 模式，逗号分隔的 off / on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    args = parser.parse_args(argv)
+
+    results = [measure(mode == "on", args.workers, args.participants, args.max_queries, args.port)
+               for mode in args.modes.split(",")]
+    print(f"{'preload':>8} {'workers':>7} {'boot(s)':>8} {'RSS MB':>8} {'PSS MB':>8} {'USS MB':>8} {'pandas':>7}")
+    for r in results:
+        print(f"{'on' if r['preload'] else 'off':>8} {r['workers']:>7} {r['first_response_seconds']:>8.2f} "
+              f"{r['worker_rss_kb'] / 1024:>8.1f} {r['worker_pss_kb'] / 1024:>8.1f} "
+              f"{r['worker_uss_kb'] / 1024:>8.1f} {str(r['pandas_in_workers']):>7}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+import bisect
+import logging
+import os
+import sys
+import threading
+import time
+
+from flask import g, has_request_context, render_template, request
+
+# ------------------ 日志与性能指标 ------------------
+# log: 分级日志，LOG_LEVEL 控制（默认 INFO）。热点路径一律使用
+#      log.debug("... %s", value) 这种惰性格式化，关闭 DEBUG 时只有一次级别判断。
+# 指标: 每个 worker 进程各自累计，由 /metrics 以 Prometheus 文本格式输出：
+#   http_request_duration_seconds{route,method,status}  每个路由的延迟直方图
+#   db_queries_per_request{route} / db_time_per_request_seconds{route}
+#   db_query_duration_seconds                           单次数据库往返
+#   template_render_seconds{template}                   模板渲染时间
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+log = logging.getLogger("ir_study")
+if not log.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    log.addHandler(_handler)
+    log.propagate = False
+log.setLevel(LOG_LEVEL)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # [每个桶的计数..., 总和, 总数]
+                series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted(self._series.items())
+            items = [(labels, list(series)) for labels, series in items]
+        for labels, series in items:
+            base = _labels(self.labelnames, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), labels + (_fmt(bound),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), labels + ('+Inf',))} {series[-1]}")
+            lines.append(f"{self.name}_sum{base} {_fmt(series[-2])}")
+            lines.append(f"{self.name}_count{base} {series[-1]}")
+        return lines
+
+
+def _fmt(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _gauge_lines(name, help_text, value, kind="gauge"):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {_fmt(value)}"]
+
+
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Request latency by route",
+                            ("route", "method", "status"))
+DB_QUERIES_PER_REQUEST = Histogram("db_queries_per_request", "Database round trips per request",
+                                   ("route",), buckets=COUNT_BUCKETS)
+DB_TIME_PER_REQUEST = Histogram("db_time_per_request_seconds", "Database time per request", ("route",))
+DB_QUERY_DURATION = Histogram("db_query_duration_seconds", "Single database round trip")
+TEMPLATE_RENDER = Histogram("template_render_seconds", "Template render time", ("template",))
+
+PROCESS_STARTED = time.time()
+startup_stats = {"worker_boot_seconds": None}
+
+
+# ------------------ 采集钩子 ------------------
+def observe_db(seconds):
+    """db 模块每次 execute/executemany 之后调用。"""
+    DB_QUERY_DURATION.observe(seconds)
+    if has_request_context():
+        g.db_queries = g.get("db_queries", 0) + 1
+        g.db_time = g.get("db_time", 0.0) + seconds
+
+
+def timed_render(template_name, **context):
+    started = time.perf_counter()
+    try:
+        return render_template(template_name, **context)
+    finally:
+        TEMPLATE_RENDER.observe(time.perf_counter() - started, template_name)
+
+
+def mark_worker_forked():
+    """preload_app 时模块在 master 中导入，worker 的启动时间从 fork 算起。"""
+    global PROCESS_STARTED
+    PROCESS_STARTED = time.time()
+
+
+def mark_worker_ready():
+    """worker 完成预热时调用，记录从进程启动到可以服务的时间。"""
+    startup_stats["worker_boot_seconds"] = time.time() - PROCESS_STARTED
+
+
+def init_app(app):
+    """注册请求计时钩子。"""
+    @app.before_request
+    def _start_timer():
+        g.request_started = time.perf_counter()
+        g.db_queries = 0
+        g.db_time = 0.0
+
+    @app.after_request
+    def _record_request(response):
+        started = g.get("request_started")
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+            REQUEST_LATENCY.observe(time.perf_counter() - started, route,
+                                    request.method, response.status_code)
+            DB_QUERIES_PER_REQUEST.observe(g.get("db_queries", 0), route)
+            DB_TIME_PER_REQUEST.observe(g.get("db_time", 0.0), route)
+        return response
+
+
+# ------------------ 输出 ------------------
+def render_metrics(extra_sections=()):
+    """
+    Prometheus 文本格式。extra_sections 为 (前缀, {名称: 数值}) 列表，
+    用来输出连接池、日志写入、缓存等模块自己的计数器。
+    """
+    lines = []
+    for histogram in (REQUEST_LATENCY, DB_QUERIES_PER_REQUEST, DB_TIME_PER_REQUEST,
+                      DB_QUERY_DURATION, TEMPLATE_RENDER):
+        lines.extend(histogram.render())
+    lines.extend(_gauge_lines("process_start_time_seconds", "Worker process start time", PROCESS_STARTED))
+    if startup_stats["worker_boot_seconds"] is not None:
+        lines.extend(_gauge_lines("worker_boot_seconds", "Seconds from process start to warm cache",
+                                  startup_stats["worker_boot_seconds"]))
+    for prefix, values in extra_sections:
+        for key, value in values.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            lines.extend(_gauge_lines(f"{prefix}_{key}", f"{prefix} {key}", value))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,346 @@
+import sys
+from collections import namedtuple
+from datetime import datetime
+
+from db import get_connection
+from partitions import ensure_future_partitions, partition_logs
+from progress import PROGRESS_COLUMNS, backfill_rows
+from storage import LOG_COLUMNS
+from textstore import split_contents
+
+# ------------------ 数据库结构迁移 ------------------
+# schema_version 表记录已执行的迁移。每个迁移只执行一次，按版本号顺序执行，
+# 且本身是幂等的（先检查表/列/索引是否已存在），所以在已有数据的旧库上也能安全运行。
+# 迁移由 loader.py 在部署时执行；web worker 启动时只比较版本号（check_schema）。
+# 这里的迁移只针对 MySQL；SQLite 后端的结构见 storage.SQLITE_SCHEMA，
+# 新增迁移时要同步修改那里。
+#     python migrations.py            执行未完成的迁移
+#     python migrations.py --explain  用 EXPLAIN 检查热点查询是否用上索引
+# tests/test_migrations.py 在设置了 MYSQL_URL 时执行同样的 EXPLAIN 检查（python -m pytest tests）。
+
+Migration = namedtuple("Migration", ["version", "description", "apply"])
+
+
+def _table_exists(c, table):
+    c.execute("""
+        SELECT COUNT(*) AS n FROM information_schema.tables
+        WHERE table_schema = DATABASE() AND table_name = %s
+    """, (table,))
+    return c.fetchone()["n"] > 0
+
+
+def _index_exists(c, table, index):
+    c.execute("""
+        SELECT COUNT(*) AS n FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+    """, (table, index))
+    return c.fetchone()["n"] > 0
+
+
+def _column_type(c, table, column):
+    c.execute("""
+        SELECT column_type FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+    """, (table, column))
+    row = c.fetchone()
+    return row["column_type"].lower() if row else None
+
+
+def _create_index(c, table, index, columns):
+    if not _index_exists(c, table, index):
+        c.execute(f"CREATE INDEX {index} ON {table} ({columns})")
+        print(f"Created index: {table}.{index}")
+
+
+def _m001_baseline(c):
+    """原 init_db() 创建的五张表"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS logs (
+          id INT AUTO_INCREMENT PRIMARY KEY,
+          user_id VARCHAR(100) NOT NULL,     -- 用户ID
+          qid INT DEFAULT 0,                 -- 查询ID (可选)
+          docno VARCHAR(255) DEFAULT '',     -- 文档标号，使用VARCHAR
+          event_type VARCHAR(100) NOT NULL,  -- "PASSAGE_SELECTION", "OPEN_DOC", ...
+          start_idx INT DEFAULT -1,          -- 选文起始索引，没有就 -1
+          end_idx INT DEFAULT -1,            -- 选文结束索引，没有就 -1
+          duration INT DEFAULT 0,            -- 上一次到本次事件的耗时
+          pass_flag TINYINT DEFAULT 0,       -- 0 or 1
+          timestamp DATETIME                 -- 记录时间
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS documents (
+            id INT PRIMARY KEY,
+            qid INT,
+            docno VARCHAR(255),
+            content TEXT
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            user_id VARCHAR(100) NOT NULL,
+            query_id INT NOT NULL,
+            doc_order TEXT,
+            PRIMARY KEY (user_id, query_id)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS queries (
+            id INT PRIMARY KEY,
+            content TEXT
+        )
+    ''')
+    # 键值表：corpus_version（语料缓存版本号）、dataset_hash（已导入数据集指纹）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS app_meta (
+            meta_key VARCHAR(64) PRIMARY KEY,
+            meta_value VARCHAR(255)
+        )
+    ''')
+
+
+def _m002_docno_varchar(c):
+    """早期版本的 documents.docno 不是 VARCHAR，原来每次启动都执行 ALTER"""
+    if _column_type(c, "documents", "docno") != "varchar(255)":
+        c.execute("ALTER TABLE documents MODIFY COLUMN docno VARCHAR(255)")
+        print("Modified docno column to VARCHAR(255)")
+
+
+def _m003_indexes(c):
+    """页面按 qid 取文档；分析时按 user_id / qid / 时间扫描 logs"""
+    _create_index(c, "documents", "idx_documents_qid_id", "qid, id")
+    _create_index(c, "logs", "idx_logs_user_qid_ts", "user_id, qid, timestamp")
+
+
+def _m004_logs_event_key(c):
+    """日志去重键：spool 重放或客户端重发同一事件时由 INSERT IGNORE 丢弃重复行"""
+    if _column_type(c, "logs", "event_key") is None:
+        c.execute("ALTER TABLE logs ADD COLUMN event_key VARCHAR(40) NULL")
+        print("Added logs.event_key")
+    if not _index_exists(c, "logs", "uq_logs_event_key"):
+        c.execute("CREATE UNIQUE INDEX uq_logs_event_key ON logs (event_key)")
+        print("Created index: logs.uq_logs_event_key")
+
+
+def _m005_participant_rows(c):
+    """参与者拉丁方分配：slot 由 AUTO_INCREMENT 原子递增，拉丁方行 = (slot - 1) mod 行数"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS participant_rows (
+            slot INT AUTO_INCREMENT PRIMARY KEY,
+            user_id VARCHAR(100) NOT NULL,
+            assigned_at DATETIME,
+            UNIQUE KEY uq_participant_rows_user (user_id)
+        )
+    ''')
+
+
+def _m006_participant_progress(c):
+    """每个 (参与者, 查询) 的进度汇总，由日志写入时增量更新（见 progress.py）"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS participant_progress (
+            user_id VARCHAR(100) NOT NULL,
+            qid INT NOT NULL,
+            events INT DEFAULT 0,
+            time_on_task_ms BIGINT DEFAULT 0,
+            passage_selections INT DEFAULT 0,
+            unselects INT DEFAULT 0,
+            pause_ms BIGINT DEFAULT 0,
+            first_event_at DATETIME,
+            last_event_at DATETIME,
+            PRIMARY KEY (user_id, qid)
+        )
+    ''')
+    c.execute("SELECT COUNT(*) AS n FROM participant_progress")
+    if c.fetchone()["n"] == 0:
+        def fetch_after(after_id, limit):
+            c.execute(f"SELECT id, {', '.join(LOG_COLUMNS)} FROM logs WHERE id > %s ORDER BY id LIMIT %s",
+                      (after_id, limit))
+            return [(r["id"],) + tuple(r[col] for col in LOG_COLUMNS) for r in c.fetchall()]
+
+        rows = backfill_rows(fetch_after)
+        c.executemany(f"""
+            INSERT INTO participant_progress ({", ".join(PROGRESS_COLUMNS)})
+            VALUES ({", ".join(["%s"] * len(PROGRESS_COLUMNS))})
+        """, rows)
+        print(f"Backfilled participant_progress: {len(rows)} rows")
+
+
+def _m007_partition_logs(c):
+    """logs 按月 RANGE 分区（见 partitions.py），写入和近期查询只访问最近的分区"""
+    partition_logs(c)
+
+
+def _m008_texts(c):
+    """documents.content 搬到按内容哈希去重、压缩存放的 texts 表（见 textstore.py）"""
+    if not _table_exists(c, "texts"):
+        c.execute('''
+            CREATE TABLE texts (
+              hash CHAR(64) CHARACTER SET ascii PRIMARY KEY,  -- 正文 sha256
+              codec VARCHAR(8) NOT NULL,                      -- zstd / zlib / raw
+              size INT NOT NULL,                              -- 原文字节数
+              body MEDIUMBLOB NOT NULL
+            )
+        ''')
+        print("Created table: texts")
+    if _column_type(c, "documents", "content_hash") is None:
+        c.execute("ALTER TABLE documents ADD COLUMN content_hash CHAR(64) CHARACTER SET ascii NULL")
+        print("Added documents.content_hash")
+    _create_index(c, "documents", "idx_documents_content_hash", "content_hash")
+    if _column_type(c, "documents", "content") is None:
+        return
+    moved = 0
+    while True:
+        c.execute("SELECT id, content FROM documents WHERE content IS NOT NULL AND content_hash IS NULL "
+                  "ORDER BY id LIMIT 2000")
+        rows = [(row["id"], row["content"]) for row in c.fetchall()]
+        if not rows:
+            break
+        texts, updates = split_contents(rows)
+        c.executemany("INSERT IGNORE INTO texts (hash, codec, size, body) VALUES (%s, %s, %s, %s)", texts)
+        c.executemany("UPDATE documents SET content_hash = %s WHERE id = %s", updates)
+        moved += len(rows)
+    c.execute("ALTER TABLE documents DROP COLUMN content")
+    print(f"Moved {moved} document texts into texts")
+
+
+def _m009_log_keys(c):
+    """
+    不分区的事件去重表：分区后 logs 的唯一键变成 (event_key, timestamp)，
+    重发的同一事件时间戳不同时拦不住，由 log_keys(event_key) 认领（见 MySQLStorage.insert_logs）
+    """
+    if not _table_exists(c, "log_keys"):
+        c.execute('''
+            CREATE TABLE log_keys (
+              event_key VARCHAR(40) PRIMARY KEY,
+              claim CHAR(32) CHARACTER SET ascii NOT NULL   -- 插入该键的事务，回填的行为空串
+            )
+        ''')
+        print("Created table: log_keys")
+    c.execute("SELECT MAX(id) AS max_id FROM logs")
+    max_id = c.fetchone()["max_id"] or 0
+    for start in range(0, max_id, 50000):
+        c.execute("INSERT IGNORE INTO log_keys (event_key, claim) "
+                  "SELECT event_key, '' FROM logs WHERE id > %s AND id <= %s AND event_key IS NOT NULL",
+                  (start, start + 50000))
+    print(f"Backfilled log_keys from {max_id} log ids")
+
+
+def _m010_log_keys_expiry(c):
+    """
+    log_keys 记录认领时间，超过保留窗口的键定期删除（partitions.prune_log_keys），表的大小不随日志总量增长；
+    去重由 log_keys 负责后，logs 上的 (event_key, timestamp) 唯一索引只增加每次插入的开销，删除
+    """
+    if _column_type(c, "log_keys", "claimed_at") is None:
+        c.execute("ALTER TABLE log_keys ADD COLUMN claimed_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP")
+        print("Added log_keys.claimed_at")
+    _create_index(c, "log_keys", "idx_log_keys_claimed_at", "claimed_at")
+    if _index_exists(c, "logs", "uq_logs_event_key"):
+        c.execute("ALTER TABLE logs DROP INDEX uq_logs_event_key")
+        print("Dropped index: logs.uq_logs_event_key")
+
+
+MIGRATIONS = [
+    Migration(1, "baseline tables", _m001_baseline),
+    Migration(2, "documents.docno VARCHAR(255)", _m002_docno_varchar),
+    Migration(3, "documents(qid, id) and logs(user_id, qid, timestamp) indexes", _m003_indexes),
+    Migration(4, "logs.event_key unique dedup key", _m004_logs_event_key),
+    Migration(5, "participant_rows counterbalancing allocator", _m005_participant_rows),
+    Migration(6, "participant_progress rollups", _m006_participant_progress),
+    Migration(7, "logs monthly RANGE partitions", _m007_partition_logs),
+    Migration(8, "content-addressed compressed texts table", _m008_texts),
+    Migration(9, "unpartitioned log_keys dedup table", _m009_log_keys),
+    Migration(10, "log_keys expiry; drop logs(event_key, timestamp) unique index", _m010_log_keys_expiry),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(c):
+    if not _table_exists(c, "schema_version"):
+        return 0
+    c.execute("SELECT MAX(version) AS v FROM schema_version")
+    row = c.fetchone()
+    return row["v"] or 0
+
+
+def migrate():
+    """执行所有未完成的迁移，返回迁移后的版本号。应在 loader 锁内调用。"""
+    conn = get_connection()
+    try:
+        with conn.cursor() as c:
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    description VARCHAR(255),
+                    applied_at DATETIME
+                )
+            ''')
+            version = current_version(c)
+            for migration in MIGRATIONS:
+                if migration.version <= version:
+                    continue
+                print(f"Applying migration {migration.version}: {migration.description}")
+                migration.apply(c)
+                c.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (%s, %s, %s)",
+                          (migration.version, migration.description, datetime.now()))
+                conn.commit()
+                version = migration.version
+            # 部署时预建未来几个月的分区；运行期间由日志写入线程定期检查（Storage.ensure_log_partitions）
+            created = ensure_future_partitions(c)
+            if created:
+                print(f"Created log partitions: {', '.join(created)}")
+        return version
+    finally:
+        conn.close()
+
+
+def check_schema():
+    """worker 启动时调用：只读一次版本号，落后时给出提示，不做任何结构修改。"""
+    from storage import get_storage
+    try:
+        version = get_storage().schema_version()
+    except Exception as e:
+        print(f"ERROR: Failed to read schema version: {e}")
+        return None
+    if version < LATEST_VERSION:
+        print(f"WARNING: Database schema version {version} is behind {LATEST_VERSION}; run python loader.py")
+    return version
+
+
+# 热点查询及其应当使用的索引
+EXPLAIN_CHECKS = [
+    ("SELECT id, docno, content_hash FROM documents WHERE qid=%s ORDER BY id", (0,), "idx_documents_qid_id"),
+    ("SELECT * FROM logs WHERE user_id=%s AND qid=%s ORDER BY timestamp", ("", 0), "idx_logs_user_qid_ts"),
+    ("SELECT event_key FROM log_keys WHERE claimed_at < %s", ("1970-01-02",), "idx_log_keys_claimed_at"),
+]
+
+
+def explain_hot_queries():
+    """对 EXPLAIN_CHECKS 中的查询执行 EXPLAIN，返回 [(sql, 期望索引, 实际索引, 是否通过)]。"""
+    results = []
+    conn = get_connection()
+    try:
+        with conn.cursor() as c:
+            for sql, args, expected in EXPLAIN_CHECKS:
+                c.execute("EXPLAIN " + sql, args)
+                keys = [row.get("key") for row in c.fetchall()]
+                results.append((sql, expected, keys, expected in keys))
+    finally:
+        conn.close()
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if "--explain" in argv:
+        ok = True
+        for sql, expected, keys, passed in explain_hot_queries():
+            print(f"{'OK  ' if passed else 'FAIL'} {expected:<24} key={keys}  {sql}")
+            ok = ok and passed
+        return 0 if ok else 1
+    print(f"Schema version: {migrate()}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,323 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sys
+from datetime import date, datetime, timedelta
+
+import pymysql
+
+from db import connect_direct, get_connection
+from storage import LOG_COLUMNS, get_storage
+
+# ------------------ logs 分区、归档与恢复（仅 MySQL） ------------------
+# logs 按月 RANGE 分区：PARTITION BY RANGE (TO_DAYS(timestamp))，分区名 pYYYYMM，
+# 最后一个分区 pmax 接收超出范围的行。写入和按时间范围的查询只会落到最近的几个分区。
+# 分区维护（迁移 7 建立分区之后）：
+#     python partitions.py list                   列出分区及行数
+#     python partitions.py ensure [--ahead 2]     预先建好未来几个月的分区（部署时和日志写入线程每小时都会检查）
+#     python partitions.py archive --older-than 3 把早于 N 个月的分区导出为 gzip JSONL 后删除
+#     python partitions.py restore p202607        把归档文件中的行重新插入 logs
+# 归档目录（LOG_ARCHIVE_DIR，默认 log_archive）下的 manifest.json 记录每个归档文件的
+# 分区名、行数、sha256 和时间；恢复前先校验 sha256。
+# 只归档已经被 export.py 导出过的分区（最大 id 不超过 app_meta 中的 log_export_watermark），
+# 恢复的行保留原 id、小于 watermark，增量导出不会再读到它们；没有导出需求时用 --force。
+#     python partitions.py prune-keys [--days 30] 删除认领时间早于 N 天的 log_keys（日志写入线程每小时也会做）
+# log_keys 只需要覆盖客户端重发和 spool 重放的时间窗口：LOG_KEY_RETENTION_DAYS（默认 30）
+# 要长于 spool 段可能滞留的最长时间，超过窗口之后重放的同一事件会再插入一次。
+
+LOG_PARTITION_MONTHS_AHEAD = int(os.environ.get("LOG_PARTITION_MONTHS_AHEAD", "2"))
+LOG_ARCHIVE_DIR = os.environ.get("LOG_ARCHIVE_DIR", "log_archive")
+LOG_KEY_RETENTION_DAYS = float(os.environ.get("LOG_KEY_RETENTION_DAYS", "30"))
+MAXVALUE_PARTITION = "pmax"
+ARCHIVE_COLUMNS = ("id",) + LOG_COLUMNS
+
+
+# ------------------ 1) 分区定义 ------------------
+def _month_start(d):
+    return date(d.year, d.month, 1)
+
+
+def _next_month(d):
+    return date(d.year + d.month // 12, d.month % 12 + 1, 1)
+
+
+def _add_months(d, months):
+    for _ in range(months):
+        d = _next_month(d)
+    return d
+
+
+def partition_name(month):
+    return f"p{month.year:04d}{month.month:02d}"
+
+
+def _partition_month(name):
+    return date(int(name[1:5]), int(name[5:7]), 1)
+
+
+def _partition_sql(months):
+    parts = [f"PARTITION {partition_name(m)} VALUES LESS THAN (TO_DAYS('{_next_month(m).isoformat()}'))"
+             for m in months]
+    parts.append(f"PARTITION {MAXVALUE_PARTITION} VALUES LESS THAN MAXVALUE")
+    return ",\n    ".join(parts)
+
+
+def list_partitions(c):
+    """[(分区名, 估计行数)]，按范围顺序；logs 未分区时返回空列表。"""
+    c.execute("""
+        SELECT partition_name AS name, table_rows AS row_count FROM information_schema.partitions
+        WHERE table_schema = DATABASE() AND table_name = 'logs' AND partition_name IS NOT NULL
+        ORDER BY partition_ordinal_position
+    """)
+    return [(row["name"], row["row_count"]) for row in c.fetchall()]
+
+
+def partition_logs(c, months_ahead=LOG_PARTITION_MONTHS_AHEAD):
+    """
+    把未分区的 logs 改成按月分区（迁移 7 调用）。分区键必须出现在所有唯一键中，
+    所以主键改为 (id, timestamp)，event_key 唯一索引改为 (event_key, timestamp)。
+    """
+    if list_partitions(c):
+        return
+    c.execute("UPDATE logs SET timestamp = '1970-01-01' WHERE timestamp IS NULL")
+    c.execute("""
+        ALTER TABLE logs
+            MODIFY COLUMN timestamp DATETIME NOT NULL,
+            DROP PRIMARY KEY,
+            ADD PRIMARY KEY (id, timestamp),
+            DROP INDEX uq_logs_event_key,
+            ADD UNIQUE INDEX uq_logs_event_key (event_key, timestamp)
+    """)
+    c.execute("SELECT MIN(timestamp) AS first_ts FROM logs WHERE timestamp > '1970-01-01'")
+    first_ts = c.fetchone()["first_ts"]
+    first = _month_start(first_ts or datetime.now())
+    last = _add_months(_month_start(datetime.now()), months_ahead)
+    months = [first]
+    while months[-1] < last:
+        months.append(_next_month(months[-1]))
+    c.execute(f"ALTER TABLE logs PARTITION BY RANGE (TO_DAYS(timestamp)) (\n    {_partition_sql(months)}\n)")
+    print(f"Partitioned logs into {len(months)} monthly partitions + {MAXVALUE_PARTITION}")
+
+
+def ensure_future_partitions(c, months_ahead=LOG_PARTITION_MONTHS_AHEAD):
+    """从 pmax 中拆出直到 当前月 + months_ahead 的按月分区，返回新建的分区名。"""
+    names = [name for name, _ in list_partitions(c) if name != MAXVALUE_PARTITION]
+    if not names:
+        return []
+    last = _add_months(_month_start(datetime.now()), months_ahead)
+    month = _next_month(_partition_month(names[-1]))
+    months = []
+    while month <= last:
+        months.append(month)
+        month = _next_month(month)
+    if months:
+        # pmax 通常是空的，REORGANIZE 只需要移动极少的行
+        c.execute(f"ALTER TABLE logs REORGANIZE PARTITION {MAXVALUE_PARTITION} INTO (\n    {_partition_sql(months)}\n)")
+    return [partition_name(m) for m in months]
+
+
+def prune_log_keys(c, days=LOG_KEY_RETENTION_DAYS, batch_size=10000):
+    """分批删除认领时间早于 days 天的 log_keys，每批单独提交以免长时间持锁，返回删除的行数。"""
+    cutoff = datetime.now() - timedelta(days=days)
+    deleted = 0
+    while True:
+        c.execute("DELETE FROM log_keys WHERE claimed_at < %s LIMIT %s", (cutoff, batch_size))
+        c.connection.commit()
+        deleted += c.rowcount
+        if c.rowcount < batch_size:
+            return deleted
+
+
+# ------------------ 2) 归档与恢复 ------------------
+def load_manifest(archive_dir):
+    path = os.path.join(archive_dir, "manifest.json")
+    if not os.path.exists(path):
+        return {"archives": {}}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(archive_dir, manifest):
+    path = os.path.join(archive_dir, "manifest.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _check_exported(name):
+    from export import WATERMARK_META_KEY
+    watermark = int(get_storage().get_meta(WATERMARK_META_KEY) or 0)
+    conn = get_connection()
+    try:
+        with conn.cursor() as c:
+            c.execute(f"SELECT MAX(id) AS max_id FROM logs PARTITION ({name})")
+            max_id = c.fetchone()["max_id"] or 0
+    finally:
+        conn.close()
+    if max_id > watermark:
+        raise RuntimeError(f"{name} 中有尚未导出的日志 (max id {max_id} > watermark {watermark})，"
+                           f"先运行 python export.py，或用 --force 跳过检查")
+
+
+def archive_partition(name, archive_dir=LOG_ARCHIVE_DIR, chunk_rows=10000, force=False):
+    """
+    把一个分区流式导出为 <name>.jsonl.gz，核对行数后删除该分区，返回归档的行数。
+    force=False 时分区中有尚未被 export.py 导出的行则抛出 RuntimeError。
+    """
+    if not force:
+        _check_exported(name)
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"logs-{name}.jsonl.gz")
+    rows = 0
+    conn = connect_direct(cursorclass=pymysql.cursors.SSDictCursor)
+    try:
+        with conn.cursor() as c, gzip.open(path + ".tmp", "wt", encoding="utf-8") as out:
+            c.execute(f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM logs PARTITION ({name}) ORDER BY id")
+            while True:
+                batch = c.fetchmany(chunk_rows)
+                if not batch:
+                    break
+                for row in batch:
+                    out.write(json.dumps(row, ensure_ascii=False, default=str))
+                    out.write("\n")
+                rows += len(batch)
+    finally:
+        conn.close()
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as c:
+            c.execute(f"SELECT COUNT(*) AS n FROM logs PARTITION ({name})")
+            count = c.fetchone()["n"]
+            if count != rows:
+                os.unlink(path + ".tmp")
+                raise RuntimeError(f"{name}: 导出 {rows} 行，但分区中有 {count} 行，已中止")
+            os.replace(path + ".tmp", path)
+            manifest = load_manifest(archive_dir)
+            manifest["archives"][name] = {
+                "file": os.path.basename(path),
+                "rows": rows,
+                "sha256": _sha256(path),
+                "archived_at": datetime.now().isoformat(timespec="seconds"),
+                "restored_at": None,
+            }
+            save_manifest(archive_dir, manifest)
+            c.execute(f"ALTER TABLE logs DROP PARTITION {name}")
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"已归档分区 {name}: {rows} 行 -> {path}")
+    return rows
+
+
+def archive_older_than(months, archive_dir=LOG_ARCHIVE_DIR, force=False):
+    """归档所有整月早于 当前月 - months 的分区，返回归档的分区名。"""
+    cutoff = _month_start(datetime.now())
+    for _ in range(months):
+        cutoff = date(cutoff.year - (cutoff.month == 1), (cutoff.month - 2) % 12 + 1, 1)
+    conn = get_connection()
+    try:
+        with conn.cursor() as c:
+            names = [name for name, _ in list_partitions(c) if name != MAXVALUE_PARTITION]
+    finally:
+        conn.close()
+    # 至少保留一个按月分区，pmax 之前的范围才不会变成一个大分区
+    cold = [name for name in names[:-1] if _partition_month(name) < cutoff]
+    for name in cold:
+        archive_partition(name, archive_dir, force=force)
+    return cold
+
+
+def restore_partition(name, archive_dir=LOG_ARCHIVE_DIR, batch_size=1000):
+    """
+    把归档的行重新插入 logs（保留原 id，已存在的行被忽略）。分区已被删除，
+    这些行会落到当前最早的分区里。participant_progress 不受归档/恢复影响。
+    """
+    manifest = load_manifest(archive_dir)
+    entry = manifest["archives"].get(name)
+    if entry is None:
+        raise ValueError(f"manifest 中没有分区 {name} 的归档")
+    path = os.path.join(archive_dir, entry["file"])
+    if _sha256(path) != entry["sha256"]:
+        raise RuntimeError(f"{path} 的 sha256 与 manifest 不一致")
+
+    sql = (f"INSERT IGNORE INTO logs ({', '.join(ARCHIVE_COLUMNS)}) "
+           f"VALUES ({', '.join(['%s'] * len(ARCHIVE_COLUMNS))})")
+    # 恢复的事件也登记到 log_keys，之后重发的同一事件仍会被去重
+    keys_sql = "INSERT IGNORE INTO log_keys (event_key, claim) VALUES (%s, '')"
+    restored = 0
+    conn = get_connection()
+    try:
+        with conn.cursor() as c, gzip.open(path, "rt", encoding="utf-8") as f:
+            batch = []
+            for line in f:
+                row = json.loads(line)
+                batch.append(tuple(row[col] for col in ARCHIVE_COLUMNS))
+                if len(batch) >= batch_size:
+                    c.executemany(sql, batch)
+                    c.executemany(keys_sql, [(row[-1],) for row in batch if row[-1] is not None])
+                    conn.commit()
+                    restored += len(batch)
+                    batch = []
+            if batch:
+                c.executemany(sql, batch)
+                c.executemany(keys_sql, [(row[-1],) for row in batch if row[-1] is not None])
+                conn.commit()
+                restored += len(batch)
+    finally:
+        conn.close()
+    entry["restored_at"] = datetime.now().isoformat(timespec="seconds")
+    save_manifest(archive_dir, manifest)
+    print(f"已从 {path} 恢复 {restored} 行")
+    return restored
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="logs 表分区维护、归档与恢复（MySQL）")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="列出分区")
+    ensure = sub.add_parser("ensure", help="预建未来月份的分区")
+    ensure.add_argument("--ahead", type=int, default=LOG_PARTITION_MONTHS_AHEAD)
+    archive = sub.add_parser("archive", help="归档并删除旧分区")
+    archive.add_argument("--older-than", type=int, required=True, help="归档早于 N 个月的分区")
+    archive.add_argument("--dir", default=LOG_ARCHIVE_DIR)
+    archive.add_argument("--force", action="store_true", help="不检查分区是否已被 export.py 导出")
+    restore = sub.add_parser("restore", help="从归档恢复一个分区的行")
+    restore.add_argument("partition")
+    restore.add_argument("--dir", default=LOG_ARCHIVE_DIR)
+    prune = sub.add_parser("prune-keys", help="删除超过保留窗口的 log_keys")
+    prune.add_argument("--days", type=float, default=LOG_KEY_RETENTION_DAYS)
+    args = parser.parse_args(argv)
+
+    if args.command == "archive":
+        archive_older_than(args.older_than, args.dir, args.force)
+    elif args.command == "restore":
+        restore_partition(args.partition, args.dir)
+    else:
+        conn = get_connection()
+        try:
+            with conn.cursor() as c:
+                if args.command == "prune-keys":
+                    print(f"删除 {prune_log_keys(c, args.days)} 个过期的 log_keys")
+                    return 0
+                if args.command == "ensure":
+                    print(f"新建分区: {ensure_future_partitions(c, args.ahead) or '无'}")
+                for name, row_count in list_partitions(c):
+                    print(f"{name:<10} ~{row_count} 行")
+        finally:
+            conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
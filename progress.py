@@ -0,0 +1,113 @@
+import re
+
+# ------------------ 参与者进度汇总 ------------------
+# 日志写入数据库时（Storage.insert_logs，与插入 logs 在同一个事务里）按 (user_id, qid)
+# 累加到 participant_progress 表，监控只读这张小表，开销与 logs 的行数无关：
+#   events              事件数
+#   time_on_task_ms     该查询页上事件间隔（duration）之和
+#   passage_selections  PASSAGE_SELECTION 次数；unselects  UNSELECT 次数
+#   pause_ms            暂停时长（pause.html 记录的 PAUSE_DURATION 事件，qid 为 0）：取 duration，
+#                       为 0 时取事件类型 "PAUSE_DURATION: N" 里的 N（旧页面只写在这里）
+#   first_event_at / last_event_at
+# 同一事件（相同 event_key）只计一次：只汇总本次实际插入的行（MySQL 上由 log_keys 认领，见 storage.py）。
+# 建表时的回填（backfill_rows）和写入时的增量（rollup_deltas）用同一套规则。
+
+PROGRESS_COLUMNS = ("user_id", "qid", "events", "time_on_task_ms", "passage_selections", "unselects",
+                    "pause_ms", "first_event_at", "last_event_at")
+
+PAUSE_EVENT_PREFIX = "PAUSE_DURATION"
+
+# 建表时用现有 logs 一次性回填（之后只做增量）时每次读取的行数
+BACKFILL_CHUNK_ROWS = 10000
+
+_PAUSE_MS = re.compile(r"PAUSE_DURATION:\s*(\d+)")
+
+
+def _pause_ms(event_type, duration):
+    if duration:
+        return int(duration)
+    match = _PAUSE_MS.match(event_type)
+    return int(match.group(1)) if match else 0
+
+
+def _accumulate(deltas, rows):
+    for user_id, qid, _docno, event_type, _start, _end, duration, _pass, timestamp, _key in rows:
+        qid = qid or 0
+        d = deltas.get((user_id, qid))
+        if d is None:
+            d = deltas[(user_id, qid)] = [user_id, qid, 0, 0, 0, 0, 0, timestamp, timestamp]
+        d[2] += 1
+        event_type = event_type or ""
+        if event_type.startswith(PAUSE_EVENT_PREFIX):
+            d[6] += _pause_ms(event_type, duration)
+        elif qid:
+            d[3] += int(duration or 0)
+        if event_type == "PASSAGE_SELECTION":
+            d[4] += 1
+        elif event_type == "UNSELECT":
+            d[5] += 1
+        if timestamp is not None:
+            d[7] = timestamp if d[7] is None else min(d[7], timestamp)
+            d[8] = timestamp if d[8] is None else max(d[8], timestamp)
+
+
+def rollup_deltas(rows):
+    """logs 行（storage.LOG_COLUMNS 顺序）-> 每个 (user_id, qid) 一行增量（PROGRESS_COLUMNS 顺序）。"""
+    deltas = {}
+    _accumulate(deltas, rows)
+    return [tuple(d) for d in deltas.values()]
+
+
+def backfill_rows(fetch_after, chunk_rows=BACKFILL_CHUNK_ROWS):
+    """
+    用现有 logs 计算 participant_progress 的全部行，规则与 rollup_deltas 相同。
+    fetch_after(after_id, limit) 按 id 升序返回 id > after_id 的至多 limit 行，每行为 (id,) + LOG_COLUMNS；
+    内存只与 (user_id, qid) 的个数有关。
+    """
+    deltas = {}
+    after_id = 0
+    while True:
+        rows = fetch_after(after_id, chunk_rows)
+        if not rows:
+            return [tuple(d) for d in deltas.values()]
+        after_id = rows[-1][0]
+        _accumulate(deltas, (row[1:] for row in rows))
+
+
+def summarize(progress_rows, positions):
+    """
+    participant_progress 的全部行 -> 每个参与者的进度摘要。
+    positions: {qid: 查询位置(1 起始)}，当前位置取最后一次有事件的查询。
+    """
+    users = {}
+    for row in progress_rows:
+        user = users.get(row["user_id"])
+        if user is None:
+            user = users[row["user_id"]] = {
+                "current_qid": None, "current_position": None, "queries": 0, "events": 0,
+                "time_on_task_ms": 0, "passage_selections": 0, "unselects": 0, "pause_ms": 0,
+                "last_event_at": None, "_current_at": None,
+            }
+        user["events"] += row["events"]
+        user["pause_ms"] += row["pause_ms"]
+        last = str(row["last_event_at"]) if row["last_event_at"] is not None else None
+        if last is not None and (user["last_event_at"] is None or last > user["last_event_at"]):
+            user["last_event_at"] = last
+        if not row["qid"]:
+            continue
+        user["queries"] += 1
+        user["time_on_task_ms"] += row["time_on_task_ms"]
+        user["passage_selections"] += row["passage_selections"]
+        user["unselects"] += row["unselects"]
+        if last is not None and (user["_current_at"] is None or last > user["_current_at"]):
+            user["_current_at"] = last
+            user["current_qid"] = row["qid"]
+            user["current_position"] = positions.get(row["qid"])
+
+    totals = {"participants": len(users), "events": 0, "time_on_task_ms": 0,
+              "passage_selections": 0, "pause_ms": 0}
+    for user in users.values():
+        del user["_current_at"]
+        for key in ("events", "time_on_task_ms", "passage_selections", "pause_ms"):
+            totals[key] += user[key]
+    return {"totals": totals, "users": users}
@@ -0,0 +1,117 @@
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+from metrics import timed_render
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖，未安装时只使用 gzip
+    brotli = None
+
+# ------------------ 查询页渲染缓存 ------------------
+# 每个查询只有有限个拉丁方行，文档网格（页面中最大的部分）只取决于
+# (query_id, 拉丁方行)。网格片段按 (query_id, 行排列, 模板版本, 语料版本) 缓存，
+# 每个用户只渲染很小的外壳 query.html 并把片段嵌进去。
+#   RENDER_CACHE_SIZE   缓存的片段数上限（默认 512）
+#   COMPRESS_MIN_SIZE   小于该字节数的响应不压缩（默认 500）
+
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "512"))
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "500"))
+
+_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+
+def _template_version(*names):
+    # 模板内容变化（重新部署）时自动使旧片段和旧 ETag 失效
+    h = hashlib.sha1()
+    for name in names:
+        with open(os.path.join(_TEMPLATE_DIR, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+TEMPLATE_VERSION = _template_version("query.html", "_doc_grid.html")
+
+
+class FragmentCache:
+    def __init__(self, max_entries=RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_doc_grid(self, query_id, perm, corpus_version, docs):
+        """
+        返回渲染好的文档网格片段（Markup）。perm 是拉丁方行（排列），
+        docs 为按 perm 排好序的文档。
+        """
+        key = (query_id, tuple(perm), TEMPLATE_VERSION, corpus_version)
+        with self._lock:
+            fragment = self._entries.get(key)
+            if fragment is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return fragment
+
+        doc_texts = {doc["docno"]: doc["content"] or '文档内容为空' for doc in docs}
+        fragment = Markup(timed_render("_doc_grid.html", docs=docs, doc_texts=doc_texts))
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = fragment
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return fragment
+
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+fragment_cache = FragmentCache()
+
+
+def page_etag(*parts):
+    """由页面的全部输入计算强 ETag，渲染之前即可判断是否返回 304。"""
+    h = hashlib.sha1(TEMPLATE_VERSION.encode())
+    for part in parts:
+        h.update(b"\0")
+        h.update(str(part).encode())
+    return h.hexdigest()
+
+
+# ------------------ HTML 压缩 ------------------
+def negotiate_encoding(accept_encoding):
+    """根据 Accept-Encoding 选择 br / gzip / None。"""
+    if brotli is not None and "br" in accept_encoding:
+        return "br"
+    if "gzip" in accept_encoding:
+        return "gzip"
+    return None
+
+
+def compress_response(response, accept_encoding):
+    """after_request 钩子：压缩 HTML 响应。"""
+    if (response.status_code != 200 or response.direct_passthrough
+            or response.mimetype != "text/html"
+            or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding(accept_encoding)
+    body = response.get_data()
+    if encoding is None or len(body) < COMPRESS_MIN_SIZE:
+        return response
+    if encoding == "br":
+        body = brotli.compress(body, quality=5)
+    else:
+        body = gzip.compress(body, compresslevel=6)
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -0,0 +1,370 @@
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from metrics import log
+from storage import get_storage
+
+try:
+    from gevent import get_hub, monkey
+except ImportError:  # gevent 为可选依赖，只在 GUNICORN_WORKER_CLASS=gevent 时需要
+    get_hub = None
+
+# ------------------ 交互日志本地预写 spool ------------------
+# /api/log 在事件追加到本地段文件并 fsync 之后才返回，数据库变慢或暂时不可用时
+# 请求延迟不受影响，事件也不会丢失：
+#   LOG_SPOOL_DIR            段文件目录（默认 log_spool；设为空则退回纯内存队列 BufferedLogWriter）
+#   LOG_SPOOL_GROUP_COMMIT   组提交窗口秒数，窗口内的并发请求共用一次 fsync（默认 0.002）
+#   LOG_SPOOL_SEGMENT_BYTES  活动段超过该大小时封存（默认 4 MB）
+#   LOG_SPOOL_SEAL_INTERVAL  活动段最多写多少秒后封存并交给投递线程（默认 1）
+# 段文件 <pid>-<毫秒时间>-<序号>.seg 由写入进程持有 flock，封存后改名为 .ready。
+# 每个进程的投递线程把拿得到 flock 的段（.ready，以及写入进程已经退出的 .seg）
+# 批量写入 logs 表后删除，所以重启后会自动重放上次没投递完的段。
+# 每行都带 event_key，重复投递由 Storage.insert_logs 按 event_key 去重。
+# 数据库拒绝的行（Storage.insert_logs_or_reject）写进 <段名>.bad，段里其余的行照常投递；
+# 因为其他原因反复失败的段在数据库确实可用（同一轮有别的段投递成功）的情况下累计失败
+# LOG_SPOOL_MAX_ATTEMPTS 次（默认 10）后改名为 .bad，不再挡住后面的段。
+# .bad 与段文件格式相同，排查修复后改名为 .ready 即可重放。
+# 投递线程同时负责定期预建 logs 的未来分区（Storage.ensure_log_partitions）。
+
+LOG_SPOOL_DIR = os.environ.get("LOG_SPOOL_DIR", "log_spool")
+LOG_SPOOL_GROUP_COMMIT = float(os.environ.get("LOG_SPOOL_GROUP_COMMIT", "0.002"))
+LOG_SPOOL_SEGMENT_BYTES = int(os.environ.get("LOG_SPOOL_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+LOG_SPOOL_SEAL_INTERVAL = float(os.environ.get("LOG_SPOOL_SEAL_INTERVAL", "1"))
+LOG_SPOOL_MAX_ATTEMPTS = int(os.environ.get("LOG_SPOOL_MAX_ATTEMPTS", "10"))
+
+TIMESTAMP_INDEX = 8  # storage.LOG_COLUMNS 中 timestamp 的位置
+
+
+def _run_blocking(fn, *args):
+    """
+    gevent worker（打过补丁）下 write/fsync 会阻塞整个 hub，每次 /api/log 确认都让其他协程排在
+    磁盘延迟后面；这时把调用交给 hub 的线程池执行，只有等待落盘的协程挂起。
+    """
+    if get_hub is not None and monkey.is_module_patched("threading"):
+        return get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+
+def _write_durable(f, data):
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _encode_row(row):
+    row = list(row)
+    if row[TIMESTAMP_INDEX] is not None:
+        row[TIMESTAMP_INDEX] = row[TIMESTAMP_INDEX].isoformat(sep=" ")
+    return (json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def _decode_row(line):
+    row = json.loads(line)
+    if row[TIMESTAMP_INDEX] is not None:
+        row[TIMESTAMP_INDEX] = datetime.fromisoformat(row[TIMESTAMP_INDEX])
+    return tuple(row)
+
+
+class LogSpool:
+    """与 BufferedLogWriter 接口相同（submit / stats / flush），但 submit 返回时事件已落盘。"""
+
+    def __init__(self, directory=LOG_SPOOL_DIR, batch_size=200, group_commit=LOG_SPOOL_GROUP_COMMIT,
+                 segment_bytes=LOG_SPOOL_SEGMENT_BYTES, seal_interval=LOG_SPOOL_SEAL_INTERVAL,
+                 max_attempts=LOG_SPOOL_MAX_ATTEMPTS):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.group_commit = group_commit
+        self.segment_bytes = segment_bytes
+        self.seal_interval = seal_interval
+        self.max_attempts = max_attempts
+        self._init_lock = threading.Lock()
+        self._pid = None
+        self.events_appended = 0
+        self.fsyncs = 0
+        self.segments_shipped = 0
+        self.rows_shipped = 0
+        self.duplicates_skipped = 0
+        self.rows_rejected = 0
+        self.segments_quarantined = 0
+        self.ship_errors = 0
+        self._failures = {}  # 段路径 -> 在数据库可用时投递失败的次数
+
+    # --- 写入端 ---
+    def start(self):
+        """打开本进程的活动段并启动投递线程（worker 启动时调用，以便尽快重放遗留的段）。"""
+        self._ensure_open()
+
+    def _ensure_open(self):
+        # 文件锁和线程都不会跨 fork 继承，按 pid 懒初始化
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._init_lock:
+            if self._pid == pid:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._cond = threading.Condition()
+            self._buffer = []
+            self._appended = 0
+            self._durable = 0
+            self._flushing = False
+            self._seq = 0
+            self._file = None
+            self._open_segment(pid)
+            self._shipper = threading.Thread(target=self._run_shipper, name="log-shipper", daemon=True)
+            self._pid = pid
+            self._shipper.start()
+
+    def _open_segment(self, pid):
+        self._seq += 1
+        self._path = os.path.join(self.directory, f"{pid}-{int(time.time() * 1000)}-{self._seq}.seg")
+        self._file = open(self._path, "ab")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        # 段文件的 fsync 不包括它在目录中的条目：新建（以及封存时的改名）之后 fsync 目录，
+        # 否则掉电后已确认的事件可能随目录条目一起丢失
+        self._fsync_directory()
+        self._bytes = 0
+        self._opened_at = time.monotonic()
+
+    def _fsync_directory(self):
+        _run_blocking(_fsync_path, self.directory)
+
+    def _seal_locked(self, force=False):
+        """调用方持有 self._cond 且没有正在进行的写入。"""
+        if self._bytes == 0 and not force:
+            self._opened_at = time.monotonic()
+            return
+        # 先改名再关闭，期间一直持有 flock，其他进程不会把它当成孤儿段。
+        # 改名由 _open_segment 中的目录 fsync 一并落盘
+        os.rename(self._path, self._path[:-len(".seg")] + ".ready")
+        self._file.close()
+        self._open_segment(self._pid)
+
+    def submit(self, rows):
+        """追加若干行并等待 fsync 完成后返回；写盘失败时抛出异常。"""
+        if not rows:
+            return
+        self._ensure_open()
+        data = b"".join(_encode_row(row) for row in rows)
+        cond = self._cond
+        with cond:
+            self._buffer.append(data)
+            self._appended += 1
+            ticket = self._appended
+            while self._durable < ticket:
+                if self._flushing:
+                    cond.wait()
+                else:
+                    self._group_commit_locked()
+            self.events_appended += len(rows)
+
+    def _group_commit_locked(self):
+        # 第一个到达的线程充当 leader：等一个很短的窗口收集其他请求的数据，
+        # 然后一次 write + fsync，唤醒所有数据已落盘的线程
+        cond = self._cond
+        self._flushing = True
+        try:
+            if self.group_commit > 0:
+                cond.release()
+                try:
+                    time.sleep(self.group_commit)
+                finally:
+                    cond.acquire()
+            batch, self._buffer = self._buffer, []
+            upto = self._appended
+            data = b"".join(batch)
+            f = self._file
+            cond.release()
+            try:
+                _run_blocking(_write_durable, f, data)
+                ok = True
+            except OSError:
+                ok = False
+                raise
+            finally:
+                cond.acquire()
+                if not ok:
+                    # 可能写了半行：封存当前段（读取时跳过残行），数据放回缓冲区重写到新段
+                    self._buffer[:0] = batch
+                    try:
+                        self._seal_locked(force=True)
+                    except OSError:
+                        log.exception("Failed to rotate log spool segment")
+            self._bytes += len(data)
+            self._durable = upto
+            self.fsyncs += 1
+            if self._bytes >= self.segment_bytes:
+                self._seal_locked()
+        finally:
+            self._flushing = False
+            cond.notify_all()
+
+    # --- 投递端 ---
+    def _seal_if_due(self):
+        cond = self._cond
+        with cond:
+            while self._flushing:
+                cond.wait()
+            if self._bytes > 0 and time.monotonic() - self._opened_at >= self.seal_interval:
+                self._seal_locked()
+
+    def _ship_segment(self, path):
+        """投递一个段；段被其他进程持有或已被删除时返回 False。"""
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return False
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            if not os.path.exists(path):
+                return False  # 拿到锁之前已被别的进程投递并删除
+            rows = []
+            for line in f:
+                try:
+                    rows.append(_decode_row(line))
+                except ValueError:
+                    log.warning("Skipping torn line in log spool segment %s", path)
+            storage = get_storage()
+            inserted = 0
+            rejected = []
+            for i in range(0, len(rows), self.batch_size):
+                n, bad = storage.insert_logs_or_reject(rows[i:i + self.batch_size])
+                inserted += n
+                rejected += bad
+            if rejected:
+                # 先把被拒绝的行落盘，再删除段
+                bad_path = path.rsplit(".", 1)[0] + ".bad"
+                with open(bad_path, "wb") as bad_file:
+                    _run_blocking(_write_durable, bad_file, b"".join(_encode_row(row) for row in rejected))
+                self._fsync_directory()
+                log.error("Database rejected %d rows from log spool segment %s; kept them in %s",
+                          len(rejected), path, bad_path)
+            os.unlink(path)
+        self.segments_shipped += 1
+        self.rows_shipped += inserted
+        self.rows_rejected += len(rejected)
+        self.duplicates_skipped += len(rows) - len(rejected) - inserted
+        return True
+
+    def _quarantine(self, path):
+        bad_path = path.rsplit(".", 1)[0] + ".bad"
+        try:
+            with open(path, "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if not os.path.exists(path):
+                    return
+                os.rename(path, bad_path)
+        except (FileNotFoundError, BlockingIOError):
+            return
+        self._fsync_directory()
+        self.segments_quarantined += 1
+        self._failures.pop(path, None)
+        log.error("Log spool segment %s failed %d times; moved to %s", path, self.max_attempts, bad_path)
+
+    def ship_pending(self):
+        """
+        投递目录中所有可以拿到锁的段，返回投递的段数。
+        以前失败过的段排在最后，一个段失败不影响其他段；本轮还没有任何段投递成功时遇到失败，
+        或者连续两个段失败，就按数据库不可用处理，停止本轮并抛出异常。
+        """
+        active = self._path if self._pid == os.getpid() else None
+        paths = [path for path in glob.glob(os.path.join(self.directory, "*.ready"))
+                 + glob.glob(os.path.join(self.directory, "*.seg")) if path != active]
+        self._failures = {path: n for path, n in self._failures.items() if path in paths}
+        paths.sort(key=lambda path: (path in self._failures, path))
+        shipped = 0
+        failed = []
+        error = None
+        previous_failed = False
+        for path in paths:
+            try:
+                if self._ship_segment(path):
+                    shipped += 1
+                    self._failures.pop(path, None)
+                previous_failed = False
+            except Exception as e:
+                failed.append(path)
+                self._failures.setdefault(path, 0)
+                if not shipped or previous_failed:
+                    error = e
+                    break
+                previous_failed = True
+                self.ship_errors += 1
+                log.error("Failed to ship log spool segment %s: %s", path, e)
+        if shipped:
+            # 数据库可用，这些段是因为自身的内容失败
+            for path in failed:
+                self._failures[path] += 1
+                if self._failures[path] >= self.max_attempts:
+                    self._quarantine(path)
+        if error is not None:
+            raise error
+        return shipped
+
+    def _run_shipper(self):
+        backoff = 0.5
+        while True:
+            time.sleep(min(self.seal_interval, backoff))
+            try:
+                self._seal_if_due()
+                self.ship_pending()
+                backoff = 0.5
+            except Exception as e:
+                self.ship_errors += 1
+                log.error("Failed to ship log spool segments: %s", e)
+                backoff = min(backoff * 2, 30)
+                time.sleep(backoff)
+            try:
+                get_storage().ensure_log_partitions()
+            except Exception as e:
+                log.error("Failed to create future log partitions: %s", e)
+
+    def stats(self):
+        pending = len(glob.glob(os.path.join(self.directory, "*.ready")))
+        bad = len(glob.glob(os.path.join(self.directory, "*.bad")))
+        return {
+            "events_appended": self.events_appended,
+            "fsyncs": self.fsyncs,
+            "segments_shipped": self.segments_shipped,
+            "rows_shipped": self.rows_shipped,
+            "duplicates_skipped": self.duplicates_skipped,
+            "rows_rejected": self.rows_rejected,
+            "segments_quarantined": self.segments_quarantined,
+            "ship_errors": self.ship_errors,
+            "pending_segments": pending,
+            "bad_files": bad,
+        }
+
+    def flush(self):
+        """进程退出前封存活动段并尽量投递；投递失败的段留在磁盘上，下次启动时重放。"""
+        if self._pid != os.getpid():
+            return
+        try:
+            with self._cond:
+                while self._flushing:
+                    self._cond.wait()
+                self._seal_locked()
+            self.ship_pending()
+            with self._cond:
+                # 不留下空的活动段
+                self._file.close()
+                os.unlink(self._path)
+                self._pid = None
+        except Exception as e:
+            log.error("Log spool segments left for replay at shutdown: %s", e)
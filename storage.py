@@ -0,0 +1,955 @@
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+import pymysql
+
+import db
+from progress import PROGRESS_COLUMNS, backfill_rows, rollup_deltas
+from textstore import FETCH_BATCH, content_hash, fetch_many, split_contents, text_cache, text_row
+
+# ------------------ 存储后端 ------------------
+# 应用、导入、压测只通过 Storage 接口访问 queries / documents / orders / logs / app_meta。
+#   STORAGE_BACKEND=mysql   （默认）MYSQL_URL 指向的 MySQL，连接来自 db 连接池
+#   STORAGE_BACKEND=sqlite  本地 SQLite 文件（SQLITE_PATH，默认 study.db），WAL 模式，
+#                           适合单机预实验、压测和测试，不需要数据库服务器
+#   SQLITE_SIMULATED_LATENCY_MS  压测用：SQLite 后端每次存储调用前等待这么多毫秒，模拟网络数据库的
+#                                往返（默认 0）。等待期间不持有任何锁，用来比较不同 worker 模式的并发上限
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "mysql").lower()
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "study.db")
+SQLITE_SIMULATED_LATENCY_MS = float(os.environ.get("SQLITE_SIMULATED_LATENCY_MS", "0"))
+
+LOG_COLUMNS = ("user_id", "qid", "docno", "event_type", "start_idx", "end_idx",
+               "duration", "pass_flag", "timestamp", "event_key")
+# 日志写入线程每隔这么多秒检查一次是否需要预建 logs 的未来分区（仅 MySQL）
+LOG_PARTITION_CHECK_INTERVAL = float(os.environ.get("LOG_PARTITION_CHECK_INTERVAL", "3600"))
+
+# 日志导出：logs 左连接 orders（该用户在该查询上看到的顺序）和 documents（按 qid + docno），
+# doc_content 先查出 content_hash，再由 Storage._export_with_content 换成正文
+EXPORT_COLUMNS = ("id",) + LOG_COLUMNS + ("doc_id", "doc_order", "doc_content")
+_EXPORT_SELECT = """
+    SELECT l.id, l.user_id, l.qid, l.docno, l.event_type, l.start_idx, l.end_idx,
+           l.duration, l.pass_flag, l.timestamp, l.event_key,
+           d.id, o.doc_order, {content}
+    FROM logs l
+    LEFT JOIN orders o ON o.user_id = l.user_id AND o.query_id = l.qid
+    LEFT JOIN documents d ON d.qid = l.qid AND d.docno = l.docno
+    WHERE l.id > {param} AND l.id <= {param}
+    ORDER BY l.id
+"""
+
+# insert_logs 抛出这些异常时是批里有写不进去的行（NOT NULL、越界、超长、无法绑定的类型，
+# 或 rollup_deltas 里 int() 失败），重试整批也不会成功；其他异常（连接断开、锁等待超时）按数据库暂时不可用处理
+LOG_ROW_ERRORS = (pymysql.err.DataError, pymysql.err.IntegrityError, sqlite3.IntegrityError,
+                  sqlite3.DataError, sqlite3.InterfaceError, TypeError, ValueError)
+
+
+def _unique_by_key(rows):
+    """同一批里重复的 event_key 只保留第一条。"""
+    seen = set()
+    unique = []
+    for row in rows:
+        if row[-1] not in seen:
+            seen.add(row[-1])
+            unique.append(row)
+    return unique
+
+
+class LockTimeout(RuntimeError):
+    """Storage.lock 在 timeout 秒内没有拿到锁。"""
+
+
+class Storage:
+    """存储接口；行以 dict（或支持 row["列名"] 的对象）返回。"""
+
+    name = None
+    _partitions_checked_at = float("-inf")
+
+    # --- 结构 ---
+    def ensure_schema(self):
+        """创建/升级表结构，返回结构版本号。"""
+        raise NotImplementedError
+
+    def schema_version(self):
+        raise NotImplementedError
+
+    @contextmanager
+    def lock(self, name, timeout):
+        """跨进程互斥锁（loader 使用）；MySQL 后端 yield 持锁的连接。"""
+        raise NotImplementedError
+        yield
+
+    # --- app_meta ---
+    def get_meta(self, key):
+        raise NotImplementedError
+
+    def set_meta(self, key, value):
+        raise NotImplementedError
+
+    def meta_items(self, prefix):
+        """返回所有以 prefix 开头的 {key: value}。"""
+        raise NotImplementedError
+
+    def corpus_version(self):
+        value = self.get_meta("corpus_version")
+        return int(value) if value is not None else 0
+
+    def bump_corpus_version(self):
+        """导入/清空语料后调用，使所有 worker 的语料缓存失效。"""
+        raise NotImplementedError
+
+    # --- 语料 ---
+    def load_corpus(self):
+        """返回 (version, queries, documents)；queries 按 id 排序，documents 按 (qid, id) 排序。"""
+        raise NotImplementedError
+
+    def clear_corpus(self):
+        raise NotImplementedError
+
+    def existing_query_ids(self):
+        raise NotImplementedError
+
+    def max_document_id(self):
+        raise NotImplementedError
+
+    def insert_queries(self, rows):
+        """rows: [(id, content), ...]，单个事务。"""
+        raise NotImplementedError
+
+    def insert_documents(self, rows):
+        """rows: [(id, qid, docno, content_hash), ...]，单个事务；正文先由 store_texts 写入。"""
+        raise NotImplementedError
+
+    def query_document_counts(self):
+        """返回 [(query_id, 文档数), ...]，按 query_id 排序。"""
+        raise NotImplementedError
+
+    # --- 文档正文（texts 表，见 textstore.py） ---
+    def insert_texts(self, rows):
+        """rows: [(hash, codec, size, body), ...]，已存在的 hash 被忽略。"""
+        raise NotImplementedError
+
+    def existing_text_hashes(self, hashes):
+        """hashes 中已经在 texts 表里的那些（set）。"""
+        raise NotImplementedError
+
+    def fetch_texts(self, hashes):
+        """返回 {hash: (codec, body)}。"""
+        raise NotImplementedError
+
+    def prune_texts(self):
+        """删除没有任何文档引用的正文，返回删除的行数。"""
+        raise NotImplementedError
+
+    def store_texts(self, texts):
+        """
+        正文列表 -> (对应的 content_hash 列表, 新写入的正文数)，None 对应 None。
+        只有 texts 表里还没有的正文才会被压缩并写入，其余只传 hash。
+        """
+        hashes = [content_hash(text) if text is not None else None for text in texts]
+        unique = {h: text for h, text in zip(hashes, texts) if h is not None}
+        if not unique:
+            return hashes, 0
+        existing = self.existing_text_hashes(list(unique))
+        rows = [text_row(text) for h, text in unique.items() if h not in existing]
+        if rows:
+            self.insert_texts(rows)
+        return hashes, len(rows)
+
+    def resolve_texts(self, hashes):
+        """{hash: 正文}，经过进程内的 LRU 缓存。"""
+        return text_cache.get_many([h for h in hashes if h is not None], self.fetch_texts)
+
+    def _with_content(self, documents):
+        # documents 行（id, qid, docno, content_hash）-> 带 content 的 dict。
+        # 整个语料一次性读出，由调用方（语料缓存）打包保存，不经过 text_cache，否则每篇正文在进程里存两份
+        texts = fetch_many(list({row["content_hash"] for row in documents} - {None}), self.fetch_texts)
+        return [{"id": row["id"], "qid": row["qid"], "docno": row["docno"],
+                 "content": texts.get(row["content_hash"])} for row in documents]
+
+    def _export_with_content(self, rows):
+        # 导出行的最后一列是 content_hash，换成正文
+        texts = self.resolve_texts([row[-1] for row in rows])
+        return [tuple(row[:-1]) + (texts.get(row[-1]),) for row in rows]
+
+    # --- 排序与日志 ---
+    def save_orders(self, rows):
+        """rows: [(user_id, query_id, doc_order), ...]，一次往返写入（已存在则覆盖）。"""
+        raise NotImplementedError
+
+    def assign_slot(self, user_id):
+        """
+        返回参与者的分配序号（0 起始）。新参与者按登录顺序原子地取下一个序号，
+        返回的参与者沿用原来的序号。
+        """
+        raise NotImplementedError
+
+    def slot_counts(self, n_rows):
+        """每个拉丁方行（slot mod n_rows）分到的参与者数，长度为 n_rows 的列表。"""
+        raise NotImplementedError
+
+    def insert_logs(self, rows):
+        """
+        rows: LOG_COLUMNS 顺序的元组列表。单个事务内过滤掉 event_key 已存在的行（可以安全重放），
+        插入其余的行并把它们累加到 participant_progress（见 progress.py）。返回实际插入的行数。
+        """
+        raise NotImplementedError
+
+    def insert_logs_or_reject(self, rows):
+        """
+        与 insert_logs 相同，但批里有写不进去的行（LOG_ROW_ERRORS）时对半拆开重试，只挑出这些行。
+        返回 (实际插入的行数, 被拒绝的行列表)；其他异常照常抛出，由调用方稍后重试整批。
+        """
+        try:
+            return self.insert_logs(rows), []
+        except LOG_ROW_ERRORS:
+            if len(rows) <= 1:
+                return 0, list(rows)
+        mid = len(rows) // 2
+        left, left_rejected = self.insert_logs_or_reject(rows[:mid])
+        right, right_rejected = self.insert_logs_or_reject(rows[mid:])
+        return left + right, left_rejected + right_rejected
+
+    def progress_rows(self):
+        """participant_progress 的全部行（dict，PROGRESS_COLUMNS）。"""
+        raise NotImplementedError
+
+    def ensure_log_partitions(self, interval=LOG_PARTITION_CHECK_INTERVAL):
+        """
+        日志写入线程定期调用：距上次检查超过 interval 秒时预建未来几个月的 logs 分区，
+        返回新建的分区名。实验持续时间超过 LOG_PARTITION_MONTHS_AHEAD 也不会写进 pmax。
+        MySQL 上同时删除超过保留窗口的 log_keys。失败时异常交给调用方记录，
+        检查时间只在成功后更新，下次调用会重试。
+        """
+        now = time.monotonic()
+        if now - self._partitions_checked_at < interval:
+            return []
+        created = self._ensure_log_partitions()
+        self._partitions_checked_at = now
+        return created
+
+    def _ensure_log_partitions(self):
+        return []
+
+    def max_log_id(self):
+        """logs 中已提交的最大 id，没有日志时为 0。"""
+        raise NotImplementedError
+
+    def iter_log_export(self, after_id, until_id, chunk_rows, with_content=False):
+        """
+        按 id 顺序流式读取 after_id < id <= until_id 的日志及其连接结果，每次产出不超过 chunk_rows 行
+        （EXPORT_COLUMNS 顺序的元组），内存占用与日志总量无关。
+        """
+        raise NotImplementedError
+
+    def selection_events(self, event_types, qid=None):
+        """
+        指定类型的事件 (user_id, qid, docno, event_type, start_idx, end_idx)，
+        按事件时间（timestamp，其次 id）排序；qid 为 None 时返回所有查询。
+        """
+        raise NotImplementedError
+
+    def query_participants(self, qid=None):
+        """在各查询上留下过任何事件的 (user_id, qid)。"""
+        raise NotImplementedError
+
+    def load_orders(self):
+        """orders 的全部行 (user_id, query_id, doc_order)，doc_order 为逗号分隔的文档 ID。"""
+        raise NotImplementedError
+
+    def log_durations(self, limit):
+        """最近 limit 条 duration > 0 的 (event_type, duration)，供压测抽样。"""
+        raise NotImplementedError
+
+
+# ------------------ MySQL ------------------
+class MySQLStorage(Storage):
+    name = "mysql"
+
+    @contextmanager
+    def _cursor(self, commit=False):
+        conn = db.get_connection()
+        try:
+            with conn.cursor() as c:
+                yield c
+            if commit:
+                conn.commit()
+        except Exception:
+            if commit:
+                conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def ensure_schema(self):
+        from migrations import migrate
+        return migrate()
+
+    def schema_version(self):
+        from migrations import current_version
+        with self._cursor() as c:
+            return current_version(c)
+
+    @contextmanager
+    def lock(self, name, timeout):
+        # 命名锁绑定在会话上，所以在持锁期间单独占用一个连接；yield 这个连接，
+        # 持锁期间的语句可以直接在它上面执行，不必再从池里借第二个
+        conn = db.get_connection()
+        try:
+            with conn.cursor() as c:
+                c.execute("SELECT GET_LOCK(%s, %s) AS locked", (name, timeout))
+                row = c.fetchone()
+            if not row or row["locked"] != 1:
+                raise LockTimeout(f"无法在 {timeout} 秒内获得锁 {name}")
+            try:
+                yield conn
+            finally:
+                with conn.cursor() as c:
+                    c.execute("SELECT RELEASE_LOCK(%s)", (name,))
+        finally:
+            conn.close()
+
+    def get_meta(self, key):
+        with self._cursor() as c:
+            c.execute("SELECT meta_value FROM app_meta WHERE meta_key=%s", (key,))
+            row = c.fetchone()
+            return row["meta_value"] if row else None
+
+    def set_meta(self, key, value):
+        with self._cursor(commit=True) as c:
+            c.execute("REPLACE INTO app_meta (meta_key, meta_value) VALUES (%s, %s)", (key, str(value)))
+
+    def meta_items(self, prefix):
+        pattern = prefix.replace("\\", "\\\\").replace("_", "\\_").replace("%", "\\%") + "%"
+        with self._cursor() as c:
+            c.execute("SELECT meta_key, meta_value FROM app_meta WHERE meta_key LIKE %s", (pattern,))
+            return {row["meta_key"]: row["meta_value"] for row in c.fetchall()}
+
+    def bump_corpus_version(self):
+        with self._cursor(commit=True) as c:
+            c.execute("""
+                INSERT INTO app_meta (meta_key, meta_value) VALUES ('corpus_version', '1')
+                ON DUPLICATE KEY UPDATE meta_value = CAST(meta_value AS UNSIGNED) + 1
+            """)
+
+    def load_corpus(self):
+        with self._cursor() as c:
+            c.execute("SELECT meta_value FROM app_meta WHERE meta_key='corpus_version'")
+            row = c.fetchone()
+            version = int(row["meta_value"]) if row else 0
+            c.execute("SELECT id, content FROM queries ORDER BY id")
+            queries = c.fetchall()
+            c.execute("SELECT id, qid, docno, content_hash FROM documents ORDER BY qid, id")
+            documents = c.fetchall()
+        return version, queries, self._with_content(documents)
+
+    def clear_corpus(self):
+        with self._cursor(commit=True) as c:
+            c.execute("DELETE FROM documents")
+            c.execute("DELETE FROM queries")
+        self.bump_corpus_version()
+
+    def existing_query_ids(self):
+        with self._cursor() as c:
+            c.execute("SELECT id FROM queries")
+            return {row["id"] for row in c.fetchall()}
+
+    def max_document_id(self):
+        with self._cursor() as c:
+            c.execute("SELECT MAX(id) AS max_id FROM documents")
+            row = c.fetchone()
+            return row["max_id"] if row and row["max_id"] is not None else 0
+
+    def insert_queries(self, rows):
+        with self._cursor(commit=True) as c:
+            c.executemany("INSERT INTO queries (id, content) VALUES (%s, %s)", rows)
+
+    def insert_documents(self, rows):
+        with self._cursor(commit=True) as c:
+            c.executemany("INSERT INTO documents (id, qid, docno, content_hash) VALUES (%s, %s, %s, %s)", rows)
+
+    def insert_texts(self, rows):
+        with self._cursor(commit=True) as c:
+            c.executemany("INSERT IGNORE INTO texts (hash, codec, size, body) VALUES (%s, %s, %s, %s)", rows)
+
+    def existing_text_hashes(self, hashes):
+        existing = set()
+        with self._cursor() as c:
+            for i in range(0, len(hashes), FETCH_BATCH):
+                batch = hashes[i:i + FETCH_BATCH]
+                c.execute(f"SELECT hash FROM texts WHERE hash IN ({', '.join(['%s'] * len(batch))})", batch)
+                existing.update(row["hash"] for row in c.fetchall())
+        return existing
+
+    def fetch_texts(self, hashes):
+        if not hashes:
+            return {}
+        with self._cursor() as c:
+            c.execute(f"SELECT hash, codec, body FROM texts WHERE hash IN ({', '.join(['%s'] * len(hashes))})",
+                      list(hashes))
+            return {row["hash"]: (row["codec"], row["body"]) for row in c.fetchall()}
+
+    def prune_texts(self):
+        with self._cursor(commit=True) as c:
+            c.execute("DELETE t FROM texts t LEFT JOIN documents d ON d.content_hash = t.hash WHERE d.id IS NULL")
+            return c.rowcount
+
+    def load_documents_file(self, path):
+        """LOAD DATA LOCAL INFILE 导入 TSV（id, qid, docno, content_hash），需要单独的 local_infile 连接。"""
+        conn = db.connect_direct(local_infile=True)
+        try:
+            with conn.cursor() as c:
+                c.execute(
+                    "LOAD DATA LOCAL INFILE %s INTO TABLE documents CHARACTER SET utf8mb4 "
+                    "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+                    "(id, qid, docno, content_hash)", (path,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def query_document_counts(self):
+        with self._cursor() as c:
+            c.execute("""
+                SELECT q.id AS qid, COUNT(d.id) AS doc_count
+                FROM queries q LEFT JOIN documents d ON d.qid = q.id
+                GROUP BY q.id ORDER BY q.id
+            """)
+            return [(row["qid"], row["doc_count"]) for row in c.fetchall()]
+
+    def save_orders(self, rows):
+        # PyMySQL 把 INSERT/REPLACE ... VALUES 的 executemany 合并成一条多行语句
+        with self._cursor(commit=True) as c:
+            c.executemany("REPLACE INTO orders (user_id, query_id, doc_order) VALUES (%s, %s, %s)", rows)
+
+    def assign_slot(self, user_id):
+        conn = db.get_connection()
+        try:
+            with conn.cursor() as c:
+                c.execute("SELECT slot FROM participant_rows WHERE user_id=%s", (user_id,))
+                row = c.fetchone()
+                if row:
+                    return row["slot"] - 1
+                # 先查再插，避免回访用户的 INSERT IGNORE 也消耗一个自增值造成空洞
+                c.execute("INSERT IGNORE INTO participant_rows (user_id, assigned_at) VALUES (%s, %s)",
+                          (user_id, datetime.now()))
+                slot = c.lastrowid if c.rowcount == 1 else None
+                conn.commit()
+                if slot is None:
+                    # 同一用户在另一个 worker 上同时登录并先插入了；提交后的新快照能读到它
+                    c.execute("SELECT slot FROM participant_rows WHERE user_id=%s", (user_id,))
+                    slot = c.fetchone()["slot"]
+                return slot - 1
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def slot_counts(self, n_rows):
+        with self._cursor() as c:
+            c.execute("SELECT MOD(slot - 1, %s) AS row_index, COUNT(*) AS n "
+                      "FROM participant_rows GROUP BY row_index", (n_rows,))
+            counts = [0] * n_rows
+            for row in c.fetchall():
+                counts[row["row_index"]] = row["n"]
+            return counts
+
+    def insert_logs(self, rows):
+        # 分区的 logs 上唯一键必须包含分区列 timestamp，而 timestamp 取自服务器接收时间，客户端重发的
+        # 同一事件时间戳不同，所以 logs 上没有 event_key 唯一索引，去重由不分区的 log_keys 表完成：
+        # 本事务用一个随机 claim 认领各 event_key，并发事务插入同一个键时会等待先插入的事务提交后被 IGNORE，
+        # 之后只有认领成功的行写入 logs 和汇总。键按排序后的顺序认领，避免两个事务交叉加锁而死锁；
+        # logs 仍按原顺序插入，同一批内 id 的先后与事件顺序一致。
+        # log_keys 只保留 LOG_KEY_RETENTION_DAYS 天内认领的键（partitions.prune_log_keys），大小有上限。
+        rows = _unique_by_key(rows)
+        claim = uuid.uuid4().hex
+        with self._cursor(commit=True) as c:
+            keys = sorted(row[-1] for row in rows if row[-1] is not None)
+            claimed = set()
+            if keys:
+                c.executemany("INSERT IGNORE INTO log_keys (event_key, claim) VALUES (%s, %s)",
+                              [(key, claim) for key in keys])
+                c.execute(f"SELECT event_key FROM log_keys WHERE event_key IN ({', '.join(['%s'] * len(keys))}) "
+                          f"AND claim = %s", keys + [claim])
+                claimed = {r["event_key"] for r in c.fetchall()}
+            rows = [row for row in rows if row[-1] is None or row[-1] in claimed]
+            if not rows:
+                return 0
+            # 认领成功的键不会已经在 logs 里（迁移 9 已回填 log_keys）
+            c.executemany(f"""
+                INSERT INTO logs ({", ".join(LOG_COLUMNS)})
+                VALUES ({", ".join(["%s"] * len(LOG_COLUMNS))})
+            """, rows)
+            c.executemany(f"""
+                INSERT INTO participant_progress ({", ".join(PROGRESS_COLUMNS)})
+                VALUES ({", ".join(["%s"] * len(PROGRESS_COLUMNS))})
+                ON DUPLICATE KEY UPDATE
+                    events = events + VALUES(events),
+                    time_on_task_ms = time_on_task_ms + VALUES(time_on_task_ms),
+                    passage_selections = passage_selections + VALUES(passage_selections),
+                    unselects = unselects + VALUES(unselects),
+                    pause_ms = pause_ms + VALUES(pause_ms),
+                    first_event_at = LEAST(COALESCE(first_event_at, VALUES(first_event_at)),
+                                           COALESCE(VALUES(first_event_at), first_event_at)),
+                    last_event_at = GREATEST(COALESCE(last_event_at, VALUES(last_event_at)),
+                                             COALESCE(VALUES(last_event_at), last_event_at))
+            """, rollup_deltas(rows))
+            return len(rows)
+
+    def progress_rows(self):
+        with self._cursor() as c:
+            c.execute(f"SELECT {', '.join(PROGRESS_COLUMNS)} FROM participant_progress")
+            return c.fetchall()
+
+    def _ensure_log_partitions(self):
+        from partitions import ensure_future_partitions, prune_log_keys
+        # DDL 在持有命名锁的同一个连接上执行：sync worker 的池只有 2 个连接，
+        # 投递线程同时占用两个会让请求等待 DB_POOL_TIMEOUT
+        try:
+            with self.lock("log_partitions", 0) as conn, conn.cursor() as c:
+                prune_log_keys(c)
+                return ensure_future_partitions(c)
+        except LockTimeout:
+            return []  # 另一个 worker 正在检查
+
+    def max_log_id(self):
+        with self._cursor() as c:
+            c.execute("SELECT MAX(id) AS max_id FROM logs")
+            return c.fetchone()["max_id"] or 0
+
+    def iter_log_export(self, after_id, until_id, chunk_rows, with_content=False):
+        # 无缓冲的服务器端游标：行在 fetchmany 时才从网络读取，不会一次性进入客户端内存。
+        # 读取期间这个连接不能执行其他语句，所以不从连接池借，单独建立
+        conn = db.connect_direct(cursorclass=pymysql.cursors.SSCursor)
+        try:
+            with conn.cursor() as c:
+                # 客户端写文件较慢时，避免服务器因等待发送超时断开
+                c.execute("SET SESSION net_write_timeout = 600")
+                c.execute(_EXPORT_SELECT.format(content="d.content_hash" if with_content else "NULL",
+                                                param="%s"), (after_id, until_id))
+                while True:
+                    rows = c.fetchmany(chunk_rows)
+                    if not rows:
+                        break
+                    yield self._export_with_content(rows) if with_content else rows
+        finally:
+            conn.close()
+
+    def selection_events(self, event_types, qid=None):
+        sql = ("SELECT user_id, qid, docno, event_type, start_idx, end_idx FROM logs "
+               "WHERE event_type IN ({})".format(", ".join(["%s"] * len(event_types))))
+        args = list(event_types)
+        if qid is not None:
+            sql += " AND qid = %s"
+            args.append(qid)
+        with self._cursor() as c:
+            c.execute(sql + " ORDER BY timestamp, id", args)
+            return [(row["user_id"], row["qid"], row["docno"], row["event_type"],
+                     row["start_idx"], row["end_idx"]) for row in c.fetchall()]
+
+    def query_participants(self, qid=None):
+        with self._cursor() as c:
+            if qid is None:
+                c.execute("SELECT DISTINCT user_id, qid FROM logs")
+            else:
+                c.execute("SELECT DISTINCT user_id, qid FROM logs WHERE qid = %s", (qid,))
+            return [(row["user_id"], row["qid"]) for row in c.fetchall()]
+
+    def load_orders(self):
+        with self._cursor() as c:
+            c.execute("SELECT user_id, query_id, doc_order FROM orders")
+            return [(row["user_id"], row["query_id"], row["doc_order"]) for row in c.fetchall()]
+
+    def log_durations(self, limit):
+        with self._cursor() as c:
+            c.execute("SELECT event_type, duration FROM logs WHERE duration > 0 ORDER BY id DESC LIMIT %s",
+                      (limit,))
+            return [(row["event_type"], row["duration"]) for row in c.fetchall()]
+
+
+# ------------------ SQLite (WAL) ------------------
+# SQLite 没有表分区：迁移 7 的 logs 按月分区及 partitions.py 的归档只适用于 MySQL，
+# 这里 logs 仍是一张表，event_key 上的唯一索引保持不变，也不需要 MySQL 的 log_keys 表。
+SQLITE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS logs (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id TEXT NOT NULL,
+      qid INTEGER DEFAULT 0,
+      docno TEXT DEFAULT '',
+      event_type TEXT NOT NULL,
+      start_idx INTEGER DEFAULT -1,
+      end_idx INTEGER DEFAULT -1,
+      duration INTEGER DEFAULT 0,
+      pass_flag INTEGER DEFAULT 0,
+      timestamp TEXT,
+      event_key TEXT
+    )
+    ''',
+    "CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, qid INTEGER, docno TEXT, content_hash TEXT)",
+    "CREATE TABLE IF NOT EXISTS texts (hash TEXT PRIMARY KEY, codec TEXT NOT NULL, size INTEGER NOT NULL, "
+    "body BLOB NOT NULL)",
+    '''
+    CREATE TABLE IF NOT EXISTS orders (
+      user_id TEXT NOT NULL,
+      query_id INTEGER NOT NULL,
+      doc_order TEXT,
+      PRIMARY KEY (user_id, query_id)
+    )
+    ''',
+    "CREATE TABLE IF NOT EXISTS queries (id INTEGER PRIMARY KEY, content TEXT)",
+    "CREATE TABLE IF NOT EXISTS app_meta (meta_key TEXT PRIMARY KEY, meta_value TEXT)",
+    '''
+    CREATE TABLE IF NOT EXISTS participant_progress (
+      user_id TEXT NOT NULL,
+      qid INTEGER NOT NULL,
+      events INTEGER DEFAULT 0,
+      time_on_task_ms INTEGER DEFAULT 0,
+      passage_selections INTEGER DEFAULT 0,
+      unselects INTEGER DEFAULT 0,
+      pause_ms INTEGER DEFAULT 0,
+      first_event_at TEXT,
+      last_event_at TEXT,
+      PRIMARY KEY (user_id, qid)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS participant_rows (
+      slot INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id TEXT NOT NULL UNIQUE,
+      assigned_at TEXT
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_documents_qid_id ON documents (qid, id)",
+    "CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents (content_hash)",
+    "CREATE INDEX IF NOT EXISTS idx_logs_user_qid_ts ON logs (user_id, qid, timestamp)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_logs_event_key ON logs (event_key)",
+    "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT, applied_at TEXT)",
+]
+
+
+def _sqlite_value(value):
+    # datetime 统一存成 ISO 字符串，避免依赖 sqlite3 默认适配器
+    return value.isoformat(sep=" ") if hasattr(value, "isoformat") else value
+
+
+class SQLiteStorage(Storage):
+    """
+    每个线程一个连接（fork 之后重新打开）。WAL 模式下读写互不阻塞，
+    synchronous=NORMAL 时提交只写 WAL 不做 fsync，写入通常在亚毫秒级。
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path=SQLITE_PATH, busy_timeout_ms=5000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+
+    def _conn(self):
+        local = self._local
+        if getattr(local, "conn", None) is None or local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000.0)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            local.conn = conn
+            local.pid = os.getpid()
+        if SQLITE_SIMULATED_LATENCY_MS:
+            time.sleep(SQLITE_SIMULATED_LATENCY_MS / 1000.0)
+        return local.conn
+
+    def _execute(self, sql, args=(), many=False, commit=False):
+        conn = self._conn()
+        started = time.perf_counter()
+        try:
+            if many:
+                cursor = conn.executemany(sql, args)
+            else:
+                cursor = conn.execute(sql, args)
+            rows = cursor.fetchall()
+            if commit:
+                conn.commit()
+            return rows
+        except Exception:
+            if commit:
+                conn.rollback()
+            raise
+        finally:
+            db.report_query_time(time.perf_counter() - started)
+
+    def ensure_schema(self):
+        # SQLite 不走 migrations.py：SQLITE_SCHEMA 直接建成最新结构，并记为 LATEST_VERSION
+        from migrations import LATEST_VERSION
+        conn = self._conn()
+        with conn:
+            # 早期 SQLite 库的 logs 表没有 event_key 列，建索引前补上
+            columns = [row["name"] for row in conn.execute("PRAGMA table_info(logs)")]
+            if columns and "event_key" not in columns:
+                conn.execute("ALTER TABLE logs ADD COLUMN event_key TEXT")
+            # 早期的 documents 表直接存正文（content 列），建表后搬到 texts
+            doc_columns = [row["name"] for row in conn.execute("PRAGMA table_info(documents)")]
+            if doc_columns and "content_hash" not in doc_columns:
+                conn.execute("ALTER TABLE documents ADD COLUMN content_hash TEXT")
+            had_progress = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' "
+                                        "AND name='participant_progress'").fetchone()
+            for statement in SQLITE_SCHEMA:
+                conn.execute(statement)
+            if not had_progress:
+                self._backfill_progress(conn)
+            if "content" in doc_columns:
+                texts, updates = split_contents(conn.execute(
+                    "SELECT id, content FROM documents WHERE content IS NOT NULL").fetchall())
+                conn.executemany("INSERT OR IGNORE INTO texts (hash, codec, size, body) VALUES (?, ?, ?, ?)", texts)
+                conn.executemany("UPDATE documents SET content_hash = ? WHERE id = ?", updates)
+                conn.execute("ALTER TABLE documents DROP COLUMN content")
+            conn.execute("INSERT OR IGNORE INTO schema_version (version, description, applied_at) "
+                         "VALUES (?, 'sqlite schema', datetime('now'))", (LATEST_VERSION,))
+        return self.schema_version()
+
+    @staticmethod
+    def _backfill_progress(conn):
+        """用现有 logs 回填 participant_progress（与 insert_logs 的增量同一套规则，见 progress.py）"""
+        def fetch_after(after_id, limit):
+            return [tuple(r) for r in conn.execute(
+                f"SELECT id, {', '.join(LOG_COLUMNS)} FROM logs WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, limit))]
+
+        conn.executemany(f"""
+            INSERT INTO participant_progress ({", ".join(PROGRESS_COLUMNS)})
+            VALUES ({", ".join(["?"] * len(PROGRESS_COLUMNS))})
+        """, [tuple(_sqlite_value(v) for v in row) for row in backfill_rows(fetch_after)])
+
+    def schema_version(self):
+        rows = self._execute("SELECT name FROM sqlite_master WHERE type='table' AND name='schema_version'")
+        if not rows:
+            return 0
+        return self._execute("SELECT MAX(version) AS v FROM schema_version")[0]["v"] or 0
+
+    @contextmanager
+    def lock(self, name, timeout):
+        with open(f"{self.path}.{name}.lock", "w") as f:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        raise LockTimeout(f"无法在 {timeout} 秒内获得锁 {name}")
+                    time.sleep(0.1)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get_meta(self, key):
+        rows = self._execute("SELECT meta_value FROM app_meta WHERE meta_key=?", (key,))
+        return rows[0]["meta_value"] if rows else None
+
+    def set_meta(self, key, value):
+        self._execute("REPLACE INTO app_meta (meta_key, meta_value) VALUES (?, ?)", (key, str(value)),
+                      commit=True)
+
+    def meta_items(self, prefix):
+        rows = self._execute("SELECT meta_key, meta_value FROM app_meta WHERE substr(meta_key, 1, ?) = ?",
+                             (len(prefix), prefix))
+        return {row["meta_key"]: row["meta_value"] for row in rows}
+
+    def bump_corpus_version(self):
+        self._execute("""
+            INSERT INTO app_meta (meta_key, meta_value) VALUES ('corpus_version', '1')
+            ON CONFLICT(meta_key) DO UPDATE SET meta_value = CAST(meta_value AS INTEGER) + 1
+        """, commit=True)
+
+    def load_corpus(self):
+        version = self.corpus_version()
+        queries = self._execute("SELECT id, content FROM queries ORDER BY id")
+        documents = self._execute("SELECT id, qid, docno, content_hash FROM documents ORDER BY qid, id")
+        return version, queries, self._with_content(documents)
+
+    def clear_corpus(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM documents")
+            conn.execute("DELETE FROM queries")
+        self.bump_corpus_version()
+
+    def existing_query_ids(self):
+        return {row["id"] for row in self._execute("SELECT id FROM queries")}
+
+    def max_document_id(self):
+        rows = self._execute("SELECT MAX(id) AS max_id FROM documents")
+        return rows[0]["max_id"] if rows and rows[0]["max_id"] is not None else 0
+
+    def insert_queries(self, rows):
+        self._execute("INSERT INTO queries (id, content) VALUES (?, ?)", rows, many=True, commit=True)
+
+    def insert_documents(self, rows):
+        self._execute("INSERT INTO documents (id, qid, docno, content_hash) VALUES (?, ?, ?, ?)", rows,
+                      many=True, commit=True)
+
+    def insert_texts(self, rows):
+        self._execute("INSERT OR IGNORE INTO texts (hash, codec, size, body) VALUES (?, ?, ?, ?)", rows,
+                      many=True, commit=True)
+
+    def existing_text_hashes(self, hashes):
+        existing = set()
+        for i in range(0, len(hashes), FETCH_BATCH):
+            batch = hashes[i:i + FETCH_BATCH]
+            existing.update(row["hash"] for row in self._execute(
+                f"SELECT hash FROM texts WHERE hash IN ({', '.join(['?'] * len(batch))})", batch))
+        return existing
+
+    def fetch_texts(self, hashes):
+        if not hashes:
+            return {}
+        rows = self._execute(f"SELECT hash, codec, body FROM texts WHERE hash IN ({', '.join(['?'] * len(hashes))})",
+                             list(hashes))
+        return {row["hash"]: (row["codec"], row["body"]) for row in rows}
+
+    def prune_texts(self):
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute("DELETE FROM texts WHERE NOT EXISTS "
+                                  "(SELECT 1 FROM documents d WHERE d.content_hash = texts.hash)")
+        return cursor.rowcount
+
+    def query_document_counts(self):
+        rows = self._execute("""
+            SELECT q.id AS qid, COUNT(d.id) AS doc_count
+            FROM queries q LEFT JOIN documents d ON d.qid = q.id
+            GROUP BY q.id ORDER BY q.id
+        """)
+        return [(row["qid"], row["doc_count"]) for row in rows]
+
+    def save_orders(self, rows):
+        self._execute("REPLACE INTO orders (user_id, query_id, doc_order) VALUES (?, ?, ?)", rows,
+                      many=True, commit=True)
+
+    def assign_slot(self, user_id):
+        rows = self._execute("SELECT slot FROM participant_rows WHERE user_id=?", (user_id,))
+        if rows:
+            return rows[0]["slot"] - 1
+        # 被忽略的 INSERT 也会推进 AUTOINCREMENT，所以和 MySQL 一样先查再插
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO participant_rows (user_id, assigned_at) VALUES (?, ?)",
+                         (user_id, _sqlite_value(datetime.now())))
+            row = conn.execute("SELECT slot FROM participant_rows WHERE user_id=?", (user_id,)).fetchone()
+        return row["slot"] - 1
+
+    def slot_counts(self, n_rows):
+        counts = [0] * n_rows
+        for row in self._execute("SELECT (slot - 1) % ? AS row_index, COUNT(*) AS n FROM participant_rows "
+                                 "GROUP BY row_index", (n_rows,)):
+            counts[row["row_index"]] = row["n"]
+        return counts
+
+    def insert_logs(self, rows):
+        rows = _unique_by_key(rows)
+        conn = self._conn()
+        started = time.perf_counter()
+        try:
+            with conn:
+                # 先取写锁：查重和插入之间没有其他写入者，过滤后的行就是实际插入的行
+                conn.execute("BEGIN IMMEDIATE")
+                keys = [row[-1] for row in rows]
+                existing = {r["event_key"] for r in conn.execute(
+                    f"SELECT event_key FROM logs WHERE event_key IN ({', '.join(['?'] * len(keys))})", keys)}
+                rows = [row for row in rows if row[-1] not in existing]
+                if not rows:
+                    return 0
+                conn.executemany(
+                    f"INSERT OR IGNORE INTO logs ({', '.join(LOG_COLUMNS)}) "
+                    f"VALUES ({', '.join(['?'] * len(LOG_COLUMNS))})",
+                    [tuple(_sqlite_value(v) for v in row) for row in rows])
+                conn.executemany(f"""
+                    INSERT INTO participant_progress ({", ".join(PROGRESS_COLUMNS)})
+                    VALUES ({", ".join(["?"] * len(PROGRESS_COLUMNS))})
+                    ON CONFLICT(user_id, qid) DO UPDATE SET
+                        events = events + excluded.events,
+                        time_on_task_ms = time_on_task_ms + excluded.time_on_task_ms,
+                        passage_selections = passage_selections + excluded.passage_selections,
+                        unselects = unselects + excluded.unselects,
+                        pause_ms = pause_ms + excluded.pause_ms,
+                        first_event_at = MIN(COALESCE(first_event_at, excluded.first_event_at),
+                                             COALESCE(excluded.first_event_at, first_event_at)),
+                        last_event_at = MAX(COALESCE(last_event_at, excluded.last_event_at),
+                                            COALESCE(excluded.last_event_at, last_event_at))
+                """, [tuple(_sqlite_value(v) for v in row) for row in rollup_deltas(rows)])
+            return len(rows)
+        finally:
+            db.report_query_time(time.perf_counter() - started)
+
+    def progress_rows(self):
+        return [dict(row) for row in
+                self._execute(f"SELECT {', '.join(PROGRESS_COLUMNS)} FROM participant_progress")]
+
+    def max_log_id(self):
+        return self._execute("SELECT MAX(id) AS max_id FROM logs")[0]["max_id"] or 0
+
+    def iter_log_export(self, after_id, until_id, chunk_rows, with_content=False):
+        # 单独的连接，避免与本线程的其他语句交错；SQLite 游标本身就是逐行读取的
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000.0)
+        try:
+            cursor = conn.execute(_EXPORT_SELECT.format(content="d.content_hash" if with_content else "NULL",
+                                                        param="?"), (after_id, until_id))
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                yield self._export_with_content(rows) if with_content else rows
+        finally:
+            conn.close()
+
+    def selection_events(self, event_types, qid=None):
+        sql = ("SELECT user_id, qid, docno, event_type, start_idx, end_idx FROM logs "
+               "WHERE event_type IN ({})".format(", ".join(["?"] * len(event_types))))
+        args = list(event_types)
+        if qid is not None:
+            sql += " AND qid = ?"
+            args.append(qid)
+        return [tuple(row) for row in self._execute(sql + " ORDER BY timestamp, id", args)]
+
+    def query_participants(self, qid=None):
+        if qid is None:
+            rows = self._execute("SELECT DISTINCT user_id, qid FROM logs")
+        else:
+            rows = self._execute("SELECT DISTINCT user_id, qid FROM logs WHERE qid = ?", (qid,))
+        return [tuple(row) for row in rows]
+
+    def load_orders(self):
+        return [tuple(row) for row in self._execute("SELECT user_id, query_id, doc_order FROM orders")]
+
+    def log_durations(self, limit):
+        rows = self._execute("SELECT event_type, duration FROM logs WHERE duration > 0 ORDER BY id DESC LIMIT ?",
+                             (limit,))
+        return [(row["event_type"], row["duration"]) for row in rows]
+
+
+# ------------------ 选择后端 ------------------
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """按 STORAGE_BACKEND 返回进程内唯一的存储后端。"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if STORAGE_BACKEND == "sqlite":
+                    _storage = SQLiteStorage()
+                elif STORAGE_BACKEND == "mysql":
+                    _storage = MySQLStorage()
+                else:
+                    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return _storage
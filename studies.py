@@ -0,0 +1,42 @@
+import json
+import os
+from collections import namedtuple
+
+# ------------------ 实验配置 ------------------
+# studies.json 里为每个实验命名一个数据集文件和查询切片：
+#   csv           数据集 CSV（qid, query, docno, text 列），相对 studies.json 所在目录
+#   skip_queries  跳过 CSV 中前 N 个查询（按首次出现顺序）
+#   max_queries   （可选）之后最多保留的查询数
+# 当前实验由 STUDY 环境变量选择（loader --study 可覆盖），未设置时用 studies.json 的 "default"。
+
+STUDIES_FILE = os.environ.get("STUDIES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           "studies.json"))
+STUDY = os.environ.get("STUDY", "")
+
+Study = namedtuple("Study", ["name", "csv", "skip_queries", "max_queries", "description"])
+
+
+def load_studies(path=STUDIES_FILE):
+    """返回 (默认实验名, {实验名: Study})。"""
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    studies = {}
+    for name, spec in config.get("studies", {}).items():
+        studies[name] = Study(
+            name=name,
+            csv=os.path.join(base, spec["csv"]),
+            skip_queries=int(spec.get("skip_queries", 0)),
+            max_queries=int(spec["max_queries"]) if spec.get("max_queries") is not None else None,
+            description=spec.get("description", ""),
+        )
+    return config.get("default"), studies
+
+
+def get_study(name=None, path=STUDIES_FILE):
+    """按名字（默认 STUDY 环境变量，其次 studies.json 的 default）取实验配置。"""
+    default, studies = load_studies(path)
+    name = name or STUDY or default
+    if name not in studies:
+        raise ValueError(f"未知的实验 {name!r}，可选: {', '.join(sorted(studies))}")
+    return studies[name]
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# 模块都在仓库根目录（没有包结构）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+from textstore import text_cache  # noqa: E402
+
+
+@pytest.fixture
+def sqlite_storage(tmp_path, monkeypatch):
+    """临时目录中的 SQLite 存储，并替换 get_storage() 返回的全局实例。"""
+    s = storage.SQLiteStorage(str(tmp_path / "study.db"))
+    s.ensure_schema()
+    monkeypatch.setattr(storage, "_storage", s)
+    text_cache.clear()
+    yield s
+    text_cache.clear()
@@ -0,0 +1,18 @@
+import pytest
+
+
+@pytest.fixture
+def client(sqlite_storage, monkeypatch):
+    import app as app_module
+    monkeypatch.setattr(app_module, "ADMIN_TOKEN", "secret")
+    with app_module.app.test_client() as client:
+        yield client
+
+
+@pytest.mark.parametrize("path", ["/api/pool", "/api/balance"])
+def test_operational_endpoints_require_admin_token(client, path):
+    assert client.get(path).status_code == 403
+    assert client.get(path, query_string={"token": "wrong"}).status_code == 403
+    response = client.get(path, headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    assert response.is_json
@@ -0,0 +1,74 @@
+import itertools
+import random
+
+import numpy as np
+import pytest
+
+import agreement
+
+
+def _brute_force(spans, k, length):
+    """逐对枚举集合的交并（k 个评分者中没有区间的按空集计）。"""
+    sets = [set(range(max(0, s), min(e, length))) for s, e in spans] + [set()] * (k - len(spans))
+    inter = sum(len(a & b) for a, b in itertools.combinations(sets, 2))
+    union = sum(len(a | b) for a, b in itertools.combinations(sets, 2))
+    return inter / union if union else float("nan")
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_pairwise_jaccard_matches_brute_force(seed):
+    rng = random.Random(seed)
+    length = rng.randint(1, 200)
+    k = rng.randint(2, 8)
+    spans = []
+    for _ in range(rng.randint(1, k)):
+        start = rng.randint(0, length - 1)
+        spans.append((start, rng.randint(start + 1, length)))
+    bounds = np.array(spans, dtype=np.int64)
+    cov = agreement.coverage(bounds[:, 0], bounds[:, 1], length)
+    jaccard, _ = agreement.pairwise_stats(cov, k)
+    assert jaccard == pytest.approx(_brute_force(spans, k, length))
+
+
+def test_pairwise_matrix_matches_brute_force():
+    rng = random.Random(1)
+    users = ["a", "b", "c", "d"]
+    spans_by_doc = {}
+    for doc in range(5):
+        spans = {}
+        for user in users:
+            if rng.random() < 0.8:
+                start = rng.randint(0, 50)
+                spans[user] = (start, start + rng.randint(1, 30))
+        spans_by_doc[(1, str(doc))] = spans
+    matrix = agreement.pairwise_matrix(spans_by_doc, users)
+    for i, j in itertools.combinations(range(len(users)), 2):
+        inter = union = 0
+        for spans in spans_by_doc.values():
+            a = set(range(*spans[users[i]])) if users[i] in spans else None
+            b = set(range(*spans[users[j]])) if users[j] in spans else None
+            if a is None or b is None:
+                continue
+            inter += len(a & b)
+            union += len(a | b)
+        assert matrix[i, j] == pytest.approx(inter / union)
+
+
+def test_final_spans_latest_selection_wins():
+    events = [
+        ("u1", 1, "d1", "PASSAGE_SELECTION", 0, 5),
+        ("u1", 1, "d1", "PASSAGE_SELECTION", 2, 8),
+        ("u2", 1, "d1", "PASSAGE_SELECTION", 1, 4),
+        ("u2", 1, "d1", "UNSELECT", -1, -1),
+        ("u3", 1, "d1", "PASSAGE_SELECTION", 3, 3),  # 空区间忽略
+    ]
+    assert agreement.final_spans(events) == {(1, "d1"): {"u1": (2, 8)}}
+
+
+def test_spans_to_tokens_counts_any_overlap():
+    text = agreement.normalize_text("  alpha   beta\ngamma delta ")
+    assert text == "alpha beta gamma delta"
+    tok_starts, tok_ends = agreement.token_bounds(text)
+    first, last = agreement.spans_to_tokens(np.array([4, 11]), np.array([7, 12]), tok_starts, tok_ends)
+    assert first.tolist() == [0, 2]
+    assert last.tolist() == [2, 3]
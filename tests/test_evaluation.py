@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+import evaluation
+
+
+def _tensors(seed=0, users=6, queries=4, docs=5, labels=("A", "B", "C")):
+    rng = np.random.default_rng(seed)
+    shown = np.ones((users, queries, docs), dtype=bool)
+    shown[0, 0, :] = False  # 有一个 (用户, 查询) 没看过
+    selected = (rng.random((users, queries, docs)) < 0.4) & shown
+    position = np.argsort(rng.random((users, queries, docs)), axis=2)
+    label_index = rng.integers(0, len(labels), (queries, docs))
+    system_rank = np.tile(np.arange(docs), (queries, 1))
+    return evaluation.StudyTensors(list(range(users)), list(range(queries)), list(labels), shown, selected,
+                                   position, label_index, system_rank)
+
+
+def _point(stat, t):
+    return stat(np.ones((1, len(t.users))), np.ones((1, len(t.qids))))[0]
+
+
+def test_label_rates_point_estimate_counts_selections():
+    t = _tensors()
+    rates = _point(evaluation.label_rates(t), t)
+    for label in range(len(t.labels)):
+        mask = t.label_index[None] == label
+        expected = (t.selected & mask).sum() / (t.shown & mask).sum()
+        assert rates[label] == pytest.approx(expected)
+
+
+def test_display_curve_point_estimate():
+    t = _tensors(seed=1)
+    n = t.shown.shape[2]
+    curve = _point(evaluation.rank_curve(t, t.position, n), t)
+    for p in range(n):
+        at = t.position == p
+        assert curve[p] == pytest.approx((t.selected & at).sum() / (t.shown & at).sum())
+
+
+def test_win_rates_count_ties_as_half():
+    t = _tensors(seed=2)
+    pairs = evaluation.system_pairs(t)
+    rates = _point(evaluation.win_rates(t, pairs), t)
+    for k, (a, b) in enumerate(pairs):
+        wins = total = 0.0
+        for u in range(len(t.users)):
+            for q in range(len(t.qids)):
+                if not t.shown[u, q].any() or not ((t.label_index[q] == a).any() and (t.label_index[q] == b).any()):
+                    continue
+                ca = (t.selected[u, q] & (t.label_index[q] == a)).sum()
+                cb = (t.selected[u, q] & (t.label_index[q] == b)).sum()
+                wins += 1.0 if ca > cb else 0.5 if ca == cb else 0.0
+                total += 1
+        assert rates[k] == pytest.approx(wins / total)
+
+
+def test_bootstrap_interval_contains_point_estimate():
+    t = _tensors(seed=3, users=20)
+    point, lower, upper = evaluation.bootstrap(evaluation.label_rates(t), len(t.users), len(t.qids),
+                                               n_boot=500, batch=200)
+    assert point.shape == lower.shape == upper.shape == (len(t.labels),)
+    assert np.all(lower <= point) and np.all(point <= upper)
+
+
+def test_system_curve_uses_observed_ranks():
+    t = _tensors(seed=4)
+    # 排名从 1 起且稀疏，另有一篇排名未知
+    system_rank = np.tile(np.array([1, 5, 9, 98, -1]), (len(t.qids), 1))
+    t = t._replace(system_rank=system_rank)
+    index, values = evaluation.observed_ranks(system_rank)
+    assert values.tolist() == [1, 5, 9, 98]
+    assert index[0].tolist() == [0, 1, 2, 3, -1]
+    curve = evaluation.evaluate(t, n_boot=20)["system_curve"]
+    assert [row["name"] for row in curve] == [1, 5, 9, 98]
+    at_98 = system_rank[None] == 98
+    assert curve[3]["estimate"] == pytest.approx(
+        (t.selected & at_98).sum() / (t.shown & at_98).sum(), abs=1e-4)
@@ -0,0 +1,47 @@
+import pandas as pd
+
+from importer import StreamingImporter, select_qids
+
+
+def _write_csv(path, n_queries=7, docs_per_query=4):
+    rows = []
+    for q in range(n_queries):
+        qid = 100 + (q * 37) % 11  # 不按大小顺序出现
+        for d in range(docs_per_query):
+            text = None if (q + d) % 5 == 0 else f"text {q}-{d % 2}"  # 有空正文，也有重复正文
+            rows.append({"qid": qid, "query": f"query {qid}", "docno": f"{qid}-{d:02d}", "text": text})
+    pd.DataFrame(rows).to_csv(path, index=False)
+
+
+def _reference(csv_path, skip_queries, max_queries, start_id):
+    # 原来的整表实现：读入全部行，按 qid 首次出现顺序切片，文档 ID = MAX(id) + 行号 + 1
+    df = pd.read_csv(csv_path, dtype={"docno": str})
+    order = list(dict.fromkeys(df["qid"].tolist()))
+    stop = skip_queries + max_queries if max_queries is not None else None
+    keep = set(order[skip_queries:stop])
+    df = df[df["qid"].isin(keep)]
+    queries = {qid: query for qid, query in zip(df["qid"], df["query"])}
+    documents = [(index + start_id + 1, qid, docno, None if pd.isna(text) else text)
+                 for index, qid, docno, text in zip(df.index, df["qid"], df["docno"], df["text"])]
+    return queries, documents
+
+
+def test_select_qids_uses_first_appearance(tmp_path):
+    path = tmp_path / "data.csv"
+    _write_csv(path)
+    order = list(dict.fromkeys(pd.read_csv(path)["qid"].tolist()))
+    assert select_qids(path, 2, chunk_size=3) == set(order[2:])
+    assert select_qids(path, 1, chunk_size=3, max_queries=3) == set(order[1:4])
+
+
+def test_streaming_import_matches_whole_file_import(sqlite_storage, tmp_path):
+    path = tmp_path / "data.csv"
+    _write_csv(path)
+    importer = StreamingImporter(chunk_size=5, batch_size=3, storage=sqlite_storage)
+    n_queries, n_docs = importer.import_csv(str(path), skip_queries=1, max_queries=5)
+
+    queries, documents = _reference(path, 1, 5, start_id=0)
+    assert (n_queries, n_docs) == (len(queries), len(documents))
+    _, loaded_queries, loaded_docs = sqlite_storage.load_corpus()
+    assert {row["id"]: row["content"] for row in loaded_queries} == queries
+    assert sorted((row["id"], row["qid"], row["docno"], row["content"]) for row in loaded_docs) == documents
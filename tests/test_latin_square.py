@@ -0,0 +1,32 @@
+from collections import Counter
+
+import pytest
+
+import latin_square
+
+
+@pytest.mark.parametrize("n", range(1, 12))
+def test_rows_are_permutations_and_positions_balanced(n):
+    square = latin_square.balanced_latin_square(n)
+    assert len(square) == latin_square.num_rows(n)
+    for row in square:
+        assert sorted(row) == list(range(n))
+    copies = len(square) // n
+    for position in range(n):
+        assert Counter(row[position] for row in square) == {doc: copies for doc in range(n)}
+
+
+@pytest.mark.parametrize("n", range(2, 12))
+def test_adjacent_pairs_balanced(n):
+    square = latin_square.balanced_latin_square(n)
+    pairs = Counter((row[i], row[i + 1]) for row in square for i in range(n - 1))
+    # 偶数 n 每个有序相邻对出现一次，奇数 n（加上逆序行）出现两次
+    expected = 1 if n % 2 == 0 else 2
+    assert set(pairs.values()) == {expected}
+    assert len(pairs) == n * (n - 1)
+
+
+def test_permutation_for_wraps_rows():
+    n = 5
+    assert latin_square.permutation_for(latin_square.num_rows(n) + 3, n) == latin_square.permutation_for(3, n)
+    assert latin_square.permutation_for(0, 0) == ()
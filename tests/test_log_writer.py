@@ -0,0 +1,86 @@
+from datetime import datetime
+
+import pytest
+
+from log_writer import BufferedLogWriter, InvalidEvent, event_to_row
+
+
+class _Collector:
+    def __init__(self):
+        self.rows = []
+
+    def submit(self, rows):
+        self.rows.extend(rows)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    import app as app_module
+    collector = _Collector()
+    monkeypatch.setattr(app_module, "log_writer", collector)
+    with app_module.app.test_client() as client:
+        client.collector = collector
+        yield client
+
+
+def test_event_to_row_coerces_fields():
+    now = datetime.now()
+    row = event_to_row({"userId": "u1", "qid": "3", "docno": 17, "eventType": "OPEN_DOC",
+                        "duration": 12.4, "passFlag": True, "eventId": "e1"}, now)
+    assert row[:9] == ("u1", 3, "17", "OPEN_DOC", -1, -1, 12, 1, now)
+    assert row[9] == event_to_row({"userId": "u1", "eventId": "e1"}, now)[9]
+
+
+@pytest.mark.parametrize("event", [
+    {"eventType": "OPEN_DOC"},
+    {"userId": "", "eventType": "OPEN_DOC"},
+    {"userId": "u1", "qid": "abc"},
+    {"userId": "u1", "duration": [1]},
+    {"userId": "u1", "startIndex": float("nan")},
+    {"userId": "u1", "endIndex": 2 ** 40},
+    {"userId": "u1", "passFlag": 1000},
+    {"userId": "x" * 101},
+    {"userId": "u1", "docno": {"a": 1}},
+])
+def test_event_to_row_rejects_unwritable_events(event):
+    with pytest.raises(InvalidEvent):
+        event_to_row(event, datetime.now())
+
+
+def test_single_event_endpoint_rejects_invalid_event(client):
+    response = client.post("/api/log", json={"eventType": "OPEN_DOC"})
+    assert response.status_code == 400
+    assert client.collector.rows == []
+    response = client.post("/api/log", json={"userId": "u1", "eventType": "OPEN_DOC"})
+    assert response.status_code == 200
+    assert len(client.collector.rows) == 1
+
+
+def test_batch_endpoint_drops_only_invalid_events(client):
+    events = [{"userId": "u1", "eventType": "OPEN_DOC"}, {"userId": "u1", "duration": "soon"}, "junk",
+              {"userId": "u1", "eventType": "CANCEL_DOC"}]
+    response = client.post("/api/log/batch", json={"events": events})
+    assert response.status_code == 200
+    assert response.get_json()["count"] == 2
+    assert response.get_json()["dropped"] == 2
+    assert [row[3] for row in client.collector.rows] == ["OPEN_DOC", "CANCEL_DOC"]
+
+
+def test_writer_drops_rows_the_database_rejects(sqlite_storage):
+    now = datetime.now()
+    good = [(f"u{i}", 1, "d", "OPEN_DOC", -1, -1, 10, 0, now, f"k{i}") for i in range(5)]
+    bad = (None, 1, "d", "OPEN_DOC", -1, -1, 10, 0, now, "k-bad")  # user_id NOT NULL
+    writer = BufferedLogWriter()
+    writer._write(good[:2] + [bad] + good[2:])
+    assert writer.stats()["rows_written"] == 5
+    assert writer.stats()["rows_rejected"] == 1
+    assert sqlite_storage.max_log_id() == 5
+    assert sorted(row["user_id"] for row in sqlite_storage.progress_rows()) == [f"u{i}" for i in range(5)]
+
+
+def test_insert_logs_or_reject_raises_database_errors(sqlite_storage, monkeypatch):
+    def unavailable(rows):
+        raise OSError("database unavailable")
+    monkeypatch.setattr(sqlite_storage, "insert_logs", unavailable)
+    with pytest.raises(OSError):
+        sqlite_storage.insert_logs_or_reject([("u", 1, "d", "OPEN_DOC", -1, -1, 0, 0, datetime.now(), "k")])
@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+import migrations
+
+requires_mysql = pytest.mark.skipif(not os.environ.get("MYSQL_URL"), reason="需要 MYSQL_URL 指向的 MySQL")
+
+
+def test_versions_are_consecutive():
+    versions = [m.version for m in migrations.MIGRATIONS]
+    assert versions == list(range(1, len(versions) + 1))
+    assert migrations.LATEST_VERSION == versions[-1]
+
+
+def test_sqlite_schema_is_recorded_as_latest(sqlite_storage):
+    assert sqlite_storage.schema_version() == migrations.LATEST_VERSION
+
+
+@requires_mysql
+def test_migrate_is_idempotent():
+    assert migrations.migrate() == migrations.LATEST_VERSION
+    assert migrations.migrate() == migrations.LATEST_VERSION
+
+
+@requires_mysql
+def test_hot_queries_use_expected_indexes():
+    migrations.migrate()
+    for sql, expected, keys, passed in migrations.explain_hot_queries():
+        assert passed, f"{sql}: 期望索引 {expected}，EXPLAIN 得到 {keys}"
@@ -0,0 +1,34 @@
+import pytest
+
+from corpus_cache import corpus_cache
+
+
+@pytest.fixture
+def client(sqlite_storage):
+    import app as app_module
+    sqlite_storage.insert_queries([(1, "first query"), (2, "second query")])
+    hashes, _ = sqlite_storage.store_texts([f"text {i}" for i in range(6)])
+    sqlite_storage.insert_documents([(i + 1, 1 + i // 3, f"d{i}", h) for i, h in enumerate(hashes)])
+    corpus_cache.invalidate()
+    with app_module.app.test_client() as client:
+        client.post("/", data={"user_id": "u1", "terms": "on"})
+        yield client
+    corpus_cache.invalidate()
+
+
+def test_first_revisit_after_position_one_is_not_modified(client):
+    first = client.get("/query/2")
+    assert first.status_code == 200
+    revisit = client.get("/query/2", headers={"If-None-Match": first.headers["ETag"]})
+    assert revisit.status_code == 304
+    assert revisit.headers["ETag"] == first.headers["ETag"]
+
+
+def test_first_visit_to_position_one_has_its_own_etag(client):
+    first = client.get("/query/1")
+    revisit = client.get("/query/1", headers={"If-None-Match": first.headers["ETag"]})
+    # 首次访问的页面会重置人机验证，回访的页面不会
+    assert revisit.status_code == 200
+    assert revisit.headers["ETag"] != first.headers["ETag"]
+    again = client.get("/query/1", headers={"If-None-Match": revisit.headers["ETag"]})
+    assert again.status_code == 304
@@ -0,0 +1,121 @@
+import fcntl
+import glob
+import os
+import threading
+from datetime import datetime
+
+import pytest
+
+import spool
+from spool import LogSpool
+
+
+def _row(key, user="u1", event_type="OPEN_DOC"):
+    return (user, 1, "d1", event_type, -1, -1, 10, 0, datetime(2026, 1, 1, 12, 0), key)
+
+
+def _write_segment(directory, name, rows, tail=b""):
+    path = os.path.join(str(directory), name)
+    with open(path, "wb") as f:
+        f.write(b"".join(spool._encode_row(row) for row in rows) + tail)
+    return path
+
+
+def _files(directory, pattern="*"):
+    return sorted(os.path.basename(p) for p in glob.glob(os.path.join(str(directory), pattern)))
+
+
+@pytest.fixture
+def log_spool(sqlite_storage, tmp_path, monkeypatch):
+    # 投递线程立即退出，测试里直接调用 ship_pending
+    monkeypatch.setattr(LogSpool, "_run_shipper", lambda self: None)
+    return LogSpool(str(tmp_path / "spool"), batch_size=3, group_commit=0.05, seal_interval=3600,
+                    max_attempts=2)
+
+
+def test_group_commit_shares_fsyncs(log_spool):
+    barrier = threading.Barrier(8)
+
+    def submit(i):
+        barrier.wait()
+        log_spool.submit([_row(f"k{i}")])
+
+    log_spool.start()
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert log_spool.events_appended == 8
+    assert log_spool.fsyncs < 8
+    with open(log_spool._path, "rb") as f:
+        assert sorted(spool._decode_row(line)[-1] for line in f) == [f"k{i}" for i in range(8)]
+
+
+def test_torn_last_line_is_skipped(log_spool, sqlite_storage):
+    os.makedirs(log_spool.directory)
+    _write_segment(log_spool.directory, "1-1-1.ready", [_row("k1"), _row("k2")], tail=b'["u1",1,"d1","OPE')
+    assert log_spool.ship_pending() == 1
+    assert sqlite_storage.max_log_id() == 2
+    assert _files(log_spool.directory) == []
+
+
+def test_orphaned_segment_is_replayed_unless_locked(log_spool, sqlite_storage):
+    os.makedirs(log_spool.directory)
+    orphan = _write_segment(log_spool.directory, "1-1-1.seg", [_row("k1")])
+    held = _write_segment(log_spool.directory, "2-1-1.seg", [_row("k2")])
+    with open(held, "rb") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)  # 写入进程还活着
+        assert log_spool.ship_pending() == 1
+    assert not os.path.exists(orphan)
+    assert os.path.exists(held)
+    assert [row["events"] for row in sqlite_storage.progress_rows()] == [1]
+
+
+def test_reshipped_rows_are_deduplicated(log_spool, sqlite_storage):
+    os.makedirs(log_spool.directory)
+    rows = [_row(f"k{i}") for i in range(4)]
+    _write_segment(log_spool.directory, "1-1-1.ready", rows)
+    _write_segment(log_spool.directory, "1-1-2.ready", rows[2:] + [_row("k4")])
+    assert log_spool.ship_pending() == 2
+    assert sqlite_storage.max_log_id() == 5
+    assert log_spool.stats()["rows_shipped"] == 5
+    assert log_spool.stats()["duplicates_skipped"] == 2
+    assert sqlite_storage.progress_rows()[0]["events"] == 5
+
+
+def test_rejected_rows_are_kept_and_the_rest_shipped(log_spool, sqlite_storage):
+    os.makedirs(log_spool.directory)
+    _write_segment(log_spool.directory, "1-1-1.ready", [_row("k1"), _row("k-bad", user=None), _row("k2")])
+    _write_segment(log_spool.directory, "1-1-2.ready", [_row("k3")])
+    assert log_spool.ship_pending() == 2
+    assert sqlite_storage.max_log_id() == 3
+    assert _files(log_spool.directory) == ["1-1-1.bad"]
+    with open(os.path.join(log_spool.directory, "1-1-1.bad"), "rb") as f:
+        assert [spool._decode_row(line)[-1] for line in f] == ["k-bad"]
+    assert log_spool.stats()["rows_rejected"] == 1
+
+
+def test_failing_segment_is_quarantined_without_blocking_others(log_spool, sqlite_storage, monkeypatch):
+    insert_logs = sqlite_storage.insert_logs
+
+    def flaky(rows):
+        if any(row[-1] == "poison" for row in rows):
+            raise RuntimeError("unexpected failure")
+        return insert_logs(rows)
+
+    monkeypatch.setattr(sqlite_storage, "insert_logs", flaky)
+    os.makedirs(log_spool.directory)
+    _write_segment(log_spool.directory, "1-1-1.ready", [_row("poison")])
+    _write_segment(log_spool.directory, "1-1-2.ready", [_row("k1")])
+    # 第一个段失败、本轮还没有投递成功的段：可能是数据库不可用，停止本轮
+    with pytest.raises(RuntimeError):
+        log_spool.ship_pending()
+    # 失败过的段排到最后，其他段照常投递
+    assert log_spool.ship_pending() == 1
+    assert _files(log_spool.directory) == ["1-1-1.ready"]
+    _write_segment(log_spool.directory, "1-1-3.ready", [_row("k2")])
+    assert log_spool.ship_pending() == 1
+    assert _files(log_spool.directory) == ["1-1-1.bad"]
+    assert sqlite_storage.max_log_id() == 2
+    assert log_spool.stats()["segments_quarantined"] == 1
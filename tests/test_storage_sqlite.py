@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+import export
+
+
+def _log_row(user, qid, event_type, key, timestamp, docno="1", duration=10):
+    return (user, qid, docno, event_type, -1, -1, duration, 0, timestamp, key)
+
+
+def test_assign_slot_is_unique_under_concurrency(sqlite_storage):
+    users = [f"user-{i}" for i in range(200)]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        slots = list(pool.map(sqlite_storage.assign_slot, users))
+    assert sorted(slots) == list(range(200))
+    # 回访用户沿用原来的 slot，不消耗新的序号
+    assert sqlite_storage.assign_slot("user-7") == slots[7]
+    counts = sqlite_storage.slot_counts(9)
+    assert sum(counts) == 200
+    assert max(counts) - min(counts) <= 1
+
+
+def test_insert_logs_dedupes_retries_with_new_timestamp(sqlite_storage):
+    now = datetime.now()
+    first = [_log_row("u1", 1, "PASSAGE_SELECTION", "k1", now),
+             _log_row("u1", 1, "OPEN_DOC", "k2", now)]
+    assert sqlite_storage.insert_logs(first) == 2
+    # 客户端重发：同一 event_key，服务器接收时间不同
+    retry = [_log_row("u1", 1, "PASSAGE_SELECTION", "k1", now + timedelta(seconds=30)),
+             _log_row("u1", 1, "UNSELECT", "k3", now + timedelta(seconds=31))]
+    assert sqlite_storage.insert_logs(retry) == 1
+    progress = {(row["user_id"], row["qid"]): row for row in sqlite_storage.progress_rows()}
+    row = progress[("u1", 1)]
+    assert row["events"] == 3
+    assert row["passage_selections"] == 1
+    assert row["unselects"] == 1
+    assert row["time_on_task_ms"] == 30
+
+
+def test_iter_log_export_respects_bounds(sqlite_storage):
+    now = datetime.now()
+    sqlite_storage.insert_logs([_log_row("u", 1, "OPEN_DOC", f"k{i}", now) for i in range(10)])
+    assert sqlite_storage.max_log_id() == 10
+    ids = [row[0] for rows in sqlite_storage.iter_log_export(3, 7, chunk_rows=2) for row in rows]
+    assert ids == [4, 5, 6, 7]
+
+
+def test_export_advances_watermark_to_bound(sqlite_storage, tmp_path):
+    now = datetime.now()
+    sqlite_storage.insert_logs([_log_row("u", 1, "OPEN_DOC", f"k{i}", now) for i in range(5)])
+    out = str(tmp_path / "exports")
+    assert export.export_logs(out, chunk_rows=2, settle_seconds=0) == 5
+    assert sqlite_storage.get_meta(export.WATERMARK_META_KEY) == "5"
+    assert export.export_logs(out, settle_seconds=0) == 0
+    sqlite_storage.insert_logs([_log_row("u", 1, "OPEN_DOC", "k-late", now)])
+    assert export.export_logs(out, settle_seconds=0) == 1
+    manifest = export.load_manifest(out)
+    assert manifest["watermark"] == 6
+    assert [part["rows"] for part in manifest["parts"]] == [5, 1]
+
+
+def test_export_picks_up_ids_committed_after_the_bound(sqlite_storage, tmp_path):
+    now = datetime.now()
+    sqlite_storage.insert_logs([_log_row("u", 1, "OPEN_DOC", f"k{i}", now) for i in range(5)])
+    # id 3 的事务在导出时还没有提交
+    late = sqlite_storage._execute("SELECT * FROM logs WHERE id = 3")[0]
+    sqlite_storage._execute("DELETE FROM logs WHERE id = 3", commit=True)
+    out = str(tmp_path / "exports")
+    assert export.export_logs(out, settle_seconds=0) == 4
+    assert [gap[:2] for gap in export.load_manifest(out)["gaps"]] == [[3, 3]]
+    sqlite_storage._execute("INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", tuple(late), commit=True)
+    assert export.export_logs(out, settle_seconds=0) == 1
+    manifest = export.load_manifest(out)
+    assert manifest["gaps"] == []
+    assert manifest["watermark"] == 5
+    assert [(part["first_id"], part["last_id"]) for part in manifest["parts"]] == [(1, 5), (3, 3)]
+
+
+def test_export_records_gaps_across_chunks(sqlite_storage, tmp_path):
+    now = datetime.now()
+    sqlite_storage.insert_logs([_log_row("u", 1, "OPEN_DOC", f"k{i}", now) for i in range(10)])
+    sqlite_storage._execute("DELETE FROM logs WHERE id IN (1, 4, 5, 8)", commit=True)
+    out = str(tmp_path / "exports")
+    assert export.export_logs(out, chunk_rows=2, settle_seconds=0) == 6
+    manifest = export.load_manifest(out)
+    assert [gap[:2] for gap in manifest["gaps"]] == [[1, 1], [4, 5], [8, 8]]
+    assert [(part["first_id"], part["last_id"]) for part in manifest["parts"]] == [(2, 10)]
+
+
+def test_export_stops_checking_old_gaps(sqlite_storage, tmp_path):
+    now = datetime.now()
+    sqlite_storage.insert_logs([_log_row("u", 1, "OPEN_DOC", f"k{i}", now) for i in range(3)])
+    sqlite_storage._execute("DELETE FROM logs WHERE id = 2", commit=True)
+    out = str(tmp_path / "exports")
+    assert export.export_logs(out, settle_seconds=0) == 2
+    assert export.export_logs(out, settle_seconds=0, gap_seconds=0) == 0
+    assert export.load_manifest(out)["gaps"] == []
+
+
+def test_failed_partition_check_is_retried(sqlite_storage, monkeypatch):
+    calls = []
+
+    def check():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OSError("database unavailable")
+        return ["p202701"]
+
+    monkeypatch.setattr(sqlite_storage, "_ensure_log_partitions", check)
+    with pytest.raises(OSError):
+        sqlite_storage.ensure_log_partitions()
+    assert sqlite_storage.ensure_log_partitions() == ["p202701"]
+    assert sqlite_storage.ensure_log_partitions() == []
+    assert len(calls) == 2
+
+
+def test_backfill_matches_incremental_progress(sqlite_storage):
+    now = datetime.now()
+    sqlite_storage.insert_logs([
+        _log_row("u1", 1, "OPEN_DOC", "k1", now, duration=120),
+        _log_row("u1", 1, "PASSAGE_SELECTION", "k2", now + timedelta(seconds=1), duration=40),
+        _log_row("u1", 2, "UNSELECT", "k3", now + timedelta(seconds=2), duration=15),
+        # 旧页面只把暂停时长写在事件类型里，duration 为 0
+        _log_row("u1", 0, "PAUSE_DURATION: 1500", "k4", now + timedelta(seconds=3), docno="PAUSE", duration=0),
+        _log_row("u1", 0, "PAUSE_DURATION: 900", "k5", now + timedelta(seconds=4), docno="PAUSE", duration=900),
+        _log_row("u2", None, "OPEN_DOC", "k6", now, duration=30),
+        _log_row("u2", 1, "OPEN_DOC", "k7", now + timedelta(seconds=5), duration=70),
+    ])
+    incremental = sorted(sqlite_storage.progress_rows(), key=lambda row: (row["user_id"], row["qid"]))
+    conn = sqlite_storage._conn()
+    with conn:
+        conn.execute("DELETE FROM participant_progress")
+        sqlite_storage._backfill_progress(conn)
+    backfilled = sorted(sqlite_storage.progress_rows(), key=lambda row: (row["user_id"], row["qid"]))
+    assert backfilled == incremental
+    assert {(row["user_id"], row["qid"]): row["pause_ms"] for row in backfilled}[("u1", 0)] == 2400
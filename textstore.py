@@ -0,0 +1,132 @@
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:  # zstandard 为可选依赖，未安装时用 zlib
+    zstandard = None
+
+# ------------------ 按内容寻址的文档正文 ------------------
+# 文档正文存放在 texts 表（hash, codec, size, body），documents.content_hash 引用它：
+# 多个数据集、多轮实验共用的同一段 MS MARCO 文本只存一份，且以压缩形式存放。
+#   hash   正文 UTF-8 字节的 sha256（十六进制）
+#   codec  zstd / zlib / raw（压缩后不比原文小时原样存放，短文本常见）
+#   size   原文字节数
+# 解压后的正文放在进程内的 LRU 缓存里（TEXT_CACHE_SIZE 条），同一正文在内存里也只有一份。
+#   TEXT_CODEC  新写入正文使用的压缩方式，默认装了 zstandard 时为 zstd，否则为 zlib
+
+TEXT_CODEC = os.environ.get("TEXT_CODEC", "zstd" if zstandard is not None else "zlib")
+TEXT_CACHE_SIZE = int(os.environ.get("TEXT_CACHE_SIZE", "20000"))
+FETCH_BATCH = 500
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def compress(data, codec=TEXT_CODEC):
+    """原文字节 -> (实际使用的 codec, body)。"""
+    if codec == "zstd":
+        body = zstandard.ZstdCompressor(level=10).compress(data)
+    elif codec == "zlib":
+        body = zlib.compress(data, 9)
+    else:
+        return "raw", data
+    return (codec, body) if len(body) < len(data) else ("raw", data)
+
+
+def decompress(codec, body):
+    body = bytes(body)
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("正文以 zstd 压缩存放，需要安装 zstandard")
+        data = zstandard.ZstdDecompressor().decompress(body)
+    elif codec == "zlib":
+        data = zlib.decompress(body)
+    else:
+        data = body
+    return data.decode("utf-8")
+
+
+def text_row(text, codec=TEXT_CODEC):
+    """正文 -> texts 表的一行 (hash, codec, size, body)。"""
+    data = text.encode("utf-8")
+    used, body = compress(data, codec)
+    return hashlib.sha256(data).hexdigest(), used, len(data), body
+
+
+def split_contents(rows):
+    """
+    旧结构 documents 的 [(id, content), ...] -> (去重后的 texts 行, [(content_hash, id), ...])，
+    供迁移把 documents.content 搬到 texts 表。
+    """
+    texts = {}
+    updates = []
+    for doc_id, content in rows:
+        row = text_row(content)
+        texts.setdefault(row[0], row)
+        updates.append((row[0], doc_id))
+    return list(texts.values()), updates
+
+
+def fetch_many(hashes, fetch):
+    """不经过缓存按 FETCH_BATCH 分批读取并解压，返回 {hash: 正文}。"""
+    loaded = {}
+    for i in range(0, len(hashes), FETCH_BATCH):
+        for h, (codec, body) in fetch(hashes[i:i + FETCH_BATCH]).items():
+            loaded[h] = decompress(codec, body)
+    return loaded
+
+
+class TextCache:
+    """hash -> 解压后正文的 LRU 缓存，线程安全；未命中的 hash 批量从存储读取。"""
+
+    def __init__(self, max_entries=TEXT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, hashes, fetch):
+        """
+        返回 {hash: 正文}；fetch(hashes) -> {hash: (codec, body)} 读取未命中的部分。
+        存储中不存在的 hash 不出现在结果里。
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            for h in set(hashes):
+                text = self._entries.get(h)
+                if text is None:
+                    missing.append(h)
+                else:
+                    self._entries.move_to_end(h)
+                    found[h] = text
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        loaded = fetch_many(missing, fetch)
+        if loaded:
+            with self._lock:
+                for h, text in loaded.items():
+                    self._entries[h] = text
+                    self._entries.move_to_end(h)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        found.update(loaded)
+        return found
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+text_cache = TextCache()